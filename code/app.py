@@ -1,16 +1,30 @@
 """
 Implements a Streamlit app for answering questions about Tonkin's projects
 using RAG.
+
+Streamlit reruns this script on every interaction, so its top level only
+imports light modules: the projects are listed from the catalog written
+by the build, and the index, OpenAI and PDF modules are imported when a
+search first needs them, or by a background preload after first paint.
 """
 
 import os
-import json
+import time
+import importlib
+import threading
+import contextvars
+from typing import TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
 
-from pdf_preview import display_pdf_preview
-from faiss_search import load_index, embed_query, search_faiss_index
-from rag import format_prompt, load_openai_api_key, call_openai_model
+import tracing
+from service_client import ServiceClient, ServiceError
+from catalog import load_catalog, is_current
+
+if TYPE_CHECKING:
+    from resources import ResourceRegistry
+    from page_cache import PageImageCache
 
 
 MODEL_ENUM = {
@@ -25,6 +39,366 @@ TONKIN_LOGO_COLOR = '#5E3F99'
 PROJECT_TOP_K = 5
 GLOBAL_TOP_K = 20
 
+# Threads shared by all sessions for pre-rendering previews.
+PREVIEW_WORKERS = 8
+
+PROJECT_FOLDER = os.path.join(
+    os.path.dirname(__file__), '..', 'data', 'projects'
+)
+OPENAI_KEY_PATH = os.path.join(
+    os.path.dirname(__file__), 'OPENAI_API_KEY.txt'
+)
+CACHE_FOLDER = os.path.join(
+    os.path.dirname(__file__), '..', 'data', 'cache'
+)
+
+# JSON span log ('-' for standard error), Prometheus metrics file
+# rewritten after every search, and port serving the metrics at
+# /metrics; tracing is disabled while all are None.
+TRACE_LOG_PATH = None
+METRICS_PATH = None
+METRICS_PORT = None
+
+# Whether to load the shared index, the OpenAI client and the query-path
+# modules in the background once the first page is shown, so the first
+# search does not wait for them.
+PRELOAD_INDEX = True
+PRELOAD_MODULES = ('rag', 'pdf_preview', 'hybrid_search')
+
+# URL of a running query service (see service.py), e.g.
+# 'http://127.0.0.1:8000'. When set, the app is a thin client of it and
+# loads no index; previews are still rendered from the local PDFs.
+SERVICE_URL = None
+
+
+@st.cache_resource
+def configure_tracing() -> None:
+    """
+    Configures tracing once per process.
+    """
+    tracing.configure(
+        log_path=TRACE_LOG_PATH,
+        metrics_path=METRICS_PATH,
+        metrics_port=METRICS_PORT
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_registry() -> 'ResourceRegistry':
+    """
+    Returns the process-wide resource registry shared by all sessions.
+
+    Returns:
+        ResourceRegistry: The shared resource registry.
+    """
+    from resources import ResourceRegistry
+
+    return ResourceRegistry(
+        os.path.join(PROJECT_FOLDER, 'global'), OPENAI_KEY_PATH, CACHE_FOLDER
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_page_cache() -> 'PageImageCache':
+    """
+    Returns the process-wide cache of rendered pages. A thin client of
+    the query service renders previews from the local PDFs but loads
+    no index, so it opens the page cache alone rather than the whole
+    registry.
+
+    Returns:
+        PageImageCache: The shared page cache.
+    """
+    if SERVICE_URL:
+        from page_cache import PageImageCache
+
+        return PageImageCache(os.path.join(CACHE_FOLDER, 'pages.sqlite'))
+
+    return get_registry().page_cache
+
+
+def list_projects() -> list[str]:
+    """
+    Lists the indexed projects from the catalog of the shared index,
+    falling back to the project folders if the catalog is missing or
+    was written for another build.
+
+    Returns:
+        list[str]: Names of the projects.
+    """
+    index_folder = os.path.join(PROJECT_FOLDER, 'global')
+    catalog = load_catalog(index_folder)
+    if catalog is not None and is_current(catalog, index_folder):
+        return [project['name'] for project in catalog['projects']]
+
+    return sorted(
+        project for project in os.listdir(PROJECT_FOLDER)
+        if project != 'global'
+        and os.path.isdir(os.path.join(PROJECT_FOLDER, project))
+    )
+
+
+def preload() -> None:
+    """
+    Loads the shared index, the project selectors and the OpenAI client,
+    and imports the query-path modules. Failures are only reported, as
+    the first search loads whatever is missing again.
+    """
+    start = time.perf_counter()
+    try:
+        with tracing.span('preload'):
+            # Imported for their import time only.
+            for module in PRELOAD_MODULES:
+                importlib.import_module(module)
+
+            registry = get_registry()
+            resources = registry.index()
+            for project in list_projects():
+                registry.selector(resources, project)
+            registry.client()
+    except Exception as e:
+        print(f'Preloading failed: {type(e).__name__}: {e}')
+        return
+
+    print(f'Preloaded the index in {time.perf_counter() - start:.2f}s.')
+
+
+@st.cache_resource(show_spinner=False)
+def start_preload() -> threading.Thread:
+    """
+    Starts preloading in a background thread, once per process.
+
+    Returns:
+        threading.Thread: The preloading thread.
+    """
+    thread = threading.Thread(target=preload, name='preload', daemon=True)
+    thread.start()
+
+    return thread
+
+
+def generate_answer(
+    client,
+    prompt: str,
+    model_name: str,
+    stream: bool
+) -> str | None:
+    """
+    Generates an answer and shows it, streamed into the page as it
+    arrives if stream is set.
+
+    A new search in the same session cancels the answer still being
+    streamed by an earlier one.
+
+    Args:
+        client (OpenAI): An instance of the OpenAI client.
+        prompt (str): The formatted prompt.
+        model_name (str): The name of the OpenAI model to use.
+        stream (bool): Whether to stream the answer.
+
+    Returns:
+        str | None: The complete answer, or None if it was cancelled.
+    """
+    from embedders import estimate_tokens
+    from rag import (
+        call_openai_model,
+        stream_openai_model,
+        record_llm_usage,
+        SYSTEM_PROMPT
+    )
+
+    if not stream:
+        response = call_openai_model(
+            client=client,
+            prompt=prompt,
+            model_name=model_name
+        )
+        st.success(response)
+        return response
+
+    previous = st.session_state.get('cancel_generation')
+    if previous is not None:
+        previous.set()
+    cancel = threading.Event()
+    st.session_state['cancel_generation'] = cancel
+
+    placeholder = st.empty()
+    response = ''
+    timings = {}
+    with tracing.span('llm', model=model_name, stream=True) as span:
+        for piece in stream_openai_model(
+            client=client,
+            prompt=prompt,
+            model_name=model_name,
+            cancel=cancel,
+            timings=timings
+        ):
+            response += piece
+            placeholder.success(response + ' ▌')
+        placeholder.success(response)
+
+        # Streamed responses carry no usage, so tokens are estimated.
+        prompt_tokens = estimate_tokens(SYSTEM_PROMPT + prompt)
+        completion_tokens = estimate_tokens(response)
+        span.set(
+            ttft_seconds=timings['ttft_seconds'],
+            cancelled=timings['cancelled'],
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens
+        )
+        record_llm_usage(model_name, prompt_tokens, completion_tokens)
+
+    ttft = timings['ttft_seconds']
+    ttft_ms = ttft * 1000 if ttft is not None else float('nan')
+    print(f'Generated answer with {model_name}: first token after '
+          f'{ttft_ms:.0f} ms, total {timings["total_seconds"] * 1000:.0f} '
+          f'ms{" (cancelled)" if timings["cancelled"] else ""}.')
+
+    return None if timings['cancelled'] else response
+
+
+def answer_from_service(
+    service: ServiceClient,
+    query: str,
+    options: dict,
+    stream: bool,
+    prefetch
+) -> tuple[str | None, list[dict]]:
+    """
+    Answers a query through the query service and shows the answer,
+    streamed into the page as it arrives if stream is set.
+
+    As in generate_answer, a new search in the same session cancels
+    the answer still being streamed by an earlier one; closing the
+    stream cancels the generation on the service too.
+
+    Args:
+        service (ServiceClient): Client of the query service.
+        query (str): The user query.
+        options (dict): 'project', 'mode' and 'model' of the request.
+        stream (bool): Whether to stream the answer.
+        prefetch (Callable[[list[dict]], None]): Called with the
+            metadata of the related pages as soon as they are known.
+
+    Returns:
+        tuple[str | None, list[dict]]: The complete answer, or None if
+            it was cancelled, and the metadata of the related pages.
+    """
+    if not stream:
+        result = service.answer(query, **options)
+        prefetch(result['sources'])
+        st.success(result['answer'])
+        return result['answer'], result['sources']
+
+    previous = st.session_state.get('cancel_generation')
+    if previous is not None:
+        previous.set()
+    cancel = threading.Event()
+    st.session_state['cancel_generation'] = cancel
+
+    placeholder = st.empty()
+    response = ''
+    pages = []
+    cancelled = False
+    events = service.stream_answer(query, **options)
+    try:
+        for event in events:
+            if cancel.is_set():
+                cancelled = True
+                break
+            if event['type'] == 'sources':
+                pages = event['sources']
+                prefetch(pages)
+            elif event['type'] == 'delta':
+                response += event['text']
+                placeholder.success(response + ' ▌')
+            elif event['type'] == 'done':
+                cancelled = event['cancelled']
+    finally:
+        events.close()
+    placeholder.success(response)
+
+    return None if cancelled else response, pages
+
+
+@st.fragment
+def show_related_pages(
+    page_cache: 'PageImageCache',
+    pages: list[dict],
+    search_id: int
+) -> None:
+    """
+    Lists the related pages in collapsed expanders. A page's preview is
+    only loaded once its expander is opened, which reruns just this
+    fragment.
+
+    Args:
+        page_cache (PageImageCache): Cache of rendered pages.
+        pages (list[dict]): Metadata of the related pages, in order.
+        search_id (int): Identifies the search, so that expanders start
+            collapsed for every new search.
+    """
+    from pdf_preview import display_pdf_preview
+
+    st.write('**Related Pages**:')
+    for i, metadata in enumerate(pages):
+        expander = st.expander(
+            f'**Source**: {metadata["source"]} '
+            f'(Page {metadata["page_number"]})',
+            key=f'page_{search_id}_{i}',
+            on_change='rerun'
+        )
+        if expander.open:
+            with expander:
+                if metadata.get('duplicates'):
+                    st.caption('Also in: ' + ', '.join(
+                        f'{duplicate["source"]} '
+                        f'(Page {duplicate["page_number"]})'
+                        for duplicate in metadata['duplicates']
+                    ))
+                display_pdf_preview(
+                    pdf_path=metadata['path'],
+                    page_number=metadata['page_number'],
+                    cache=page_cache
+                )
+
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Returns the process-wide pool rendering previews into the page
+    cache for all sessions.
+
+    Returns:
+        ThreadPoolExecutor: The shared thread pool.
+    """
+    return ThreadPoolExecutor(
+        max_workers=PREVIEW_WORKERS, thread_name_prefix='preview'
+    )
+
+
+def prefetch_previews(
+    page_cache: 'PageImageCache',
+    pages: list[dict]
+) -> None:
+    """
+    Renders the previews of pages into the cache in the background.
+    Renders run in a copy of the context, so their spans belong to the
+    current query's trace.
+
+    Args:
+        page_cache (PageImageCache): Cache of rendered pages.
+        pages (list[dict]): Metadata of the pages.
+    """
+    executor = get_executor()
+    for metadata in pages:
+        executor.submit(
+            contextvars.copy_context().run,
+            page_cache.get,
+            metadata['path'],
+            metadata['page_number']
+        )
+
 
 def main():
     st.markdown(f"""
@@ -60,10 +434,11 @@ def main():
         '**Search Tonkin\'s legacy project data with AI-powered retrieval.**'
     )
 
-    project_folder = os.path.join(
-        os.path.dirname(__file__), '..', 'data', 'projects'
-    )
-    projects = os.listdir(project_folder)
+    service = ServiceClient(SERVICE_URL) if SERVICE_URL else None
+    if service is not None:
+        projects = service.projects()
+    else:
+        projects = list_projects()
 
     with st.expander('Advanced Options'):
         model = st.radio(
@@ -74,70 +449,217 @@ def main():
         )
 
         projects.insert(0, 'All Projects')
-        projects.remove('global')
         project_name = st.selectbox(
             'Select Project:',
             projects,
             index=0
         )
 
+        search_mode = st.radio(
+            'Search Mode:',
+            ('Hybrid', 'Vector', 'Lexical'),
+            horizontal=True,
+            index=0
+        )
+
+        stream = st.checkbox('Stream answers', value=True)
+
+        if st.checkbox('Show index and cache stats'):
+            st.json(
+                service.stats() if service is not None
+                else get_registry().stats()
+            )
+
     query = st.text_input(
         'Query', 
         placeholder='Ask anything about Tonkin projects',
         label_visibility='hidden'
     )
 
-    if project_name == 'All Projects':
-        project_name = 'global'
-        topk = GLOBAL_TOP_K
-    else:
-        topk = PROJECT_TOP_K
-    project_path = os.path.join(project_folder, project_name)
-    out_json = os.path.join(project_path, 'embedded_chunks.json')
-    faiss_index = os.path.join(project_path, 'faiss_index.index')
-    openai_key_path = os.path.join(
-        os.path.dirname(__file__), 'OPENAI_API_KEY.txt'
-    )
-
     if st.button('Search'):
         if not query.strip():
             st.warning('Please enter a query before searching.')
+        elif service is not None:
+            try:
+                response, pages = answer_from_service(
+                    service=service,
+                    query=query,
+                    options={
+                        'project': (
+                            None if project_name == 'All Projects'
+                            else project_name
+                        ),
+                        'mode': search_mode.lower(),
+                        'model': MODEL_ENUM[model]
+                    },
+                    stream=stream,
+                    prefetch=lambda pages: prefetch_previews(
+                        get_page_cache(), pages
+                    )
+                )
+            except ServiceError as e:
+                st.error(str(e))
+                return
+
+            search_id = st.session_state.get('search_id', 0) + 1
+            st.session_state['search_id'] = search_id
+            st.session_state['result'] = {
+                'search_id': search_id,
+                'response': response,
+                'pages': pages
+            }
+            show_related_pages(get_page_cache(), pages, search_id)
         else:
-            client = load_openai_api_key(openai_key_path)
-            index = load_index(faiss_index)
-
-            query_embedding = embed_query(client, query)
-            top_indices = search_faiss_index(
-                index=index,
-                query_embedding=query_embedding,
-                top_k=topk
-            )
-            chunks = json.load(open(out_json, 'r'))
-            prompt = format_prompt(
-                query=query,
-                chunks=chunks,
-                top_indices=top_indices
-            )
-            response = call_openai_model(
-                client=client,
-                prompt=prompt,
-                model_name=MODEL_ENUM[model]
-            )
-            st.success(response)
-
-            st.write('**Related Pages**:')
-            for idx in top_indices:
-                source = chunks[idx]['metadata']['source']
-                pdf_path = chunks[idx]['metadata']['path']
-                page_number = chunks[idx]['metadata']['page_number']
-
-                with st.expander(f'**Source**: {source} (Page {page_number})'):
-                    display_pdf_preview(
-                        pdf_path=pdf_path,
-                        page_number=page_number,
-                        width=600
+            from faiss_search import embed_query, search_faiss_index
+            from hybrid_search import hybrid_search
+            from query_cache import answer_key
+            from rag import format_prompt, context_budget, PROMPT_VERSION
+
+            with tracing.span(
+                'query',
+                project=project_name,
+                mode=search_mode.lower(),
+                model=MODEL_ENUM[model]
+            ) as span:
+                registry = get_registry()
+                client = registry.client()
+                resources = registry.index()
+
+                # Every project is searched in the shared indices; a
+                # single project is selected by filtering on its chunk
+                # IDs.
+                if project_name == 'All Projects':
+                    allowed_ids = None
+                    id_selector = None
+                    topk = GLOBAL_TOP_K
+                else:
+                    allowed_ids = registry.project_ids(
+                        resources, project_name
+                    )
+                    id_selector = registry.selector(
+                        resources, project_name
                     )
+                    topk = PROJECT_TOP_K
+
+                def vector_search(top_k: int) -> list[int]:
+                    query_embedding = embed_query(
+                        resources.embedder,
+                        query,
+                        cache=registry.query_cache
+                    )
+                    return search_faiss_index(
+                        index=resources.index,
+                        query_embedding=query_embedding,
+                        top_k=top_k,
+                        search_params=resources.info['params'],
+                        id_selector=id_selector,
+                        store=resources.store
+                    )
+
+                top_indices, route = hybrid_search(
+                    query=query,
+                    lexical_index=resources.lexical,
+                    vector_search=vector_search,
+                    top_k=topk,
+                    mode=search_mode.lower(),
+                    allowed_ids=allowed_ids
+                )
+                print(f'Retrieved {len(top_indices)} chunks ({route}).')
+                chunks = resources.store.get_many(top_indices)
+                # IDs missing from a store replaced since the search.
+                top_indices = [idx for idx in top_indices if idx in chunks]
+
+                key = answer_key(
+                    project_name=project_name,
+                    query=query,
+                    chunks=chunks,
+                    top_indices=top_indices,
+                    model_name=MODEL_ENUM[model],
+                    prompt_version=PROMPT_VERSION
+                )
+                # Previews are rendered into the cache while the answer
+                # is generated, so opening an expander is served from
+                # it.
+                pages = [chunks[idx]['metadata'] for idx in top_indices]
+                prefetch_previews(get_page_cache(), pages)
+
+                response = registry.lookup_answer(
+                    resources=resources,
+                    key=key,
+                    project_name=project_name,
+                    query=query,
+                    top_indices=top_indices,
+                    route=route,
+                    model_name=MODEL_ENUM[model]
+                )
+                span.set(
+                    route=route,
+                    chunks=len(top_indices),
+                    answer_cached=response is not None
+                )
+                if response is not None:
+                    st.success(response)
+                else:
+                    packing = {}
+                    prompt = format_prompt(
+                        query=query,
+                        chunks=chunks,
+                        top_indices=top_indices,
+                        max_context_tokens=context_budget(
+                            MODEL_ENUM[model]
+                        ),
+                        stats=packing
+                    )
+                    print(f'Context: ~{packing["tokens_after"]} tokens, '
+                          f'saved ~{packing["tokens_saved"]} of '
+                          f'{packing["tokens_before"]} '
+                          f'({packing["duplicates"]} duplicates, '
+                          f'{packing["merges"]} merges, '
+                          f'{packing["dropped"]} passages dropped).')
+                    response = generate_answer(
+                        client=client,
+                        prompt=prompt,
+                        model_name=MODEL_ENUM[model],
+                        stream=stream
+                    )
+                    if response is not None:
+                        registry.remember_answer(
+                            resources=resources,
+                            key=key,
+                            project_name=project_name,
+                            query=query,
+                            chunks=chunks,
+                            top_indices=top_indices,
+                            route=route,
+                            model_name=MODEL_ENUM[model],
+                            response=response
+                        )
+
+            tracing.write_metrics()
+
+            search_id = st.session_state.get('search_id', 0) + 1
+            st.session_state['search_id'] = search_id
+            st.session_state['result'] = {
+                'search_id': search_id,
+                'response': response,
+                'pages': pages
+            }
+            show_related_pages(get_page_cache(), pages, search_id)
+    elif 'result' in st.session_state:
+        # Reruns triggered by other widgets keep showing the last result.
+        result = st.session_state['result']
+        if result['response'] is not None:
+            st.success(result['response'])
+        show_related_pages(
+            get_page_cache(), result['pages'], result['search_id']
+        )
+
+    # After the rest of the page, so the preload never delays it.
+    if PRELOAD_INDEX and service is None:
+        start_preload()
 
 
 if __name__ == "__main__":
-    main()
+    configure_tracing()
+    with tracing.span('app_run'):
+        main()
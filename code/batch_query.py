@@ -0,0 +1,353 @@
+"""
+Answers a file of questions in bulk, e.g. for bid preparation or QA
+audits, without clicking through the app one query at a time.
+
+Queries are read from a text file (one per line) or a JSONL file of
+objects with a 'query' and an optional 'id'. They are embedded in
+batched API calls and searched with one multi-row FAISS search; the
+answers are then generated concurrently under a request rate limit,
+and each result is written to the output JSONL file, with its sources,
+as soon as it is ready:
+
+    python batch_query.py questions.txt --project P001 --output out.jsonl
+    python batch_query.py questions.jsonl --no-answer
+
+Answers are shared with the app's answer caches, so repeated and
+paraphrased questions cost no LLM call.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import tracing
+from rate_limit import RateLimiter
+from resources import ResourceRegistry
+from hybrid_search import SEARCH_MODES
+from retrieval import (
+    retrieve_batch,
+    MODEL_NAME,
+    PROJECT_TOP_K,
+    GLOBAL_TOP_K
+)
+from query_cache import answer_key
+from rag import (
+    format_prompt,
+    call_openai_model,
+    context_budget,
+    PROMPT_VERSION
+)
+
+
+# Concurrent LLM calls, and the request rate they are held to.
+LLM_WORKERS = 8
+LLM_REQUESTS_PER_MINUTE = 500
+
+PROJECT_FOLDER = os.path.join(
+    os.path.dirname(__file__), '..', 'data', 'projects'
+)
+OPENAI_KEY_PATH = os.path.join(
+    os.path.dirname(__file__), 'OPENAI_API_KEY.txt'
+)
+CACHE_FOLDER = os.path.join(
+    os.path.dirname(__file__), '..', 'data', 'cache'
+)
+
+
+def read_queries(
+    path: str
+) -> list[dict]:
+    """
+    Reads the queries of a batch.
+
+    Args:
+        path (str): A text file with one query per line, or a .jsonl
+            file of objects with a 'query' and an optional 'id'.
+
+    Returns:
+        list[dict]: Queries with 'id' (the line number if none is
+            given) and 'query' keys, in file order. Blank lines are
+            skipped.
+    """
+    queries = []
+    with open(path, 'r', encoding='utf-8') as fin:
+        for line_number, line in enumerate(fin, start=1):
+            line = line.strip()
+            if not line:
+                continue
+
+            if path.endswith('.jsonl'):
+                record = json.loads(line)
+                queries.append({
+                    'id': record.get('id', line_number),
+                    'query': record['query']
+                })
+            else:
+                queries.append({'id': line_number, 'query': line})
+
+    return queries
+
+
+def _sources(
+    chunks: dict[int, dict],
+    top_indices: list[int]
+) -> list[dict]:
+    """
+    Describes the retrieved chunks of a result.
+
+    Args:
+        chunks (dict[int, dict]): The retrieved chunks, keyed by ID.
+        top_indices (list[int]): The IDs of the top chunks, best first.
+
+    Returns:
+        list[dict]: Chunk ID, project, source file, page number and
+            path of each chunk, best first, and the source files and
+            page numbers of its near-duplicates.
+    """
+    return [
+        {
+            'chunk_id': idx,
+            'project': chunks[idx]['metadata'].get('project'),
+            'source': chunks[idx]['metadata']['source'],
+            'page_number': chunks[idx]['metadata']['page_number'],
+            'path': chunks[idx]['metadata']['path'],
+            'duplicates': [
+                {
+                    'source': duplicate['source'],
+                    'page_number': duplicate['page_number']
+                }
+                for duplicate in chunks[idx]['metadata'].get(
+                    'duplicates', []
+                )
+            ]
+        }
+        for idx in top_indices if idx in chunks
+    ]
+
+
+def answer_batch(
+    registry: ResourceRegistry,
+    queries: list[dict],
+    project_name: str = None,
+    model_name: str = MODEL_NAME,
+    top_k: int = None,
+    mode: str = 'hybrid',
+    answer: bool = True,
+    max_workers: int = LLM_WORKERS,
+    requests_per_minute: float = LLM_REQUESTS_PER_MINUTE
+):
+    """
+    Retrieves and answers a batch of queries.
+
+    Retrieval runs for the whole batch at once. Answers are looked up
+    in the answer cache or generated by up to max_workers concurrent
+    LLM calls, started no faster than requests_per_minute. A failed
+    call fails only its own query.
+
+    Args:
+        registry (ResourceRegistry): The resource registry.
+        queries (list[dict]): Queries returned by read_queries.
+        project_name (str): Restricts the search to one project.
+            Default is None (all projects).
+        model_name (str): The name of the OpenAI model to use. Default
+            is MODEL_NAME.
+        top_k (int): Number of chunks retrieved per query. Default is
+            None (PROJECT_TOP_K for one project, GLOBAL_TOP_K
+            otherwise).
+        mode (str): One of SEARCH_MODES. Default is 'hybrid'.
+        answer (bool): Whether to generate answers, or only retrieve
+            sources. Default is True.
+        max_workers (int): Maximum number of concurrent LLM calls.
+            Default is LLM_WORKERS.
+        requests_per_minute (float): Maximum rate of LLM calls. Default
+            is LLM_REQUESTS_PER_MINUTE.
+
+    Yields:
+        dict: The result of each query as soon as it is ready (not in
+            input order): 'id', 'query', 'route', 'sources' and, when
+            answering, 'answer' and 'cached', or 'error' if the call
+            failed.
+    """
+    if top_k is None:
+        top_k = PROJECT_TOP_K if project_name is not None else GLOBAL_TOP_K
+
+    resources = registry.index()
+    texts = [query['query'] for query in queries]
+
+    start = time.perf_counter()
+    with tracing.span('retrieve_batch', queries=len(texts)):
+        retrieved = retrieve_batch(
+            registry, resources, texts, project_name, top_k, mode
+        )
+        chunks = resources.store.get_many(
+            {idx for top_indices, _ in retrieved for idx in top_indices}
+        )
+        # IDs missing from a store replaced since the search.
+        retrieved = [
+            ([idx for idx in top_indices if idx in chunks], route)
+            for top_indices, route in retrieved
+        ]
+    print(f'Retrieved chunks for {len(texts)} queries in '
+          f'{time.perf_counter() - start:.2f}s.')
+
+    results = []
+    for query, (top_indices, route) in zip(queries, retrieved):
+        results.append({
+            'id': query['id'],
+            'query': query['query'],
+            'route': route,
+            'sources': _sources(chunks, top_indices)
+        })
+
+    if not answer:
+        yield from results
+        return
+
+    client = registry.client()
+    limiter = RateLimiter(requests_per_minute / 60.0, name='chat')
+    budget = context_budget(model_name)
+
+    # Queries with the same answer key (repeated questions retrieving
+    # the same chunks) share one LLM call.
+    groups = {}
+    for result, (top_indices, route) in zip(results, retrieved):
+        query_chunks = {idx: chunks[idx] for idx in top_indices}
+        key = answer_key(
+            project_name=project_name or 'All Projects',
+            query=result['query'],
+            chunks=query_chunks,
+            top_indices=top_indices,
+            model_name=model_name,
+            prompt_version=PROMPT_VERSION
+        )
+        if key not in groups:
+            groups[key] = (query_chunks, top_indices, route, [])
+        groups[key][3].append(result)
+
+    def run(key, query_chunks, top_indices, route, query):
+        with tracing.span('answer', queries=len(groups[key][3])) as span:
+            response = registry.lookup_answer(
+                resources=resources,
+                key=key,
+                project_name=project_name or 'All Projects',
+                query=query,
+                top_indices=top_indices,
+                route=route,
+                model_name=model_name
+            )
+            span.set(cached=response is not None)
+            if response is not None:
+                return response, True
+
+            prompt = format_prompt(
+                query=query,
+                chunks=query_chunks,
+                top_indices=top_indices,
+                max_context_tokens=budget
+            )
+            limiter.acquire()
+            response = call_openai_model(
+                client=client,
+                prompt=prompt,
+                model_name=model_name
+            )
+            registry.remember_answer(
+                resources=resources,
+                key=key,
+                project_name=project_name or 'All Projects',
+                query=query,
+                chunks=query_chunks,
+                top_indices=top_indices,
+                route=route,
+                model_name=model_name,
+                response=response
+            )
+
+        return response, False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                run, key, query_chunks, top_indices, route, group[0]['query']
+            ): group
+            for key, (query_chunks, top_indices, route, group)
+            in groups.items()
+        }
+        for future in as_completed(futures):
+            try:
+                response, cached = future.result()
+            except Exception as e:
+                response, cached = None, None
+                error = f'{type(e).__name__}: {e}'
+            for i, result in enumerate(futures[future]):
+                if response is None:
+                    result['error'] = error
+                else:
+                    result['answer'] = response
+                    result['cached'] = cached or i > 0
+                yield result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('queries', help='text or .jsonl file of queries')
+    parser.add_argument('--output', default='answers.jsonl')
+    parser.add_argument('--project', help='default: all projects')
+    parser.add_argument('--model', default=MODEL_NAME)
+    parser.add_argument('--top-k', type=int)
+    parser.add_argument('--mode', choices=SEARCH_MODES, default='hybrid')
+    parser.add_argument('--no-answer', action='store_true',
+                        help='only retrieve sources')
+    parser.add_argument('--workers', type=int, default=LLM_WORKERS)
+    parser.add_argument('--requests-per-minute', type=float,
+                        default=LLM_REQUESTS_PER_MINUTE)
+    args = parser.parse_args()
+
+    queries = read_queries(args.queries)
+    registry = ResourceRegistry(
+        os.path.join(PROJECT_FOLDER, 'global'), OPENAI_KEY_PATH, CACHE_FOLDER
+    )
+
+    print(f'Running {len(queries)} queries...')
+    start = time.perf_counter()
+    counts = {'answered': 0, 'cached': 0, 'failed': 0}
+    # Written as results arrive, so the file can be followed while the
+    # batch runs.
+    with open(args.output, 'w', encoding='utf-8') as fout:
+        for result in answer_batch(
+            registry,
+            queries,
+            project_name=args.project,
+            model_name=args.model,
+            top_k=args.top_k,
+            mode=args.mode,
+            answer=not args.no_answer,
+            max_workers=args.workers,
+            requests_per_minute=args.requests_per_minute
+        ):
+            fout.write(json.dumps(result, ensure_ascii=False) + '\n')
+            fout.flush()
+            if 'error' in result:
+                counts['failed'] += 1
+            elif result.get('cached'):
+                counts['cached'] += 1
+            else:
+                counts['answered'] += 1
+    elapsed = time.perf_counter() - start
+
+    print('=' * 72)
+    print(f'Completed {len(queries)} queries in {elapsed:.2f}s '
+          f'({len(queries) / max(elapsed, 1e-9):.1f} queries/s).')
+    if not args.no_answer:
+        print(f'{counts["answered"]} answered, {counts["cached"]} from '
+              f'cache, {counts["failed"]} failed.')
+    print(f'Results saved to {args.output}.')
+
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
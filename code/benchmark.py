@@ -0,0 +1,822 @@
+"""
+Offline benchmark of the build and query paths.
+
+Generates a synthetic PDF corpus, builds it with the real pipeline
+(extraction, embedding, chunk store, FAISS and BM25 indices) against a
+deterministic fake OpenAI client with configurable latency, then
+replays queries through the query path (embedding, hybrid search and
+prompt packing). Reports build throughput, query latency percentiles,
+recall@k and peak memory, and saves everything to a JSON file that
+later runs can be compared against to catch regressions:
+
+    python benchmark.py --pdfs 100 --output baseline.json
+    python benchmark.py --pdfs 100 --output new.json --compare baseline.json
+
+With --quantization-sweep, the index is also rebuilt with each vector
+quantization to report its memory against its recall, with and without
+rescoring:
+
+    python benchmark.py --pdfs 100 --quantization-sweep
+
+No network access or API key is needed.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import fitz # PyMuPDF
+import faiss
+import numpy as np
+
+import build
+from fake_client import FakeOpenAI
+from embedders import make_embedder
+from embedding_cache import EmbeddingCache
+from faiss_index import build_faiss_index, load_index_info, RESCORE_FACTOR
+from faiss_search import (
+    embed_query,
+    embed_queries,
+    search_faiss_index,
+    search_faiss_index_batch
+)
+from hybrid_search import hybrid_search, SEARCH_MODES
+from profiling import peak_rss_bytes
+from chunk_store import ChunkStore
+from rag import format_prompt, context_budget
+from resources import ResourceRegistry
+
+
+PROJECTS = 2
+PDFS = 20
+PAGES_PER_PDF = 10
+WORDS_PER_PAGE = 600
+QUERIES = 200
+QUERY_WORDS = 12
+TOP_K = 5
+EMBEDDING_LATENCY = 0.02
+MODEL_NAME = 'gpt-4o-mini'
+
+# Quantizations compared by --quantization-sweep (None is full
+# precision).
+QUANTIZATION_SWEEP = (None, 'fp16', 'int8', 'pq')
+
+# Relative change beyond which a metric counts as a regression.
+TOLERANCE = 0.10
+
+# Metrics checked by --compare, and whether higher or lower is better.
+REGRESSION_METRICS = {
+    'build.pages_per_second': 'higher',
+    'build.chunks_per_second': 'higher',
+    'query.latency_ms.p50': 'lower',
+    'query.latency_ms.p95': 'lower',
+    'query.latency_ms.p99': 'lower',
+    'query.search_ms.p50': 'lower',
+    'query.search_ms.p95': 'lower',
+    'query.recall_at_k': 'higher',
+    'query.ann_recall_at_k': 'higher',
+    'memory.build_peak_rss_bytes': 'lower'
+}
+
+RESULTS_VERSION = 1
+
+
+def _vocabulary(
+    rnd: random.Random,
+    size: int = 5000
+) -> list[str]:
+    """
+    Generates pseudo-words from syllables.
+
+    Args:
+        rnd (random.Random): Random number generator.
+        size (int): Number of words. Default is 5000.
+
+    Returns:
+        list[str]: Distinct words.
+    """
+    syllables = [c + v for c in 'bcdfghklmnprstvw' for v in 'aeiou']
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rnd.choices(syllables, k=rnd.randint(1, 4))))
+
+    return sorted(words)
+
+
+def make_corpus(
+    folder: str,
+    projects: int = PROJECTS,
+    pdfs: int = PDFS,
+    pages_per_pdf: int = PAGES_PER_PDF,
+    words_per_page: int = WORDS_PER_PAGE,
+    seed: int = 0
+) -> int:
+    """
+    Writes a deterministic synthetic corpus laid out like the projects
+    folder: folder/<project>/6_Issued/<pdf>.
+
+    Word frequencies follow a Zipf-like distribution, and pages contain
+    drawing-number identifiers, so both vector and lexical search have
+    realistic work to do.
+
+    Args:
+        folder (str): Folder to write the projects to.
+        projects (int): Number of projects. Default is PROJECTS.
+        pdfs (int): Total number of PDFs, spread over the projects.
+            Default is PDFS.
+        pages_per_pdf (int): Pages per PDF. Default is PAGES_PER_PDF.
+        words_per_page (int): Words per page. Default is
+            WORDS_PER_PAGE.
+        seed (int): Random seed. Default is 0.
+
+    Returns:
+        int: Total number of pages.
+    """
+    rnd = random.Random(seed)
+    vocabulary = _vocabulary(rnd)
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+
+    for i in range(pdfs):
+        project = f'P{i % projects:03d}'
+        pdf_folder = os.path.join(folder, project, '6_Issued')
+        os.makedirs(pdf_folder, exist_ok=True)
+
+        doc = fitz.open()
+        for _ in range(pages_per_pdf):
+            words = rnd.choices(vocabulary, weights, k=words_per_page)
+            words[rnd.randrange(words_per_page)] = (
+                f'DWG-{rnd.choice("CSEM")}-{rnd.randint(1000, 9999)}'
+            )
+            page = doc.new_page()
+            page.insert_textbox(
+                fitz.Rect(20, 20, 580, 820), ' '.join(words), fontsize=5
+            )
+        doc.save(os.path.join(pdf_folder, f'{project}-{i:05d}.pdf'))
+        doc.close()
+
+    return pdfs * pages_per_pdf
+
+
+def percentiles(
+    values: list[float]
+) -> dict:
+    """
+    Summarizes a latency distribution.
+
+    Args:
+        values (list[float]): Measured values.
+
+    Returns:
+        dict: Mean, p50, p95, p99 and max.
+    """
+    if not values:
+        return {'mean': None, 'p50': None, 'p95': None, 'p99': None,
+                'max': None}
+
+    values = np.asarray(values, dtype=np.float64)
+
+    return {
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max())
+    }
+
+
+def run_build(
+    project_folder: str,
+    embedder_backend: str,
+    client: FakeOpenAI,
+    cache_path: str,
+    project_workers: int = None
+) -> dict:
+    """
+    Builds the shared index of a corpus from scratch with the build
+    pipeline.
+
+    Args:
+        project_folder (str): Folder holding the projects.
+        embedder_backend (str): 'openai' (served by the fake client) or
+            'hashing'.
+        client (FakeOpenAI): The fake OpenAI client.
+        cache_path (str): Path to a fresh embedding cache.
+        project_workers (int): Maximum number of projects built at
+            once. Default is None (build.PROJECT_WORKERS).
+
+    Returns:
+        dict: Build metrics.
+    """
+    global_path = os.path.join(project_folder, 'global')
+    os.makedirs(global_path, exist_ok=True)
+    options = (
+        {'model_name': 'text-embedding-3-small'}
+        if embedder_backend == 'openai' else {}
+    )
+    embedder = make_embedder(embedder_backend, options, client)
+    cache = EmbeddingCache(cache_path)
+
+    projects = sorted(
+        project for project in os.listdir(project_folder)
+        if project != 'global'
+    )
+    start = time.perf_counter()
+    plans = [
+        build.plan_project(
+            os.path.join(project_folder, project), None, full=True
+        )
+        for project in projects
+    ]
+    stages = build.build_global(
+        global_path, plans, [], embedder, cache, max_workers=project_workers
+    )
+    seconds = time.perf_counter() - start
+    cache.close()
+
+    pages = 0
+    extract_seconds = 0.0
+    for project in projects:
+        with open(os.path.join(
+            project_folder, project, 'extract_report.json'
+        ), 'r') as fin:
+            report = json.load(fin)
+        pages += report['pages']
+        extract_seconds += report['seconds']
+
+    info = load_index_info(os.path.join(global_path, 'faiss_index.index'))
+
+    return {
+        'pdfs': sum(len(plan['pdf_files']) for plan in plans),
+        'pages': pages,
+        'chunks': info['ntotal'],
+        'duplicates': sum(
+            plan.get('dedup', {}).get('duplicates', 0) for plan in plans
+        ),
+        'seconds': seconds,
+        'pages_per_second': pages / max(seconds, 1e-9),
+        'chunks_per_second': info['ntotal'] / max(seconds, 1e-9),
+        'extract_seconds': extract_seconds,
+        'embedding_calls': client.embeddings.calls,
+        'index_type': info['index_type'],
+        'index_params': info['params'],
+        'index_build_seconds': info['build_seconds'],
+        'stages': [
+            {
+                'name': stage.name,
+                'items': stage.items,
+                'wall_seconds': stage.wall_seconds,
+                'busy_seconds': stage.busy_seconds,
+                'wait_seconds': stage.wait_seconds,
+                'peak_rss_bytes': stage.peak_rss_bytes
+            }
+            for stage in stages
+        ]
+    }
+
+
+def _excerpt_queries(
+    store: ChunkStore,
+    queries: int,
+    seed: int = 0
+) -> tuple[list[str], list[int]]:
+    """
+    Makes queries from excerpts of the middle of random chunks.
+
+    Args:
+        store (ChunkStore): The chunk store.
+        queries (int): Number of queries.
+        seed (int): Random seed. Default is 0.
+
+    Returns:
+        tuple[list[str], list[int]]: The queries, and the ID of the
+            chunk each was taken from.
+    """
+    rnd = random.Random(seed)
+    ids = [int(i) for i in store.ids]
+    targets = [rnd.choice(ids) for _ in range(queries)]
+    chunks = store.get_many(targets)
+    texts = []
+    for chunk_id in targets:
+        words = chunks[chunk_id]['content'].split()
+        start = max(len(words) // 2 - QUERY_WORDS // 2, 0)
+        texts.append(' '.join(words[start:start + QUERY_WORDS]))
+
+    return texts, targets
+
+
+def _exact_index(
+    store: ChunkStore
+) -> tuple[faiss.Index, np.ndarray]:
+    """
+    Builds an exact index of the stored embeddings, as ground truth.
+
+    Args:
+        store (ChunkStore): The chunk store.
+
+    Returns:
+        tuple[faiss.Index, np.ndarray]: The exact index, and the chunk
+            ID of each of its rows.
+    """
+    exact = faiss.IndexFlatIP(store.embeddings.shape[1])
+    embeddings = np.array(store.embeddings, dtype=np.float32)
+    faiss.normalize_L2(embeddings)
+    exact.add(embeddings)
+
+    return exact, np.asarray(store.ids, dtype=np.int64)
+
+
+def run_queries(
+    global_path: str,
+    client: FakeOpenAI,
+    cache_folder: str,
+    queries: int = QUERIES,
+    top_k: int = TOP_K,
+    mode: str = 'hybrid',
+    seed: int = 0
+) -> dict:
+    """
+    Replays queries through the query path and measures latency and
+    recall.
+
+    Each query is an excerpt from the middle of a random chunk, which
+    is the one it should retrieve. Recall@k is the share of queries
+    whose chunk is among the top k; ANN recall@k compares the FAISS
+    results with exact search over the same vectors.
+
+    Args:
+        global_path (str): Folder of the shared index.
+        client (FakeOpenAI): The fake OpenAI client.
+        cache_folder (str): Folder for the registry's caches.
+        queries (int): Number of queries. Default is QUERIES.
+        top_k (int): Number of chunks retrieved. Default is TOP_K.
+        mode (str): One of SEARCH_MODES. Default is 'hybrid'.
+        seed (int): Random seed. Default is 0.
+
+    Returns:
+        dict: Query metrics.
+    """
+    registry = ResourceRegistry(
+        global_path, key_path=None, cache_folder=cache_folder, client=client
+    )
+    resources = registry.index()
+    store = resources.store
+    index_stats = registry.stats()
+
+    texts, targets = _excerpt_queries(store, queries, seed)
+    exact, row_ids = _exact_index(store)
+
+    latencies = []
+    embed_ms = []
+    search_ms = []
+    prompt_ms = []
+    hits = 0
+    ann_recall = []
+    context_tokens = []
+    tokens_saved = []
+    budget = context_budget(MODEL_NAME)
+    for query, target in zip(texts, targets):
+        timings = {'embed': 0.0, 'search': 0.0}
+
+        def vector_search(k):
+            start = time.perf_counter()
+            query_embedding = embed_query(resources.embedder, query)
+            timings['embed'] += time.perf_counter() - start
+            start = time.perf_counter()
+            results = search_faiss_index(
+                index=resources.index,
+                query_embedding=query_embedding,
+                top_k=k,
+                search_params=resources.info['params'],
+                store=store
+            )
+            timings['search'] += time.perf_counter() - start
+            timings['vector'] = (query_embedding, results)
+            return results
+
+        start = time.perf_counter()
+        top_indices, _ = hybrid_search(
+            query=query,
+            lexical_index=resources.lexical,
+            vector_search=vector_search,
+            top_k=top_k,
+            mode=mode
+        )
+        retrieved = time.perf_counter()
+        packing = {}
+        format_prompt(
+            query, store.get_many(top_indices), top_indices, budget, packing
+        )
+        end = time.perf_counter()
+
+        latencies.append((end - start) * 1000)
+        embed_ms.append(timings['embed'] * 1000)
+        search_ms.append(
+            (retrieved - start - timings['embed']) * 1000
+        )
+        prompt_ms.append((end - retrieved) * 1000)
+        hits += target in top_indices
+        context_tokens.append(packing['tokens_after'])
+        tokens_saved.append(packing['tokens_saved'])
+
+        if 'vector' in timings:
+            query_embedding, results = timings['vector']
+            query_embedding = np.array(query_embedding, dtype=np.float32)
+            faiss.normalize_L2(query_embedding)
+            _, rows = exact.search(query_embedding, top_k)
+            truth = set(row_ids[rows[0][rows[0] >= 0]].tolist())
+            ann_recall.append(
+                len(truth & set(results[:top_k])) / max(len(truth), 1)
+            )
+
+    return {
+        'queries': queries,
+        'top_k': top_k,
+        'mode': mode,
+        'latency_ms': percentiles(latencies),
+        'embed_ms': percentiles(embed_ms),
+        'search_ms': percentiles(search_ms),
+        'prompt_ms': percentiles(prompt_ms),
+        'recall_at_k': hits / max(queries, 1),
+        'ann_recall_at_k': (
+            float(np.mean(ann_recall)) if ann_recall else None
+        ),
+        'context_tokens_mean': float(np.mean(context_tokens)),
+        'tokens_saved_mean': float(np.mean(tokens_saved)),
+        'index_load_seconds': index_stats['load_seconds'],
+        'index_rss_delta_bytes': index_stats['rss_delta_bytes']
+    }
+
+
+def run_quantization_sweep(
+    global_path: str,
+    client: FakeOpenAI,
+    cache_folder: str,
+    queries: int = QUERIES,
+    top_k: int = TOP_K,
+    seed: int = 0
+) -> list[dict]:
+    """
+    Rebuilds the shared FAISS index from the stored embeddings with
+    each quantization in QUANTIZATION_SWEEP, and measures its size
+    against its recall@k vs. exact search, with and without rescoring
+    RESCORE_FACTOR times as many candidates.
+
+    Args:
+        global_path (str): Folder of the shared index.
+        client (FakeOpenAI): The fake OpenAI client.
+        cache_folder (str): Folder for the registry's caches.
+        queries (int): Number of queries. Default is QUERIES.
+        top_k (int): Number of chunks retrieved. Default is TOP_K.
+        seed (int): Random seed. Default is 0.
+
+    Returns:
+        list[dict]: One row per quantization with 'quantization',
+            'index_bytes', 'bytes_per_vector', 'recall_at_k' and
+            'ms_per_query', and for quantized indices
+            'rescored_recall_at_k' and 'rescored_ms_per_query'.
+    """
+    registry = ResourceRegistry(
+        global_path, key_path=None, cache_folder=cache_folder, client=client
+    )
+    resources = registry.index()
+    store = resources.store
+    # IVF-PQ is IVF with product quantization; the sweep varies the
+    # quantization of the underlying index type.
+    index_type = resources.info['index_type']
+    if index_type == 'ivfpq':
+        index_type = 'ivf'
+
+    texts, _ = _excerpt_queries(store, queries, seed)
+    query_embeddings = embed_queries(resources.embedder, texts)
+    normalized = query_embeddings.copy()
+    faiss.normalize_L2(normalized)
+    exact, row_ids = _exact_index(store)
+    _, rows = exact.search(normalized, top_k)
+    truth = [set(row_ids[row[row >= 0]].tolist()) for row in rows]
+    del exact
+
+    def measure(index, search_params):
+        start = time.perf_counter()
+        results = search_faiss_index_batch(
+            index, query_embeddings, top_k, search_params, store=store
+        )
+        ms_per_query = (time.perf_counter() - start) * 1000 / len(texts)
+        recall = np.mean([
+            len(expected & set(found)) / max(len(expected), 1)
+            for expected, found in zip(truth, results)
+        ])
+        return float(recall), ms_per_query
+
+    sweep_folder = tempfile.mkdtemp(prefix='quantization-')
+    index_path = os.path.join(sweep_folder, 'faiss_index.index')
+    report = []
+    try:
+        for quantization in QUANTIZATION_SWEEP:
+            print('=' * 72)
+            print(f'Quantization: {quantization or "none"}')
+            build_faiss_index(
+                embeddings_path=os.path.join(global_path, 'embeddings.npy'),
+                output_path=index_path,
+                ids_path=os.path.join(global_path, 'ids.npy'),
+                index_type=index_type,
+                params={'quantization': quantization} if quantization else {}
+            )
+            index = faiss.read_index(index_path)
+            params = load_index_info(index_path)['params']
+            index_bytes = os.path.getsize(index_path)
+
+            recall, ms_per_query = measure(index, {**params, 'rescore': 1})
+            row = {
+                'quantization': quantization or 'none',
+                'index_type': index_type,
+                'index_bytes': index_bytes,
+                'bytes_per_vector': index_bytes / max(index.ntotal, 1),
+                'recall_at_k': recall,
+                'ms_per_query': ms_per_query
+            }
+            if quantization is not None:
+                recall, ms_per_query = measure(
+                    index, {**params, 'rescore': RESCORE_FACTOR}
+                )
+                row['rescored_recall_at_k'] = recall
+                row['rescored_ms_per_query'] = ms_per_query
+            report.append(row)
+            del index
+    finally:
+        shutil.rmtree(sweep_folder, ignore_errors=True)
+
+    return report
+
+
+def _environment() -> dict:
+    """
+    Describes the machine and code a benchmark ran on.
+
+    Returns:
+        dict: Python, platform, CPU count, library versions and git
+            commit (None outside a git checkout).
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'faiss': faiss.__version__,
+        'pymupdf': fitz.VersionBind,
+        'git_commit': commit
+    }
+
+
+def _metric(
+    results: dict,
+    name: str
+) -> float | None:
+    """
+    Looks up a dotted metric name, e.g. 'query.latency_ms.p95'.
+
+    Args:
+        results (dict): Benchmark results.
+        name (str): Dotted path of the metric.
+
+    Returns:
+        float | None: The value, or None if it is missing.
+    """
+    value = results
+    for key in name.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+
+    return value
+
+
+def compare_results(
+    baseline: dict,
+    current: dict,
+    tolerance: float = TOLERANCE
+) -> list[str]:
+    """
+    Compares two benchmark results and prints the change of each
+    metric in REGRESSION_METRICS.
+
+    Args:
+        baseline (dict): Results of the reference run.
+        current (dict): Results of the new run.
+        tolerance (float): Relative change beyond which a metric counts
+            as a regression. Default is TOLERANCE.
+
+    Returns:
+        list[str]: Names of the metrics that regressed.
+    """
+    if baseline.get('config') != current.get('config'):
+        print('Warning: the runs used different configurations.')
+
+    regressions = []
+    print(f'{"Metric":<28} {"Baseline":>14} {"Current":>14} {"Change":>9}')
+    for name, better in REGRESSION_METRICS.items():
+        old, new = _metric(baseline, name), _metric(current, name)
+        if old is None or new is None:
+            continue
+
+        change = (new - old) / abs(old) if old else 0.0
+        regressed = (
+            change < -tolerance if better == 'higher' else change > tolerance
+        )
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<28} {old:>14.4g} {new:>14.4g} {change:>+8.1%}'
+              f'{"  REGRESSION" if regressed else ""}')
+
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--projects', type=int, default=PROJECTS)
+    parser.add_argument('--pdfs', type=int, default=PDFS)
+    parser.add_argument('--pages', type=int, default=PAGES_PER_PDF)
+    parser.add_argument('--words', type=int, default=WORDS_PER_PAGE)
+    parser.add_argument('--queries', type=int, default=QUERIES)
+    parser.add_argument('--top-k', type=int, default=TOP_K)
+    parser.add_argument('--mode', choices=SEARCH_MODES, default='hybrid')
+    parser.add_argument(
+        '--embedder', choices=('openai', 'hashing'), default='openai',
+        help='openai is served by the fake client'
+    )
+    parser.add_argument(
+        '--embedding-latency', type=float, default=EMBEDDING_LATENCY,
+        help='seconds per fake embeddings request'
+    )
+    parser.add_argument(
+        '--project-workers', type=int, default=build.PROJECT_WORKERS,
+        help='projects built concurrently'
+    )
+    parser.add_argument('--index-type', default=build.INDEX_TYPE)
+    parser.add_argument(
+        '--quantization', choices=QUANTIZATION_SWEEP[1:],
+        help='quantize the index vectors (default: full precision)'
+    )
+    parser.add_argument(
+        '--quantization-sweep', action='store_true',
+        help='compare the memory and recall of each quantization'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='default: a temporary folder')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the corpus and index')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='baseline results to compare to')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    project_folder = os.path.join(workdir, 'projects')
+    cache_folder = os.path.join(workdir, 'cache')
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(project_folder)
+
+    config = {
+        key: getattr(args, key)
+        for key in ('projects', 'pdfs', 'pages', 'words', 'queries',
+                    'top_k', 'mode', 'embedder', 'embedding_latency',
+                    'project_workers', 'index_type', 'quantization',
+                    'seed')
+    }
+    print(f'Benchmark configuration: {config}')
+    build.INDEX_TYPE = args.index_type
+    if args.quantization:
+        build.INDEX_PARAMS = {
+            **build.INDEX_PARAMS, 'quantization': args.quantization
+        }
+    client = FakeOpenAI(embedding_latency=args.embedding_latency)
+
+    try:
+        print('=' * 72)
+        start = time.perf_counter()
+        pages = make_corpus(
+            project_folder, args.projects, args.pdfs, args.pages,
+            args.words, args.seed
+        )
+        print(f'Generated {args.pdfs} PDFs with {pages} pages in '
+              f'{time.perf_counter() - start:.2f}s.')
+
+        build_results = run_build(
+            project_folder,
+            args.embedder,
+            client,
+            os.path.join(cache_folder, 'embeddings.sqlite'),
+            args.project_workers
+        )
+        build_peak = peak_rss_bytes()
+
+        print('=' * 72)
+        print(f'Running {args.queries} queries...')
+        query_results = run_queries(
+            os.path.join(project_folder, 'global'),
+            client,
+            cache_folder,
+            args.queries,
+            args.top_k,
+            args.mode,
+            args.seed
+        )
+
+        quantization_results = None
+        if args.quantization_sweep:
+            quantization_results = run_quantization_sweep(
+                os.path.join(project_folder, 'global'),
+                client,
+                cache_folder,
+                args.queries,
+                args.top_k,
+                args.seed
+            )
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'version': RESULTS_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': _environment(),
+        'config': config,
+        'build': build_results,
+        'query': query_results,
+        'memory': {
+            'build_peak_rss_bytes': build_peak,
+            'peak_rss_bytes': peak_rss_bytes()
+        }
+    }
+    if quantization_results is not None:
+        results['quantization'] = quantization_results
+    tmp_path = args.output + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fout:
+        json.dump(results, fout, indent=4)
+    os.replace(tmp_path, args.output)
+
+    print('=' * 72)
+    print(f'Build: {build_results["pages"]} pages, '
+          f'{build_results["chunks"]} chunks in '
+          f'{build_results["seconds"]:.2f}s '
+          f'({build_results["pages_per_second"]:.1f} pages/s, '
+          f'{build_results["chunks_per_second"]:.1f} chunks/s).')
+    latency = query_results['latency_ms']
+    print(f'Query latency: p50 {latency["p50"]:.2f} ms, '
+          f'p95 {latency["p95"]:.2f} ms, p99 {latency["p99"]:.2f} ms.')
+    ann_recall = query_results['ann_recall_at_k']
+    print(f'Recall@{args.top_k}: {query_results["recall_at_k"]:.3f}, '
+          'ANN recall@{}: {}.'.format(
+              args.top_k,
+              f'{ann_recall:.3f}' if ann_recall is not None else '-'
+          ))
+    if quantization_results is not None:
+        print(f'{"Quantization":<13} {"Index MiB":>10} {"B/vector":>9} '
+              f'{"Recall":>8} {"Rescored":>9} {"ms/query":>9}')
+        for row in quantization_results:
+            rescored = row.get('rescored_recall_at_k')
+            ms_per_query = row.get(
+                'rescored_ms_per_query', row['ms_per_query']
+            )
+            print(f'{row["quantization"]:<13} '
+                  f'{row["index_bytes"] / 1024 ** 2:>10.2f} '
+                  f'{row["bytes_per_vector"]:>9.0f} '
+                  f'{row["recall_at_k"]:>8.3f} '
+                  f'{"-" if rescored is None else f"{rescored:.3f}":>9} '
+                  f'{ms_per_query:>9.3f}')
+    if results['memory']['peak_rss_bytes'] is not None:
+        print(f'Peak RSS: '
+              f'{results["memory"]["peak_rss_bytes"] / 1024 ** 2:.1f} MiB.')
+    print(f'Results saved to {args.output}.')
+
+    if args.compare:
+        print('=' * 72)
+        with open(args.compare, 'r', encoding='utf-8') as fin:
+            baseline = json.load(fin)
+        regressions = compare_results(baseline, results, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} metrics regressed beyond '
+                  f'{args.tolerance:.0%}.')
+            return 1
+        print('No regressions.')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
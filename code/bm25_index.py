@@ -0,0 +1,389 @@
+"""
+Builds and searches an inverted BM25 index over the chunk store.
+
+The index is a folder of .npy arrays that are memory-mapped on load, so
+opening it costs no parsing and the OS page cache is shared between
+processes:
+
+    terms.npy     Sorted vocabulary as fixed-width UTF-8 byte strings,
+                  searched with a binary search.
+    offsets.npy   Start of each term's postings (one extra end entry).
+    postings.npy  Document numbers, grouped by term.
+    tfs.npy       Term frequency of each posting.
+    doc_lens.npy  Number of tokens of each document.
+    ids.npy       Chunk ID of each document.
+    meta.json     Document count, average length and BM25 parameters.
+"""
+
+import os
+import re
+import json
+import time
+from collections import Counter
+
+import numpy as np
+
+import tracing
+from chunk_store import ChunkStore
+
+
+BM25_FOLDER = 'bm25'
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Terms are stored as fixed-width byte strings; longer tokens are cut.
+MAX_TERM_BYTES = 32
+
+# Query terms found in more than this share of chunks barely affect the
+# ranking but have the longest postings, so they are skipped when the
+# query has rarer terms.
+MAX_DF_RATIO = 0.5
+
+# Words joined by '-', '.', '/' or '_' (drawing numbers, clause numbers,
+# project codes) are kept whole as well as split into their parts.
+_TOKEN_RE = re.compile(r'\w+(?:[-./]\w+)*')
+
+
+def _truncate(
+    term: str
+) -> str:
+    """
+    Cuts a term to MAX_TERM_BYTES bytes of UTF-8.
+
+    Args:
+        term (str): The term.
+
+    Returns:
+        str: The truncated term.
+    """
+    return term.encode('utf-8')[:MAX_TERM_BYTES].decode('utf-8', 'ignore')
+
+
+def _split_compound(
+    token: str
+) -> list[str]:
+    """
+    Splits a compound identifier into its parts.
+
+    Args:
+        token (str): A lower-case token.
+
+    Returns:
+        list[str]: The parts, empty if the token is a single word.
+    """
+    if token.isalnum():
+        return []
+
+    return [part for part in re.split(r'[-./_]', token) if part]
+
+
+def tokenize(
+    text: str
+) -> list[str]:
+    """
+    Splits a text into lower-case terms.
+
+    Compound identifiers such as 'DWG-C-1203' or '4.2.1' yield the
+    whole identifier followed by its parts, so both exact and partial
+    matches score.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list[str]: The terms, truncated to MAX_TERM_BYTES bytes.
+    """
+    terms = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        terms.append(_truncate(token))
+        terms.extend(_truncate(part) for part in _split_compound(token))
+
+    return terms
+
+
+def _save_npy(
+    path: str,
+    array: np.ndarray
+) -> None:
+    """
+    Atomically saves an array.
+
+    Args:
+        path (str): Destination .npy path.
+        array (np.ndarray): Array to save.
+    """
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def build_bm25_index(
+    store_folder: str,
+    k1: float = BM25_K1,
+    b: float = BM25_B
+) -> None:
+    """
+    Builds the BM25 index of every chunk in a chunk store and saves it
+    in the store's bm25 subfolder, replacing any previous index.
+
+    Args:
+        store_folder (str): Path to the chunk store folder.
+        k1 (float): BM25 term frequency saturation. Default is BM25_K1.
+        b (float): BM25 length normalization. Default is BM25_B.
+    """
+    start = time.perf_counter()
+    folder = os.path.join(store_folder, BM25_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+
+    vocabulary = {}
+    term_numbers = []
+    doc_numbers = []
+    tfs = []
+    doc_lens = []
+    ids = []
+
+    store = ChunkStore(store_folder)
+    for doc, chunk in enumerate(store.iter_chunks()):
+        terms = tokenize(chunk['content'])
+        counts = Counter(terms)
+        ids.append(chunk['id'])
+        doc_lens.append(len(terms))
+        for term, tf in counts.items():
+            term_numbers.append(vocabulary.setdefault(term, len(vocabulary)))
+            doc_numbers.append(doc)
+            tfs.append(tf)
+    store.close()
+
+    terms = np.array(
+        [term.encode('utf-8') for term in vocabulary],
+        dtype=f'S{MAX_TERM_BYTES}'
+    )
+    term_order = np.argsort(terms, kind='stable')
+    rank = np.empty_like(term_order)
+    rank[term_order] = np.arange(len(term_order))
+
+    term_numbers = rank[np.asarray(term_numbers, dtype=np.int64)]
+    posting_order = np.argsort(term_numbers, kind='stable')
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(term_numbers, minlength=len(terms)), out=offsets[1:]
+    )
+
+    doc_lens = np.asarray(doc_lens, dtype=np.uint32)
+    _save_npy(os.path.join(folder, 'terms.npy'), terms[term_order])
+    _save_npy(os.path.join(folder, 'offsets.npy'), offsets)
+    _save_npy(
+        os.path.join(folder, 'postings.npy'),
+        np.asarray(doc_numbers, dtype=np.uint32)[posting_order]
+    )
+    _save_npy(
+        os.path.join(folder, 'tfs.npy'),
+        np.minimum(np.asarray(tfs, dtype=np.int64), 65535).astype(
+            np.uint16
+        )[posting_order]
+    )
+    _save_npy(os.path.join(folder, 'doc_lens.npy'), doc_lens)
+    _save_npy(
+        os.path.join(folder, 'ids.npy'), np.asarray(ids, dtype=np.int64)
+    )
+
+    # meta.json is written last; it marks the index as complete.
+    meta = {
+        'docs': len(ids),
+        'terms': len(terms),
+        'postings': len(posting_order),
+        'avg_doc_len': float(doc_lens.mean()) if len(doc_lens) else 0.0,
+        'k1': k1,
+        'b': b
+    }
+    tmp_path = os.path.join(folder, 'meta.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as fout:
+        json.dump(meta, fout, indent=4)
+    os.replace(tmp_path, os.path.join(folder, 'meta.json'))
+
+    size = sum(
+        os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder)
+    )
+    print(f'Built BM25 index of {meta["docs"]} chunks, {meta["terms"]} '
+          f'terms and {meta["postings"]} postings in '
+          f'{time.perf_counter() - start:.2f}s ({size / 1024 ** 2:.1f} MiB).')
+
+
+def has_bm25_index(
+    store_folder: str
+) -> bool:
+    """
+    Checks whether a chunk store has a complete BM25 index.
+
+    Args:
+        store_folder (str): Path to the chunk store folder.
+
+    Returns:
+        bool: True if the index exists.
+    """
+    return os.path.exists(
+        os.path.join(store_folder, BM25_FOLDER, 'meta.json')
+    )
+
+
+class BM25Index:
+    """
+    Read-only, memory-mapped BM25 index. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        store_folder: str
+    ) -> None:
+        """
+        Memory-maps the index saved by build_bm25_index.
+
+        Args:
+            store_folder (str): Path to the chunk store folder.
+        """
+        folder = os.path.join(store_folder, BM25_FOLDER)
+        with open(os.path.join(folder, 'meta.json'), 'r') as fin:
+            self.meta = json.load(fin)
+
+        def load(name):
+            return np.load(os.path.join(folder, name), mmap_mode='r')
+
+        self.terms = load('terms.npy')
+        self.offsets = load('offsets.npy')
+        self.postings = load('postings.npy')
+        self.tfs = load('tfs.npy')
+        self.doc_lens = load('doc_lens.npy')
+        self.ids = load('ids.npy')
+
+    def _term_postings(
+        self,
+        term: str
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Looks up the postings of a term.
+
+        Args:
+            term (str): The term.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Document numbers and term
+                frequencies, empty if the term is unknown.
+        """
+        key = term.encode('utf-8')
+        i = int(np.searchsorted(self.terms, key))
+        if i == len(self.terms) or self.terms[i] != key:
+            return self.postings[:0], self.tfs[:0]
+
+        start, end = self.offsets[i], self.offsets[i + 1]
+
+        return self.postings[start:end], self.tfs[start:end]
+
+    def _query_terms(
+        self,
+        query: str
+    ) -> Counter:
+        """
+        Tokenizes a query. A compound identifier found in the index is
+        matched exactly; only unknown ones fall back to their parts.
+
+        Args:
+            query (str): The user query.
+
+        Returns:
+            Counter: Query frequency of each term.
+        """
+        terms = Counter()
+        for token in _TOKEN_RE.findall(query.lower()):
+            term = _truncate(token)
+            parts = _split_compound(token)
+            if not parts or len(self._term_postings(term)[0]):
+                terms[term] += 1
+            else:
+                terms.update(_truncate(part) for part in parts)
+
+        return terms
+
+    def search(
+        self,
+        query: str,
+        top_k: int = 5,
+        allowed_ids: np.ndarray = None
+    ) -> list[int]:
+        """
+        Ranks chunks by their BM25 score for a query.
+
+        Args:
+            query (str): The user query.
+            top_k (int): Number of top results to return. Default is 5.
+            allowed_ids (np.ndarray): Restricts results to these sorted
+                chunk IDs, e.g. one project's. Default is None.
+
+        Returns:
+            list[int]: IDs of the top K chunks with a positive score.
+        """
+        with tracing.span('bm25_search', top_k=top_k) as span:
+            results = self._search(query, top_k, allowed_ids)
+            span.set(results=len(results))
+
+        return results
+
+    def _search(
+        self,
+        query: str,
+        top_k: int,
+        allowed_ids: np.ndarray
+    ) -> list[int]:
+        """
+        Scores the chunks matching a query and keeps the best.
+
+        Args:
+            query (str): The user query.
+            top_k (int): Number of top results to return.
+            allowed_ids (np.ndarray): Sorted chunk IDs results are
+                restricted to, or None.
+
+        Returns:
+            list[int]: IDs of the top K chunks with a positive score.
+        """
+        n_docs = self.meta['docs']
+        k1, b = self.meta['k1'], self.meta['b']
+        avg_doc_len = self.meta['avg_doc_len'] or 1.0
+
+        matches = []
+        for term, query_tf in self._query_terms(query).items():
+            postings, tfs = self._term_postings(term)
+            if len(postings):
+                matches.append((query_tf, postings, tfs))
+
+        rare = [m for m in matches if len(m[1]) <= MAX_DF_RATIO * n_docs]
+        if rare:
+            matches = rare
+        if not matches:
+            return []
+
+        docs = []
+        scores = []
+        for query_tf, postings, tfs in matches:
+            df = len(postings)
+            idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+            tfs = tfs.astype(np.float32)
+            norm = k1 * (1.0 - b + b * self.doc_lens[postings] / avg_doc_len)
+            docs.append(postings)
+            scores.append(query_tf * idf * tfs * (k1 + 1.0) / (tfs + norm))
+
+        docs, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(scores))
+        ids = self.ids[docs]
+
+        if allowed_ids is not None:
+            keep = np.isin(ids, allowed_ids, assume_unique=True)
+            ids, scores = ids[keep], scores[keep]
+
+        if len(ids) > top_k:
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            top = np.arange(len(ids))
+        top = top[np.argsort(-scores[top], kind='stable')]
+
+        return [int(i) for i in ids[top]]
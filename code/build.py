@@ -1,56 +1,838 @@
 import os
+import sys
+import time
+import shutil
+import functools
+from concurrent.futures import Executor
 
+import numpy as np
+
+import tracing
 from rag import load_openai_api_key
-from faiss_index import build_faiss_index
-from extract_pdf import extract_folder, merge_chunks
-from embed_chunks import embed_chunks, merge_embedded_chunks
+from rate_limit import RateLimiter
+from scheduler import Task, run_tasks
+from embed_chunks import embed_stream
+from embedders import Embedder, make_embedder, check_embedder
+from embedding_cache import EmbeddingCache
+from dedup import Deduplicator
+from page_cache import PageImageCache, prerender_pages
+from query_cache import SemanticAnswerCache
+from bm25_index import build_bm25_index, has_bm25_index
+from pipeline import StageStats, run_stages, print_stage_stats
+from extract_pdf import (
+    extract_stream,
+    make_extract_executor,
+    report_extraction
+)
+from manifest import load_manifest, save_manifest, diff_manifest
+from catalog import write_catalog, load_catalog, is_current
+from chunk_store import ChunkStore, ChunkStoreWriter, migrate_json_artifacts
+from faiss_index import (
+    FaissIndexUpdater,
+    build_faiss_index,
+    load_index_info,
+    choose_index_type,
+    embedder_info
+)
 
 
-def main():
-    project_folder = os.path.join(
-        os.path.dirname(__file__), '..', 'data', 'projects'
+# Index type ('auto', 'flat', 'ivf', 'hnsw' or 'ivfpq') and parameter
+# overrides, e.g. {'nlist': 1024} or {'M': 32, 'efSearch': 128}. The
+# vectors of a flat, IVF or HNSW index are quantized with
+# {'quantization': 'fp16'}, 'int8' or 'pq', and searches rescore
+# 'rescore' times as many candidates against the stored embeddings.
+INDEX_TYPE = 'auto'
+INDEX_PARAMS = {}
+
+# Data type of the stored embeddings ('float32' or 'float16'), which
+# quantized indices are rescored against.
+EMBEDDINGS_DTYPE = 'float32'
+
+# Embedding backend ('openai', 'hashing' or 'sentence-transformers')
+# and its options, e.g. {'model_name': 'text-embedding-3-small'},
+# {'dim': 1024} or {'model_path': 'models/bge-small-en-v1.5'}. Changing
+# the embedder rebuilds the shared index from scratch.
+EMBEDDER_BACKEND = 'openai'
+EMBEDDER_OPTIONS = {'model_name': 'text-embedding-3-small'}
+
+# Projects built concurrently; only the shared index waits on all of
+# them. Extraction of all projects shares one pool of processes.
+PROJECT_WORKERS = 4
+
+# Processes extracting the PDFs of all projects, or None for one per
+# CPU; 1 extracts in a thread of the build process.
+EXTRACT_WORKERS = None
+
+# OpenAI embedding rate limits shared by all projects being built, in
+# requests and estimated tokens per minute, so concurrent projects are
+# spread out to the limit instead of being throttled with 429 errors.
+# None disables a limit.
+EMBED_REQUESTS_PER_MINUTE = 3000
+EMBED_TOKENS_PER_MINUTE = 1_000_000
+
+# Whether to drop chunks that nearly duplicate another chunk of the same
+# project (e.g. an unchanged page of a newer revision) before embedding,
+# keeping them as back-references to the indexed chunk, and the
+# estimated Jaccard similarity from which chunks count as duplicates.
+DEDUPLICATE = True
+DEDUP_THRESHOLD = 0.8
+
+# Whether to render the preview of every new or changed page into the
+# app's page image cache, so no preview is rasterized on request.
+PRERENDER_PREVIEWS = False
+
+# JSON span log ('-' for standard error) and Prometheus metrics file
+# written by the build; tracing is disabled while both are None.
+TRACE_LOG_PATH = None
+METRICS_PATH = None
+
+ARTIFACTS = (
+    'embeddings.npy',
+    'ids.npy',
+    'projects.npy',
+    'chunks.sqlite',
+    'faiss_index.index'
+)
+
+# Per-project copies written by earlier builds; all vectors now live in
+# the single index in the global folder.
+LEGACY_PROJECT_ARTIFACTS = (
+    'merged_chunks.json',
+    'embedded_chunks.json',
+    'embeddings.npy',
+    'ids.npy',
+    'projects.npy',
+    'projects.json',
+    'chunks.sqlite',
+    'faiss_index.index',
+    'faiss_index.json'
+)
+
+# Intermediate per-PDF chunk files and embedding checkpoints written by
+# earlier builds; chunks now stream straight into the shared index.
+LEGACY_PROJECT_FOLDERS = ('chunks', 'checkpoints')
+
+
+def _has_artifacts(
+    folder: str
+) -> bool:
+    """
+    Checks whether a folder holds a complete set of build artifacts.
+
+    Args:
+        folder (str): Path to the index folder.
+
+    Returns:
+        bool: True if every artifact exists.
+    """
+    return all(
+        os.path.exists(os.path.join(folder, artifact))
+        for artifact in ARTIFACTS
+    )
+
+
+def _remove_legacy_artifacts(
+    project_path: str
+) -> None:
+    """
+    Deletes per-project index artifacts and intermediate files left by
+    earlier builds.
+
+    Args:
+        project_path (str): Path to the project folder.
+    """
+    for artifact in LEGACY_PROJECT_ARTIFACTS:
+        path = os.path.join(project_path, artifact)
+        if os.path.exists(path):
+            os.remove(path)
+    for folder in LEGACY_PROJECT_FOLDERS:
+        shutil.rmtree(os.path.join(project_path, folder), ignore_errors=True)
+
+
+def _quantization_changed(
+    info: dict
+) -> bool:
+    """
+    Checks whether the configured quantization differs from the one an
+    index was built with.
+
+    Args:
+        info (dict): Index info saved with the index.
+
+    Returns:
+        bool: True if the index must be rebuilt.
+    """
+    return (
+        INDEX_PARAMS.get('quantization')
+        != info['params'].get('quantization')
+    )
+
+
+def plan_project(
+    project_path: str,
+    store: ChunkStore | None,
+    full: bool = False
+) -> dict | None:
+    """
+    Works out what changed in a single project since the last build.
+
+    Only PDFs in 6_Issued that were added, changed or deleted since the
+    last build (according to the project manifest) are rebuilt, along
+    with unchanged PDFs whose pages were deduplicated against chunks of
+    those, so they get new representatives. Projects without a
+    manifest, or with full set, are rebuilt from scratch.
+
+    Args:
+        project_path (str): Path to the project folder.
+        store (ChunkStore | None): The shared chunk store, used to look
+            up the chunks of changed and deleted PDFs, or None if it
+            does not exist yet.
+        full (bool): Whether to rebuild the project from scratch.
+            Default is False.
+
+    Returns:
+        dict | None: The project's plan, or None if it is unchanged.
+    """
+    project = os.path.basename(project_path)
+    project_pdfs = os.path.join(project_path, '6_Issued')
+    manifest_path = os.path.join(project_path, 'manifest.json')
+
+    _remove_legacy_artifacts(project_path)
+    manifest = {} if full else load_manifest(manifest_path)
+    added, changed, removed, new_manifest = diff_manifest(
+        manifest, project_pdfs
     )
-    projects = os.listdir(project_folder)
-    projects.insert(-1, 'global')
 
-    client = load_openai_api_key(
-        os.path.join(
-            os.path.dirname(__file__), 'OPENAI_API_KEY.txt'
+    if manifest and not (added or changed or removed):
+        print(f'{project}: no changes, skipping.')
+        return None
+
+    remove_ids = []
+    rebuilt = []
+    if not manifest:
+        print(f'{project}: full build of {len(added)} PDFs.')
+    else:
+        print(f'{project}: {len(added)} added, {len(changed)} changed, '
+              f'{len(removed)} removed PDFs.')
+        if store is not None:
+            paths = {
+                os.path.abspath(os.path.join(project_pdfs, pdf_file))
+                for pdf_file in changed + removed
+            }
+            remove_ids = store.path_ids(paths)
+            # Pages of unchanged PDFs that duplicate a removed chunk
+            # lose their representative, so those PDFs are rebuilt
+            # too, which may in turn remove further representatives.
+            while True:
+                extra = {
+                    path for path in store.duplicate_paths(remove_ids)
+                    if path not in paths and os.path.exists(path)
+                }
+                if not extra:
+                    break
+                paths |= extra
+                remove_ids.extend(store.path_ids(extra))
+                rebuilt.extend(
+                    os.path.relpath(path, os.path.abspath(project_pdfs))
+                    for path in sorted(extra)
+                )
+            if rebuilt:
+                print(f'{project}: rebuilding {len(rebuilt)} unchanged PDFs '
+                      'with pages deduplicated against changed ones.')
+
+    return {
+        'project': project,
+        'full': not manifest,
+        'pdf_folder': project_pdfs,
+        'pdf_files': added + changed + rebuilt,
+        'remove_ids': remove_ids,
+        'manifest': new_manifest,
+        'manifest_path': manifest_path,
+        'report_path': os.path.join(project_path, 'extract_report.json')
+    }
+
+
+def build_project(
+    embedder: Embedder,
+    cache: EmbeddingCache,
+    plan: dict,
+    writer: ChunkStoreWriter,
+    updater: FaissIndexUpdater | None,
+    executor: Executor = None,
+    limiter: RateLimiter = None,
+    token_limiter: RateLimiter = None
+) -> list[StageStats]:
+    """
+    Streams the new and changed PDFs of a project through extraction,
+    embedding and writing, which run concurrently connected by bounded
+    queues, so memory stays flat however large the project is. Nothing
+    is written besides the shared store and index.
+
+    If DEDUPLICATE is set, chunks that nearly duplicate another chunk
+    of the project are not embedded but recorded as back-references;
+    the savings are reported, and recorded in the plan's 'dedup'.
+
+    PDFs that fail to extract are dropped from the plan's manifest, so
+    they are retried by the next build. The pages with text of each
+    PDF are recorded in the plan's 'pages', for pre-rendering, and the
+    PDFs and chunks done so far in its 'progress'. If the build fails,
+    the chunks it added are discarded from the store and index.
+
+    Args:
+        embedder (Embedder): The embedding backend.
+        cache (EmbeddingCache): Embedding cache shared by all projects.
+        plan (dict): The project's plan returned by plan_project.
+        writer (ChunkStoreWriter): Writer of the shared chunk store.
+        updater (FaissIndexUpdater | None): Updater of the shared FAISS
+            index, or None if the index is built once the store is
+            complete.
+        executor (Executor): Extraction pool shared with other projects.
+            Default is None (the project creates its own).
+        limiter (RateLimiter): Embedding request rate limiter shared
+            with other projects. Default is None (no limit).
+        token_limiter (RateLimiter): Embedding token rate limiter
+            shared with other projects. Default is None (no limit).
+
+    Returns:
+        list[StageStats]: Statistics of each stage.
+    """
+    project = plan['project']
+    names = {
+        os.path.join(plan['pdf_folder'], pdf_file): pdf_file
+        for pdf_file in plan['pdf_files']
+    }
+    paths = {
+        os.path.abspath(pdf_path): pdf_file
+        for pdf_path, pdf_file in names.items()
+    }
+    report = {}
+    plan['pages'] = {}
+    plan['progress'] = {'pdfs': 0, 'chunks': 0}
+    # IDs of the chunks and duplicates added, discarded on failure.
+    added_ids = []
+    duplicate_ids = []
+
+    def extract(_):
+        for pdf_path, chunks, entry in extract_stream(
+            list(names), max_workers=EXTRACT_WORKERS, executor=executor
+        ):
+            report[names[pdf_path]] = entry
+            plan['progress']['pdfs'] += 1
+            if chunks is None:
+                tracing.count('extract_errors_total')
+                continue
+            tracing.count('extract_pages_total', entry['pages'])
+            tracing.observe('extract_pdf_seconds', entry['seconds'])
+            for chunk in chunks:
+                chunk['metadata']['project'] = project
+            plan['pages'][names[pdf_path]] = sorted({
+                chunk['metadata']['page_number'] for chunk in chunks
+            })
+            yield chunks
+
+    def dedup(chunk_lists):
+        for chunks in chunk_lists:
+            if not chunks:
+                continue
+            unique, duplicates, signatures = deduplicator.deduplicate(chunks)
+            duplicate_ids.extend(chunk['id'] for chunk, _ in duplicates)
+            writer.add_duplicates(duplicates)
+            writer.add_signatures(
+                [chunk['id'] for chunk in unique], signatures
+            )
+            report[paths[chunks[0]['metadata']['path']]]['duplicates'] = (
+                len(duplicates)
+            )
+            tracing.count('dedup_chunks_total', len(chunks))
+            tracing.count('dedup_duplicates_total', len(duplicates))
+            if unique:
+                yield unique
+
+    def embed(chunk_lists):
+        yield from embed_stream(
+            embedder,
+            chunk_lists,
+            cache,
+            limiter=limiter,
+            token_limiter=token_limiter
         )
+
+    print('=' * 72)
+    print(f'{project}: extracting and embedding {len(names)} PDFs...')
+
+    stages = [('extract', extract), ('embed', embed)]
+    if DEDUPLICATE:
+        deduplicator = Deduplicator(DEDUP_THRESHOLD)
+        computed = deduplicator.load(writer.representatives(project))
+        if computed:
+            writer.add_signatures(list(computed), list(computed.values()))
+        stages.insert(1, ('dedup', dedup))
+
+    start = time.perf_counter()
+    stats = []
+    with tracing.span(
+        'build_project', project=project, pdfs=len(names)
+    ) as span:
+        try:
+            for chunks, embeddings in run_stages(stages, stats=stats):
+                ids = np.array(
+                    [chunk['id'] for chunk in chunks], dtype=np.int64
+                )
+                writer.add(chunks, embeddings)
+                added_ids.extend(ids.tolist())
+                if updater is not None:
+                    updater.add(embeddings, ids)
+                plan['progress']['chunks'] += len(chunks)
+        except Exception:
+            writer.discard(added_ids + duplicate_ids)
+            if updater is not None:
+                updater.discard(added_ids)
+            print(f'{project}: build failed, discarded '
+                  f'{len(added_ids)} chunks.')
+            raise
+        span.set(chunks=len(added_ids))
+
+    report_extraction(
+        report, time.perf_counter() - start, plan['report_path']
     )
+    for pdf_file, entry in report.items():
+        if 'error' in entry:
+            plan['manifest']['files'].pop(pdf_file)
+    if DEDUPLICATE:
+        plan['dedup'] = {
+            'chunks': deduplicator.chunks,
+            'duplicates': deduplicator.duplicates,
+            'tokens': deduplicator.duplicate_tokens,
+            'bytes': deduplicator.duplicates * embedder.dim * 4
+        }
+        print(f'{project}: {deduplicator.duplicates} of '
+              f'{deduplicator.chunks} chunks were near-duplicates '
+              f'({deduplicator.duplicates / max(deduplicator.chunks, 1):.1%})'
+              ', not embedded.')
+    print_stage_stats(stats)
+
+    return stats
+
+
+def _project_progress(
+    plan: dict
+) -> str:
+    """
+    Describes how far the build of a project has got.
+
+    Args:
+        plan (dict): The project's plan, being built by build_project.
 
-    for project in projects:
-        project_path = os.path.join(project_folder, project)
+    Returns:
+        str: PDFs and chunks done so far.
+    """
+    progress = plan.get('progress', {'pdfs': 0, 'chunks': 0})
 
-        merged_chunks = os.path.join(project_path, 'merged_chunks.json')
-        out_npy = os.path.join(project_path, 'embeddings.npy')
-        out_json = os.path.join(project_path, 'embedded_chunks.json')
-        faiss_index = os.path.join(project_path, 'faiss_index.index')
+    return (f'{progress["pdfs"]}/{len(plan["pdf_files"])} PDFs, '
+            f'{progress["chunks"]} chunks')
 
-        if project != 'global':
-            project_pdfs = os.path.join(project_path, '6_Issued')
-            project_chunks = os.path.join(project_path, 'chunks')
 
-            extract_folder(project_pdfs, project_chunks)
-            merge_chunks(project_chunks, merged_chunks)
-            embed_chunks(
-                client=client,
-                input_path=merged_chunks,
-                out_npy=out_npy,
-                out_json=out_json,
-                model_name='text-embedding-3-small'
+def build_global(
+    global_path: str,
+    plans: list[dict],
+    removed_projects: list[str],
+    embedder: Embedder,
+    cache: EmbeddingCache,
+    max_workers: int = None,
+    limiter: RateLimiter = None,
+    token_limiter: RateLimiter = None
+) -> list[StageStats]:
+    """
+    Builds the changes of all projects into the single shared chunk
+    store and FAISS index, which hold every project's vectors tagged
+    with a project code.
+
+    The store and index are created from scratch if they do not exist
+    yet. Otherwise vectors are removed and added by ID: a project that
+    is rebuilt from scratch or deleted loses all of its vectors.
+
+    Projects are built concurrently, sharing one extraction pool and
+    the embedding rate limiters; the store and index are finished once
+    all of them are done. A project whose build fails is left out and
+    gets its plan's 'error', the others are kept.
+
+    Args:
+        global_path (str): Path to the folder of the shared index.
+        plans (list[dict]): Plans returned by plan_project for the
+            projects that changed.
+        removed_projects (list[str]): Projects that no longer exist.
+        embedder (Embedder): The embedding backend, recorded with a
+            new index.
+        cache (EmbeddingCache): Embedding cache shared by all projects.
+        max_workers (int): Maximum number of projects built at once.
+            Default is None (PROJECT_WORKERS).
+        limiter (RateLimiter): Embedding request rate limiter shared by
+            all projects. Default is None (no limit).
+        token_limiter (RateLimiter): Embedding token rate limiter
+            shared by all projects. Default is None (no limit).
+
+    Returns:
+        list[StageStats]: Statistics of each stage of every project
+            built successfully.
+    """
+    out_npy = os.path.join(global_path, 'embeddings.npy')
+    out_ids = os.path.join(global_path, 'ids.npy')
+    faiss_index = os.path.join(global_path, 'faiss_index.index')
+
+    fresh = not _has_artifacts(global_path)
+    if not fresh and not plans and not removed_projects:
+        if not has_bm25_index(global_path):
+            build_bm25_index(global_path)
+        info = load_index_info(faiss_index)
+        if _quantization_changed(info):
+            print('global: index quantization changed, rebuilding it from '
+                  'the stored embeddings.')
+            with tracing.span('faiss_index', fresh=False):
+                build_faiss_index(
+                    embeddings_path=out_npy,
+                    output_path=faiss_index,
+                    ids_path=out_ids,
+                    index_type=info['index_type'],
+                    params=INDEX_PARAMS,
+                    embedder_info=embedder_info(info)
+                )
+            return []
+        print('global: no changes, skipping.')
+        return []
+
+    remove_ids = []
+    if not fresh:
+        store = ChunkStore(global_path)
+        remove_ids = [i for plan in plans for i in plan['remove_ids']]
+        for project in removed_projects + [
+            plan['project'] for plan in plans if plan['full']
+        ]:
+            remove_ids.extend(store.project_ids(project).tolist())
+        store.close()
+        print(f'global: applying changes from {len(plans)} projects, '
+              f'removing {len(removed_projects)} deleted projects.')
+    else:
+        print(f'global: building shared index from {len(plans)} projects.')
+
+    writer = ChunkStoreWriter(
+        global_path, embedder.dim, remove_ids, EMBEDDINGS_DTYPE
+    )
+    updater = None if fresh else FaissIndexUpdater(faiss_index, remove_ids)
+    executor = make_extract_executor(EXTRACT_WORKERS)
+
+    def finish():
+        executor.shutdown()
+        print('=' * 72)
+        _finish_global(global_path, embedder, writer, updater, fresh)
+
+    projects = [plan['project'] for plan in plans]
+    tasks = [
+        Task(
+            plan['project'],
+            functools.partial(
+                build_project, embedder, cache, plan, writer, updater,
+                executor, limiter, token_limiter
+            ),
+            progress=functools.partial(_project_progress, plan)
+        )
+        for plan in plans
+    ] + [Task('global', finish, tuple(projects), after_failures=True)]
+    try:
+        results = run_tasks(tasks, max_workers or PROJECT_WORKERS)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    stats = []
+    for plan in plans:
+        result = results[plan['project']]
+        if result.ok:
+            stats.extend(result.value)
+        else:
+            plan['error'] = f'{type(result.error).__name__}: {result.error}'
+    if not results['global'].ok:
+        raise results['global'].error
+
+    return stats
+
+
+def _finish_global(
+    global_path: str,
+    embedder: Embedder,
+    writer: ChunkStoreWriter,
+    updater: FaissIndexUpdater | None,
+    fresh: bool
+) -> None:
+    """
+    Finishes the shared chunk store, then builds or saves the FAISS
+    index and rebuilds the BM25 index from the store.
+
+    Args:
+        global_path (str): Path to the folder of the shared index.
+        embedder (Embedder): The embedding backend, recorded with a
+            new index.
+        writer (ChunkStoreWriter): Writer of the shared chunk store.
+        updater (FaissIndexUpdater | None): Updater of the shared FAISS
+            index, or None if the index is built from scratch.
+        fresh (bool): Whether the index is built from scratch.
+    """
+    out_npy = os.path.join(global_path, 'embeddings.npy')
+    out_ids = os.path.join(global_path, 'ids.npy')
+    faiss_index = os.path.join(global_path, 'faiss_index.index')
+
+    with tracing.span('write_store') as span:
+        span.set(chunks=writer.close(), removed=writer.removed)
+
+    with tracing.span('faiss_index', fresh=fresh) as span:
+        if fresh:
+            build_faiss_index(
+                embeddings_path=out_npy,
+                output_path=faiss_index,
+                ids_path=out_ids,
+                index_type=INDEX_TYPE,
+                params=INDEX_PARAMS,
+                embedder_info=embedder.info()
             )
         else:
-            merge_embedded_chunks(
-                project_folder=project_folder,
-                global_folder=project_path
+            updater.close(out_npy, out_ids)
+
+            info = load_index_info(faiss_index)
+            index_type = info['index_type']
+            if (
+                INDEX_TYPE == 'auto'
+                and choose_index_type(info['ntotal']) != index_type
+            ):
+                index_type = choose_index_type(info['ntotal'])
+                print(f'global: corpus size now suits a {index_type} '
+                      'index, rebuilding it from the stored embeddings.')
+            elif _quantization_changed(info):
+                print('global: index quantization changed, rebuilding it '
+                      'from the stored embeddings.')
+            else:
+                index_type = None
+            if index_type is not None:
+                build_faiss_index(
+                    embeddings_path=out_npy,
+                    output_path=faiss_index,
+                    ids_path=out_ids,
+                    index_type=index_type,
+                    params=INDEX_PARAMS,
+                    embedder_info=embedder_info(info)
+                )
+        info = load_index_info(faiss_index)
+        span.set(index_type=info['index_type'], vectors=info['ntotal'])
+        tracing.gauge('index_vectors', info['ntotal'])
+
+    # Tokenizing is cheap next to embedding, so the lexical index is
+    # rebuilt from the updated store rather than patched.
+    with tracing.span('bm25_index'):
+        build_bm25_index(global_path)
+
+    _write_catalog(global_path)
+
+
+def _write_catalog(
+    global_path: str
+) -> None:
+    """
+    Writes the catalog of the shared index. It is written after all
+    other artifacts, and its new build ID tells readers the build is
+    complete.
+
+    Args:
+        global_path (str): Path to the folder of the shared index.
+    """
+    store = ChunkStore(global_path)
+    catalog = write_catalog(
+        global_path,
+        store.project_counts(),
+        load_index_info(os.path.join(global_path, 'faiss_index.index'))
+    )
+    store.close()
+    print(f'Wrote catalog of {len(catalog["projects"])} projects and '
+          f'{catalog["vectors"]} vectors.')
+
+
+def main() -> int:
+    tracing.configure(log_path=TRACE_LOG_PATH, metrics_path=METRICS_PATH)
+
+    project_folder = os.path.join(
+        os.path.dirname(__file__), '..', 'data', 'projects'
+    )
+    global_path = os.path.join(project_folder, 'global')
+    projects = sorted(
+        project for project in os.listdir(project_folder)
+        if project != 'global'
+        and os.path.isdir(os.path.join(project_folder, project))
+    )
+
+    cache_folder = os.path.join(
+        os.path.dirname(__file__), '..', 'data', 'cache'
+    )
+    cache = EmbeddingCache(os.path.join(cache_folder, 'embeddings.sqlite'))
+
+    client = None
+    if EMBEDDER_BACKEND == 'openai':
+        client = load_openai_api_key(
+            os.path.join(
+                os.path.dirname(__file__), 'OPENAI_API_KEY.txt'
+            )
+        )
+    embedder = make_embedder(EMBEDDER_BACKEND, EMBEDDER_OPTIONS, client)
+
+    # Projects missing from the shared index (new ones, or all of them
+    # if it has to be created) are built from scratch.
+    migrate_json_artifacts(global_path)
+    indexed_projects = set()
+    store = None
+    if _has_artifacts(global_path):
+        store = ChunkStore(global_path)
+        indexed_projects = set(store.projects())
+        try:
+            check_embedder(
+                embedder,
+                load_index_info(
+                    os.path.join(global_path, 'faiss_index.index')
+                )
             )
+            embedder_changed = False
+        except ValueError as e:
+            print(f'{e} Rebuilding all projects.')
+            embedder_changed = True
+        if '' in indexed_projects or embedder_changed:
+            # Built before chunks were tagged with their project, or
+            # with a different embedder.
+            store.close()
+            store = None
+            for artifact in ARTIFACTS:
+                os.remove(os.path.join(global_path, artifact))
+            indexed_projects = set()
+
+    start = time.perf_counter()
+    with tracing.span('build', projects=len(projects)):
+        plans = []
+        for project in projects:
+            with tracing.span('plan_project', project=project):
+                plan = plan_project(
+                    project_path=os.path.join(project_folder, project),
+                    store=store,
+                    full=project not in indexed_projects
+                )
+            if plan is not None:
+                plans.append(plan)
+        if store is not None:
+            store.close()
 
-        build_faiss_index(
-            embeddings_path=out_npy,
-            output_path=faiss_index
+        removed_projects = sorted(indexed_projects - set(projects))
+        limiter = token_limiter = None
+        if EMBEDDER_BACKEND == 'openai':
+            if EMBED_REQUESTS_PER_MINUTE is not None:
+                limiter = RateLimiter(
+                    EMBED_REQUESTS_PER_MINUTE / 60.0, name='embeddings'
+                )
+            if EMBED_TOKENS_PER_MINUTE is not None:
+                # Any batch fits in the bucket, so it never waits
+                # longer than the limit requires.
+                token_limiter = RateLimiter(
+                    EMBED_TOKENS_PER_MINUTE / 60.0,
+                    burst=max(
+                        EMBED_TOKENS_PER_MINUTE / 60.0,
+                        embedder.max_batch_tokens
+                    ),
+                    name='embedding_tokens'
+                )
+        build_global(
+            global_path,
+            plans,
+            removed_projects,
+            embedder,
+            cache,
+            max_workers=PROJECT_WORKERS,
+            limiter=limiter,
+            token_limiter=token_limiter
         )
 
+        # Manifests are only saved once the shared index holds the
+        # changes, so an interrupted build redoes them. A project whose
+        # build failed loses its manifest, so the next build rebuilds
+        # it from scratch.
+        for plan in plans:
+            if 'error' not in plan:
+                save_manifest(plan['manifest'], plan['manifest_path'])
+            elif os.path.exists(plan['manifest_path']):
+                os.remove(plan['manifest_path'])
+
+        # Cached answers of changed projects may cite outdated chunks.
+        # Answers across all projects are checked when next served.
+        semantic_path = os.path.join(cache_folder, 'semantic_answers.sqlite')
+        changed_projects = [plan['project'] for plan in plans]
+        if os.path.exists(semantic_path) and (
+            changed_projects or removed_projects
+        ):
+            semantic_cache = SemanticAnswerCache(semantic_path)
+            dropped = semantic_cache.invalidate(
+                changed_projects + removed_projects
+            )
+            semantic_cache.close()
+            print(f'Semantic answer cache: dropped {dropped} answers of '
+                  'changed projects.')
+
+        # Builds without changes only write a catalog if the index has
+        # none yet or was rebuilt in place, so readers do not reload an
+        # unchanged index.
+        if _has_artifacts(global_path):
+            catalog = load_catalog(global_path)
+            if catalog is None or not is_current(catalog, global_path):
+                _write_catalog(global_path)
+
+        if PRERENDER_PREVIEWS:
+            print('=' * 72)
+            pages = sorted(
+                (os.path.abspath(os.path.join(plan['pdf_folder'], pdf_file)),
+                 page_number)
+                for plan in plans if 'error' not in plan
+                for pdf_file, page_numbers in plan['pages'].items()
+                for page_number in page_numbers
+            )
+            page_cache = PageImageCache(
+                os.path.join(cache_folder, 'pages.sqlite')
+            )
+            with tracing.span('prerender_pages', pages=len(pages)):
+                prerender_pages(page_cache, pages)
+            page_cache.close()
+
+    print('=' * 72)
+    print(f'Build finished in {time.perf_counter() - start:.2f}s.')
+
+    dedup = [plan['dedup'] for plan in plans if 'dedup' in plan]
+    if dedup:
+        chunks = sum(entry['chunks'] for entry in dedup)
+        duplicates = sum(entry['duplicates'] for entry in dedup)
+        print(f'Deduplication: {duplicates} of {chunks} chunks were '
+              f'near-duplicates ({duplicates / max(chunks, 1):.1%}), '
+              f'saving ~{sum(entry["tokens"] for entry in dedup)} '
+              'embedding tokens and '
+              f'{sum(entry["bytes"] for entry in dedup) / 1024 ** 2:.1f} '
+              'MiB of vectors.')
+
+    stats = cache.stats()
+    print(f'Embedding cache: {stats["hits"]} hits, {stats["misses"]} misses '
+          f'({stats["hit_rate"]:.1%} hit rate), {stats["evictions"]} '
+          f'evictions, {stats["entries"]} entries, '
+          f'{stats["bytes"] / 1024 ** 2:.1f} MiB.')
+    cache.close()
+
+    tracing.write_metrics()
+
+    failed = [plan for plan in plans if 'error' in plan]
+    if failed:
+        print('=' * 72)
+        print(f'{len(failed)} of {len(plans)} projects failed and will be '
+              'rebuilt by the next build:')
+        for plan in failed:
+            print(f'  {plan["project"]}: {plan["error"]}')
+
+    return 1 if failed else 0
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
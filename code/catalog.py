@@ -0,0 +1,180 @@
+"""
+Catalog of the shared index, written by the build next to it: the
+indexed projects with their chunk counts, the index type, dimension and
+embedder, and the versions of the index artifacts.
+
+The app reads only this small JSON file at startup, so it can list the
+projects without listing the project folders or loading the index. The
+module only needs the standard library, to keep that path light.
+
+The build writes the catalog after all other artifacts, with a new
+build ID. Readers reload the index only when the build ID changes, so
+they never pair the files of two builds while one is being replaced.
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+
+
+CATALOG_FILE = 'catalog.json'
+CATALOG_VERSION = 2
+
+# Artifacts identifying a build of the shared index; a rebuild replaces
+# them, changing their versions. The BM25 metadata (see bm25_index) is
+# missing from stores built before it existed.
+VERSION_FILES = ('faiss_index.index', 'chunks.sqlite', 'embeddings.npy')
+OPTIONAL_VERSION_FILES = (os.path.join('bm25', 'meta.json'),)
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def artifact_version(
+    index_folder: str
+) -> tuple:
+    """
+    Identifies the current build by the mtimes and sizes of its
+    artifacts. A rebuild replaces the files, changing the version.
+
+    Args:
+        index_folder (str): Path to the folder of the shared index.
+
+    Returns:
+        tuple: (mtime_ns, size) of each artifact, None for optional
+            artifacts that do not exist.
+    """
+    version = []
+    for artifact in VERSION_FILES:
+        stat = os.stat(os.path.join(index_folder, artifact))
+        version.append((stat.st_mtime_ns, stat.st_size))
+    for artifact in OPTIONAL_VERSION_FILES:
+        path = os.path.join(index_folder, artifact)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        else:
+            version.append(None)
+
+    return tuple(version)
+
+
+def write_catalog(
+    index_folder: str,
+    project_chunks: dict[str, int],
+    info: dict
+) -> dict:
+    """
+    Atomically writes the catalog of the shared index, with a new
+    build ID. Must be written after all other artifacts of the build.
+
+    Args:
+        index_folder (str): Path to the folder of the shared index.
+        project_chunks (dict[str, int]): Number of indexed chunks of
+            each project.
+        info (dict): The index info saved with the FAISS index.
+
+    Returns:
+        dict: The catalog.
+    """
+    catalog = {
+        'version': CATALOG_VERSION,
+        'build': uuid.uuid4().hex,
+        'built': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'projects': [
+            {'name': project, 'chunks': int(chunks)}
+            for project, chunks in sorted(project_chunks.items())
+        ],
+        'vectors': info['ntotal'],
+        'index_type': info['index_type'],
+        'quantization': info['params'].get('quantization'),
+        'dim': info['dim'],
+        'embedder': info.get('model_id'),
+        'artifacts': artifact_version(index_folder)
+    }
+
+    path = os.path.join(index_folder, CATALOG_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fout:
+        json.dump(catalog, fout, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+    return catalog
+
+
+def load_catalog(
+    index_folder: str
+) -> dict | None:
+    """
+    Loads the catalog of the shared index, reusing the last one read
+    while the file is unchanged.
+
+    Args:
+        index_folder (str): Path to the folder of the shared index.
+
+    Returns:
+        dict | None: The catalog, or None if there is none or it was
+            written by another version of the build.
+    """
+    path = os.path.join(index_folder, CATALOG_FILE)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    with _cache_lock:
+        if key not in _cache:
+            with open(path, 'r', encoding='utf-8') as fin:
+                catalog = json.load(fin)
+            if catalog.get('version') != CATALOG_VERSION:
+                catalog = None
+            _cache.clear()
+            _cache[key] = catalog
+
+        return _cache[key]
+
+
+def is_current(
+    catalog: dict,
+    index_folder: str
+) -> bool:
+    """
+    Checks whether a catalog describes the current build of the shared
+    index.
+
+    Args:
+        catalog (dict): Catalog returned by load_catalog.
+        index_folder (str): Path to the folder of the shared index.
+
+    Returns:
+        bool: Whether the artifact versions match.
+    """
+    try:
+        version = artifact_version(index_folder)
+    except FileNotFoundError:
+        return False
+
+    return json.loads(json.dumps(version)) == catalog['artifacts']
+
+
+def build_version(
+    index_folder: str
+) -> str | tuple:
+    """
+    Identifies the last complete build of the shared index.
+
+    Args:
+        index_folder (str): Path to the folder of the shared index.
+
+    Returns:
+        str | tuple: The build ID of the catalog, or the artifact
+            versions of a store built before catalogs existed.
+    """
+    catalog = load_catalog(index_folder)
+    if catalog is not None:
+        return catalog['build']
+
+    return artifact_version(index_folder)
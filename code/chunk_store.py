@@ -0,0 +1,926 @@
+"""
+Compact on-disk store of embedded chunks.
+
+A chunk store is a folder holding embeddings.npy (float32 or float16
+embeddings, memory-mapped on read), ids.npy (the chunk ID of each
+embedding row), projects.npy (the project code of each row, decoded by
+projects.json) and chunks.sqlite (content and metadata of each chunk,
+indexed by chunk ID). Readers fetch only the rows they need instead of
+parsing every chunk of a project.
+
+Near-duplicate chunks dropped by the build are kept in chunks.sqlite
+as back-references to their representative chunk, without content or
+embedding, and the MinHash signatures of the representatives are kept
+for later builds to deduplicate against.
+"""
+
+import os
+import json
+import shutil
+import sqlite3
+import pathlib
+import threading
+
+import numpy as np
+
+import tracing
+from extract_pdf import make_chunk_id
+
+
+EMBEDDINGS_FILE = 'embeddings.npy'
+IDS_FILE = 'ids.npy'
+PROJECTS_FILE = 'projects.npy'
+PROJECT_NAMES_FILE = 'projects.json'
+CHUNKS_DB = 'chunks.sqlite'
+LEGACY_JSON = 'embedded_chunks.json'
+
+# Rows of embeddings copied at a time when rewriting a store.
+COPY_ROWS = 65536
+
+# Data types embeddings may be stored as. float16 halves the file and
+# its page cache footprint at a precision loss well below what affects
+# rankings.
+EMBEDDING_DTYPES = ('float32', 'float16')
+
+
+def _save_npy(
+    array: np.ndarray,
+    output_path: str
+) -> None:
+    """
+    Atomically saves an array to a .npy file.
+
+    Args:
+        array (np.ndarray): The array to save.
+        output_path (str): Path to the .npy file.
+    """
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        np.save(fout, array)
+    os.replace(tmp_path, output_path)
+
+
+def _create_dedup_tables(
+    conn: sqlite3.Connection
+) -> None:
+    """
+    Creates the tables of duplicates and signatures if they do not
+    exist, e.g. in a store written before deduplication.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the chunks database.
+    """
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS duplicates ('
+        'id INTEGER PRIMARY KEY, '
+        'rep INTEGER NOT NULL, '
+        'metadata TEXT NOT NULL)'
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_rep ON duplicates (rep)')
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS signatures ('
+        'id INTEGER PRIMARY KEY, '
+        'signature BLOB NOT NULL)'
+    )
+
+
+def _create_db(
+    path: str
+) -> sqlite3.Connection:
+    """
+    Creates an empty chunks database, replacing any existing file.
+
+    Args:
+        path (str): Path to the SQLite database file.
+
+    Returns:
+        sqlite3.Connection: Connection to the new database, usable from
+            any thread (callers serialize access).
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute(
+        'CREATE TABLE chunks ('
+        'id INTEGER PRIMARY KEY, '
+        'row INTEGER NOT NULL, '
+        'content TEXT NOT NULL, '
+        'metadata TEXT NOT NULL)'
+    )
+    conn.execute('CREATE INDEX idx_row ON chunks (row)')
+    _create_dedup_tables(conn)
+
+    return conn
+
+
+def _chunk_rows(
+    chunks: list[dict]
+) -> list[tuple]:
+    """
+    Converts chunks to database rows, numbering embedding rows from 0.
+
+    Args:
+        chunks (list[dict]): List of dictionaries containing text
+            chunks and metadata.
+
+    Returns:
+        list[tuple]: (id, row, content, metadata) tuples.
+    """
+    return [
+        (
+            chunk['id'],
+            i,
+            chunk['content'],
+            json.dumps(chunk['metadata'], ensure_ascii=False)
+        )
+        for i, chunk in enumerate(chunks)
+    ]
+
+
+def _load_project_names(
+    folder: str
+) -> list[str]:
+    """
+    Loads the project names that project codes index into.
+
+    Args:
+        folder (str): Folder containing the chunk store.
+
+    Returns:
+        list[str]: Project names, or an empty list for a new store.
+    """
+    path = os.path.join(folder, PROJECT_NAMES_FILE)
+    if not os.path.exists(path):
+        return []
+
+    with open(path, 'r', encoding='utf-8') as fin:
+        return json.load(fin)
+
+
+def _project_codes(
+    chunks: list[dict],
+    names: list[str]
+) -> np.ndarray:
+    """
+    Encodes the project of each chunk as a stable integer code,
+    appending unseen project names to names.
+
+    Args:
+        chunks (list[dict]): Chunks whose metadata may name a project.
+        names (list[str]): Known project names, extended in place.
+
+    Returns:
+        np.ndarray: int32 project code of each chunk.
+    """
+    lookup = {name: code for code, name in enumerate(names)}
+    codes = np.empty(len(chunks), dtype=np.int32)
+    for i, chunk in enumerate(chunks):
+        name = chunk['metadata'].get('project', '')
+        if name not in lookup:
+            lookup[name] = len(names)
+            names.append(name)
+        codes[i] = lookup[name]
+
+    return codes
+
+
+def _save_project_names(
+    names: list[str],
+    folder: str
+) -> None:
+    """
+    Atomically saves the project names that project codes index into.
+
+    Args:
+        names (list[str]): Project names.
+        folder (str): Folder containing the chunk store.
+    """
+    path = os.path.join(folder, PROJECT_NAMES_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fout:
+        json.dump(names, fout, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def save_chunk_store(
+    folder: str,
+    chunks: list[dict],
+    embeddings: np.ndarray
+) -> None:
+    """
+    Writes a chunk store, replacing any existing one in the folder.
+
+    Args:
+        folder (str): Folder to write the chunk store to.
+        chunks (list[dict]): List of dictionaries containing text
+            chunks and metadata.
+        embeddings (np.ndarray): Embeddings, one row per chunk.
+    """
+    os.makedirs(folder, exist_ok=True)
+    ids = np.array([chunk['id'] for chunk in chunks], dtype=np.int64)
+    names = []
+    codes = _project_codes(chunks, names)
+
+    tmp_db = os.path.join(folder, CHUNKS_DB + '.tmp')
+    conn = _create_db(tmp_db)
+    conn.executemany(
+        'INSERT INTO chunks (id, row, content, metadata) '
+        'VALUES (?, ?, ?, ?)',
+        _chunk_rows(chunks)
+    )
+    conn.commit()
+    conn.close()
+
+    _save_npy(np.asarray(embeddings, dtype=np.float32),
+              os.path.join(folder, EMBEDDINGS_FILE))
+    _save_npy(ids, os.path.join(folder, IDS_FILE))
+    _save_npy(codes, os.path.join(folder, PROJECTS_FILE))
+    _save_project_names(names, folder)
+    os.replace(tmp_db, os.path.join(folder, CHUNKS_DB))
+
+    print(f'Saved chunk store with {len(chunks)} chunks to {folder}')
+
+
+class ChunkStoreWriter:
+    """
+    Writes a chunk store incrementally, one batch of chunks at a time,
+    so neither the chunks nor their embeddings are ever all in memory.
+
+    If the folder already holds a store, its chunks are kept except
+    those in remove_ids (with their duplicates) and new chunks are
+    appended after them, and its embeddings are converted if they were
+    stored with another data type. Embeddings are spooled to a temporary
+    file and the store's files are only replaced by close(), so readers
+    keep seeing the previous store until the new one is complete. Chunks
+    added by mistake, e.g. by a project whose build failed, can be
+    discarded before then.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        dim: int,
+        remove_ids: list[int] = None,
+        dtype: str = 'float32'
+    ) -> None:
+        """
+        Starts writing a store.
+
+        Args:
+            folder (str): Folder of the chunk store.
+            dim (int): Dimension of the embeddings.
+            remove_ids (list[int]): IDs of existing chunks or
+                duplicates to drop. Default is None.
+            dtype (str): One of EMBEDDING_DTYPES, the data type the
+                embeddings are stored as. Default is 'float32'.
+        """
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f'Unknown embedding data type: {dtype}')
+
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.removed = 0
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._discarded = set()
+        self._ids = []
+        self._codes = []
+        self._rows = 0
+
+        db_path = os.path.join(folder, CHUNKS_DB)
+        self._tmp_db = db_path + '.tmp'
+        self._spool_path = os.path.join(folder, EMBEDDINGS_FILE + '.spool')
+        self._spool = open(self._spool_path, 'wb')
+
+        if not os.path.exists(db_path):
+            self._names = []
+            self._conn = _create_db(self._tmp_db)
+            return
+
+        self._names = _load_project_names(folder)
+        shutil.copyfile(db_path, self._tmp_db)
+        self._conn = sqlite3.connect(self._tmp_db, check_same_thread=False)
+        _create_dedup_tables(self._conn)
+
+        ids = np.load(os.path.join(folder, IDS_FILE))
+        codes = np.load(os.path.join(folder, PROJECTS_FILE))
+        remove_ids = np.array(list(remove_ids or []), dtype=np.int64)
+        keep = ~np.isin(ids, remove_ids)
+        self.removed = int((~keep).sum())
+        for statement in (
+            'DELETE FROM chunks WHERE id = ?',
+            'DELETE FROM signatures WHERE id = ?',
+            'DELETE FROM duplicates WHERE rep = ?'
+        ):
+            self._conn.executemany(
+                statement, ((int(chunk_id),) for chunk_id in ids[~keep])
+            )
+        self._conn.executemany(
+            'DELETE FROM duplicates WHERE id = ?',
+            ((int(chunk_id),) for chunk_id in remove_ids)
+        )
+        self._conn.executemany(
+            'UPDATE chunks SET row = ? WHERE id = ?',
+            ((row, int(chunk_id)) for row, chunk_id in enumerate(ids[keep]))
+        )
+
+        embeddings = np.load(
+            os.path.join(folder, EMBEDDINGS_FILE), mmap_mode='r'
+        )
+        for start in range(0, len(ids), COPY_ROWS):
+            block = keep[start:start + COPY_ROWS]
+            self._spool.write(np.ascontiguousarray(
+                embeddings[start:start + COPY_ROWS][block], dtype=self.dtype
+            ).tobytes())
+        del embeddings
+
+        self._ids.append(ids[keep])
+        self._codes.append(codes[keep])
+        self._rows = int(keep.sum())
+
+    def add(
+        self,
+        chunks: list[dict],
+        embeddings: np.ndarray
+    ) -> None:
+        """
+        Appends a batch of chunks. Safe to call from several threads.
+
+        Args:
+            chunks (list[dict]): List of dictionaries containing text
+                chunks and metadata.
+            embeddings (np.ndarray): Embeddings, one row per chunk.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+        if len(chunks) and embeddings.shape[1] != self.dim:
+            raise ValueError(
+                f'Embeddings of dimension {embeddings.shape[1]} cannot be '
+                f'added to a store of dimension {self.dim}.'
+            )
+
+        with self._lock:
+            rows = [
+                (chunk_id, self._rows + row, content, metadata)
+                for chunk_id, row, content, metadata in _chunk_rows(chunks)
+            ]
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO chunks (id, row, content, metadata) '
+                'VALUES (?, ?, ?, ?)',
+                rows
+            )
+            self._spool.write(embeddings.tobytes())
+            self._ids.append(
+                np.array([chunk['id'] for chunk in chunks], dtype=np.int64)
+            )
+            self._codes.append(_project_codes(chunks, self._names))
+            self._rows += len(chunks)
+
+    def add_duplicates(
+        self,
+        duplicates: list[tuple[dict, int]]
+    ) -> None:
+        """
+        Records near-duplicate chunks as back-references to their
+        representatives. Safe to call from several threads.
+
+        Args:
+            duplicates (list[tuple[dict, int]]): Each duplicate chunk
+                with the chunk ID of its representative.
+        """
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO duplicates (id, rep, metadata) '
+                'VALUES (?, ?, ?)',
+                [
+                    (
+                        chunk['id'],
+                        int(rep),
+                        json.dumps(chunk['metadata'], ensure_ascii=False)
+                    )
+                    for chunk, rep in duplicates
+                ]
+            )
+            self.duplicates += len(duplicates)
+
+    def add_signatures(
+        self,
+        ids: list[int],
+        signatures: np.ndarray
+    ) -> None:
+        """
+        Records the MinHash signatures of representative chunks. Safe
+        to call from several threads.
+
+        Args:
+            ids (list[int]): Chunk IDs of the representatives.
+            signatures (np.ndarray): Their signatures, one row each.
+        """
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO signatures (id, signature) '
+                'VALUES (?, ?)',
+                [
+                    (int(chunk_id), np.ascontiguousarray(signature).tobytes())
+                    for chunk_id, signature in zip(ids, signatures)
+                ]
+            )
+
+    def representatives(
+        self,
+        project: str
+    ) -> list[tuple[int, bytes | None, str | None]]:
+        """
+        Returns the chunks of a project already in the store, to
+        deduplicate new chunks against.
+
+        Args:
+            project (str): Name of the project.
+
+        Returns:
+            list[tuple[int, bytes | None, str | None]]: Chunk ID and
+                stored signature of each chunk, with its content if
+                the signature is missing.
+        """
+        with self._lock:
+            return self._conn.execute(
+                'SELECT c.id, s.signature, '
+                'CASE WHEN s.signature IS NULL THEN c.content END '
+                'FROM chunks c LEFT JOIN signatures s ON s.id = c.id '
+                "WHERE json_extract(c.metadata, '$.project') = ?",
+                (project,)
+            ).fetchall()
+
+    def discard(
+        self,
+        ids: list[int]
+    ) -> None:
+        """
+        Drops chunks and duplicates added since the writer was opened,
+        with the duplicates of those chunks. Safe to call from several
+        threads.
+
+        Args:
+            ids (list[int]): IDs of the chunks and duplicates.
+        """
+        ids = [int(chunk_id) for chunk_id in ids]
+        with self._lock:
+            for statement in (
+                'DELETE FROM chunks WHERE id = ?',
+                'DELETE FROM signatures WHERE id = ?',
+                'DELETE FROM duplicates WHERE rep = ?'
+            ):
+                self._conn.executemany(
+                    statement, ((chunk_id,) for chunk_id in ids)
+                )
+            cursor = self._conn.executemany(
+                'DELETE FROM duplicates WHERE id = ?',
+                ((chunk_id,) for chunk_id in ids)
+            )
+            self.duplicates -= max(cursor.rowcount, 0)
+            self._discarded.update(ids)
+
+    def close(self) -> int:
+        """
+        Finishes the store and atomically replaces the previous one.
+
+        Returns:
+            int: Number of chunks in the store.
+        """
+        with self._lock:
+            ids = (
+                np.concatenate(self._ids) if self._ids
+                else np.zeros(0, dtype=np.int64)
+            )
+            codes = (
+                np.concatenate(self._codes) if self._codes
+                else np.zeros(0, dtype=np.int32)
+            )
+            keep = None
+            if self._discarded:
+                keep = ~np.isin(
+                    ids, np.fromiter(self._discarded, dtype=np.int64)
+                )
+                ids = ids[keep]
+                codes = codes[keep]
+                self._rows = len(ids)
+                self._conn.executemany(
+                    'UPDATE chunks SET row = ? WHERE id = ?',
+                    ((row, int(chunk_id)) for row, chunk_id in enumerate(ids))
+                )
+            self._conn.commit()
+            self._conn.close()
+            self._spool.close()
+
+            # The .npy header is written in front of the spooled rows,
+            # copying them in blocks rather than loading them.
+            embeddings_path = os.path.join(self.folder, EMBEDDINGS_FILE)
+            tmp_path = embeddings_path + '.tmp'
+            with open(tmp_path, 'wb') as fout, \
+                    open(self._spool_path, 'rb') as fin:
+                np.lib.format.write_array_header_1_0(fout, {
+                    'descr': np.lib.format.dtype_to_descr(self.dtype),
+                    'fortran_order': False,
+                    'shape': (self._rows, self.dim)
+                })
+                if keep is None:
+                    shutil.copyfileobj(fin, fout, 16 * 1024 ** 2)
+                else:
+                    row_bytes = self.dim * self.dtype.itemsize
+                    for start in range(0, len(keep), COPY_ROWS):
+                        block = np.frombuffer(
+                            fin.read(COPY_ROWS * row_bytes), dtype=self.dtype
+                        ).reshape(-1, self.dim)
+                        fout.write(
+                            block[keep[start:start + COPY_ROWS]].tobytes()
+                        )
+            os.replace(tmp_path, embeddings_path)
+            os.remove(self._spool_path)
+
+            _save_npy(ids, os.path.join(self.folder, IDS_FILE))
+            _save_npy(codes, os.path.join(self.folder, PROJECTS_FILE))
+            _save_project_names(self._names, self.folder)
+            os.replace(self._tmp_db, os.path.join(self.folder, CHUNKS_DB))
+
+        print(f'Wrote chunk store in {self.folder}: removed {self.removed}, '
+              f'now {self._rows} chunks'
+              + (f', {self.duplicates} new duplicates.'
+                 if self.duplicates else '.'))
+
+        return self._rows
+
+
+def migrate_json_artifacts(
+    folder: str
+) -> bool:
+    """
+    Converts a legacy embedded_chunks.json into a chunk store and
+    deletes the JSON file. Chunks from builds that predate chunk IDs
+    are given the IDs the extractor would assign them.
+
+    Args:
+        folder (str): Folder containing the legacy artifacts.
+
+    Returns:
+        bool: True if a legacy file was migrated.
+    """
+    json_path = os.path.join(folder, LEGACY_JSON)
+    if not os.path.exists(json_path):
+        return False
+
+    print(f'Migrating {json_path} to a chunk store...')
+    with open(json_path, 'r', encoding='utf-8') as fin:
+        chunks = json.load(fin)
+
+    ordinals = {}
+    embeddings = []
+    for chunk in chunks:
+        if 'id' not in chunk:
+            metadata = chunk['metadata']
+            key = (metadata['path'], metadata['page_number'])
+            ordinals[key] = ordinals.get(key, -1) + 1
+            chunk['id'] = make_chunk_id(*key, ordinals[key])
+        embeddings.append(chunk.pop('embedding'))
+
+    embeddings = np.array(embeddings, dtype=np.float32)
+    save_chunk_store(folder, chunks, embeddings)
+    os.remove(json_path)
+
+    return True
+
+
+class ChunkStore:
+    """
+    Read-only access to a chunk store. Chunks are fetched by ID from
+    SQLite and embeddings are memory-mapped, so opening a store is cheap
+    and lookups only touch the requested rows. Safe to share between
+    threads.
+    """
+
+    def __init__(
+        self,
+        folder: str
+    ) -> None:
+        """
+        Opens a chunk store.
+
+        Args:
+            folder (str): Folder containing the chunk store.
+        """
+        self.folder = folder
+        db_uri = pathlib.Path(
+            os.path.abspath(os.path.join(folder, CHUNKS_DB))
+        ).as_uri()
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            f'{db_uri}?mode=ro', uri=True, check_same_thread=False
+        )
+        self._embeddings = None
+        self._ids = None
+        self._codes = None
+        # Stores written before deduplication have no duplicates.
+        self._has_duplicates = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'duplicates'"
+        ).fetchone() is not None
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """
+        np.ndarray: Memory-mapped embeddings, one row per chunk.
+        """
+        if self._embeddings is None:
+            self._embeddings = np.load(
+                os.path.join(self.folder, EMBEDDINGS_FILE), mmap_mode='r'
+            )
+
+        return self._embeddings
+
+    @property
+    def ids(self) -> np.ndarray:
+        """
+        np.ndarray: Memory-mapped chunk ID of each embedding row.
+        """
+        if self._ids is None:
+            self._ids = np.load(
+                os.path.join(self.folder, IDS_FILE), mmap_mode='r'
+            )
+
+        return self._ids
+
+    @property
+    def codes(self) -> np.ndarray:
+        """
+        np.ndarray: Memory-mapped project code of each embedding row.
+        """
+        if self._codes is None:
+            self._codes = np.load(
+                os.path.join(self.folder, PROJECTS_FILE), mmap_mode='r'
+            )
+
+        return self._codes
+
+    def projects(self) -> list[str]:
+        """
+        Returns the names of the projects with chunks in the store.
+
+        Returns:
+            list[str]: Project names.
+        """
+        names = _load_project_names(self.folder)
+
+        return [names[code] for code in np.unique(self.codes)]
+
+    def project_counts(self) -> dict[str, int]:
+        """
+        Counts the chunks of each project in the store.
+
+        Returns:
+            dict[str, int]: Number of chunks of each project.
+        """
+        names = _load_project_names(self.folder)
+        codes, counts = np.unique(self.codes, return_counts=True)
+
+        return {
+            names[code]: int(count) for code, count in zip(codes, counts)
+        }
+
+    def project_ids(
+        self,
+        project: str
+    ) -> np.ndarray:
+        """
+        Returns the chunk IDs belonging to a project.
+
+        Args:
+            project (str): Name of the project.
+
+        Returns:
+            np.ndarray: int64 chunk IDs of the project.
+        """
+        names = _load_project_names(self.folder)
+        if project not in names:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.asarray(
+            self.ids[self.codes == names.index(project)], dtype=np.int64
+        )
+
+    def path_ids(
+        self,
+        paths: list[str]
+    ) -> list[int]:
+        """
+        Returns the IDs of the chunks and duplicates extracted from some
+        PDF files.
+
+        Args:
+            paths (list[str]): Absolute paths of the PDF files.
+
+        Returns:
+            list[int]: IDs of their chunks and duplicates.
+        """
+        tables = ['chunks'] + (['duplicates'] if self._has_duplicates else [])
+        paths = list(paths)
+        ids = []
+        for start in range(0, len(paths), 500):
+            part = paths[start:start + 500]
+            placeholders = ','.join('?' * len(part))
+            for table in tables:
+                with self._lock:
+                    ids.extend(chunk_id for chunk_id, in self._conn.execute(
+                        f'SELECT id FROM {table} WHERE '
+                        "json_extract(metadata, '$.path') "
+                        f'IN ({placeholders})',
+                        part
+                    ))
+
+        return ids
+
+    def duplicate_paths(
+        self,
+        ids: list[int]
+    ) -> set[str]:
+        """
+        Returns the PDF files holding duplicates of some chunks.
+
+        Args:
+            ids (list[int]): Chunk IDs of the representatives.
+
+        Returns:
+            set[str]: Absolute paths of the PDF files.
+        """
+        if not self._has_duplicates:
+            return set()
+
+        ids = [int(chunk_id) for chunk_id in ids]
+        paths = set()
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            placeholders = ','.join('?' * len(part))
+            with self._lock:
+                paths.update(path for path, in self._conn.execute(
+                    "SELECT DISTINCT json_extract(metadata, '$.path') "
+                    f'FROM duplicates WHERE rep IN ({placeholders})',
+                    part
+                ))
+
+        return paths
+
+    def duplicate_count(self) -> int:
+        """
+        Returns the number of near-duplicate chunks recorded as
+        back-references instead of being indexed.
+
+        Returns:
+            int: Number of duplicates.
+        """
+        if not self._has_duplicates:
+            return 0
+
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM duplicates'
+            ).fetchone()[0]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM chunks'
+            ).fetchone()[0]
+
+    def __getitem__(
+        self,
+        chunk_id: int
+    ) -> dict:
+        chunks = self.get_many([chunk_id])
+        if chunk_id not in chunks:
+            raise KeyError(chunk_id)
+
+        return chunks[chunk_id]
+
+    def get_many(
+        self,
+        ids: list[int]
+    ) -> dict[int, dict]:
+        """
+        Fetches chunks by ID.
+
+        Args:
+            ids (list[int]): Chunk IDs to fetch.
+
+        Returns:
+            dict[int, dict]: The chunks found, keyed by chunk ID. Each
+                chunk has 'id', 'row', 'content' and 'metadata' keys;
+                the metadata of a chunk with near-duplicates lists
+                theirs under 'duplicates'.
+        """
+        ids = [int(chunk_id) for chunk_id in ids]
+        if not ids:
+            return {}
+
+        placeholders = ','.join('?' * len(ids))
+        duplicates = []
+        with tracing.span('fetch_chunks', chunks=len(ids)), self._lock:
+            rows = self._conn.execute(
+                'SELECT id, row, content, metadata FROM chunks '
+                f'WHERE id IN ({placeholders})',
+                ids
+            ).fetchall()
+            if self._has_duplicates:
+                duplicates = self._conn.execute(
+                    'SELECT rep, metadata FROM duplicates '
+                    f'WHERE rep IN ({placeholders}) '
+                    "ORDER BY json_extract(metadata, '$.source'), "
+                    "json_extract(metadata, '$.page_number')",
+                    ids
+                ).fetchall()
+
+        chunks = {
+            chunk_id: {
+                'id': chunk_id,
+                'row': row,
+                'content': content,
+                'metadata': json.loads(metadata)
+            }
+            for chunk_id, row, content, metadata in rows
+        }
+        for rep, metadata in duplicates:
+            if rep in chunks:
+                chunks[rep]['metadata'].setdefault('duplicates', []).append(
+                    json.loads(metadata)
+                )
+
+        return chunks
+
+    def get_embeddings(
+        self,
+        ids: list[int]
+    ) -> np.ndarray:
+        """
+        Fetches the embeddings of chunks by ID.
+
+        Args:
+            ids (list[int]): Chunk IDs to fetch.
+
+        Returns:
+            np.ndarray: float32 embeddings in the order of ids.
+        """
+        ids = [int(chunk_id) for chunk_id in ids]
+        rows = {}
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            placeholders = ','.join('?' * len(part))
+            with self._lock:
+                rows.update(self._conn.execute(
+                    f'SELECT id, row FROM chunks WHERE id IN ({placeholders})',
+                    part
+                ))
+
+        return np.asarray(
+            self.embeddings[[rows[chunk_id] for chunk_id in ids]],
+            dtype=np.float32
+        )
+
+    def iter_chunks(
+        self,
+        batch_size: int = 10000
+    ):
+        """
+        Iterates over all chunks in embedding row order.
+
+        Args:
+            batch_size (int): Number of rows fetched per query.
+                Default is 10000.
+
+        Yields:
+            dict: Chunks with 'id', 'content' and 'metadata' keys.
+        """
+        last_row = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT id, row, content, metadata FROM chunks '
+                    'WHERE row > ? ORDER BY row LIMIT ?',
+                    (last_row, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+
+            for chunk_id, row, content, metadata in rows:
+                yield {
+                    'id': chunk_id,
+                    'content': content,
+                    'metadata': json.loads(metadata)
+                }
+            last_row = rows[-1][1]
+
+    def close(self) -> None:
+        """
+        Closes the underlying database connection.
+        """
+        with self._lock:
+            self._conn.close()
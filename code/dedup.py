@@ -0,0 +1,239 @@
+"""
+Near-duplicate detection of chunks with MinHash and locality-sensitive
+hashing (LSH).
+
+Project folders hold many revisions of the same reports and drawing
+sets, whose pages differ in a few words at most. Each chunk is
+fingerprinted by the MinHash signature of its word shingles. Chunks
+whose signatures agree on a whole LSH band are compared, and a chunk
+whose estimated Jaccard similarity to an earlier one reaches the
+threshold is recorded as a duplicate of that representative instead of
+being embedded and indexed.
+"""
+
+import zlib
+from collections.abc import Iterable
+
+import numpy as np
+
+from embedders import estimate_tokens
+
+
+# Words per shingle.
+SHINGLE_WORDS = 3
+
+# Hash functions per signature, split into BANDS bands of equal rows.
+# With 8 bands of 8 rows, pairs above ~0.77 similarity are likely to
+# share a band. Changing these invalidates stored signatures, which are
+# then recomputed.
+NUM_PERM = 64
+BANDS = 8
+
+# Estimated Jaccard similarity from which chunks are duplicates.
+THRESHOLD = 0.8
+
+_PRIME = (1 << 61) - 1
+_rng = np.random.default_rng(1)
+_A = _rng.integers(1, 1 << 32, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, 1 << 32, NUM_PERM, dtype=np.uint64)
+
+
+def minhash(
+    text: str
+) -> np.ndarray:
+    """
+    Computes the MinHash signature of a text's word shingles.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        np.ndarray: uint32 signature of NUM_PERM values.
+    """
+    words = text.lower().split()
+    shingles = {
+        ' '.join(words[i:i + SHINGLE_WORDS])
+        for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))
+    }
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles)
+    )
+    # Products stay below 2 ** 64, as both factors are below 2 ** 32.
+    values = (hashes[:, None] * _A + _B) % _PRIME
+
+    return (values.min(axis=0) & 0xFFFFFFFF).astype(np.uint32)
+
+
+def similarity(
+    a: np.ndarray,
+    b: np.ndarray
+) -> float:
+    """
+    Estimates the Jaccard similarity of two texts from their
+    signatures.
+
+    Args:
+        a (np.ndarray): Signature of the first text.
+        b (np.ndarray): Signature of the second text.
+
+    Returns:
+        float: Share of equal signature values.
+    """
+    return float(np.mean(a == b))
+
+
+class Deduplicator:
+    """
+    Keeps the signatures of representative chunks in LSH buckets and
+    splits incoming chunks into new representatives and duplicates of
+    known ones. Not thread-safe; a build stage owns one per project.
+    """
+
+    def __init__(
+        self,
+        threshold: float = THRESHOLD
+    ) -> None:
+        """
+        Creates an empty deduplicator.
+
+        Args:
+            threshold (float): Estimated Jaccard similarity from which
+                chunks are duplicates. Default is THRESHOLD.
+        """
+        self.threshold = threshold
+        self.chunks = 0
+        self.duplicates = 0
+        self.duplicate_tokens = 0
+        self._signatures = {}
+        self._buckets = [{} for _ in range(BANDS)]
+
+    def _bands(
+        self,
+        signature: np.ndarray
+    ) -> list[bytes]:
+        """
+        Splits a signature into its LSH band keys.
+
+        Args:
+            signature (np.ndarray): The signature.
+
+        Returns:
+            list[bytes]: Key of each band.
+        """
+        rows = NUM_PERM // BANDS
+
+        return [
+            signature[band * rows:(band + 1) * rows].tobytes()
+            for band in range(BANDS)
+        ]
+
+    def add(
+        self,
+        chunk_id: int,
+        signature: np.ndarray
+    ) -> None:
+        """
+        Adds a representative, e.g. one indexed by an earlier build.
+
+        Args:
+            chunk_id (int): Chunk ID of the representative.
+            signature (np.ndarray): Its signature.
+        """
+        self._signatures[chunk_id] = signature
+        for bucket, key in zip(self._buckets, self._bands(signature)):
+            bucket.setdefault(key, []).append(chunk_id)
+
+    def load(
+        self,
+        representatives: Iterable[tuple[int, bytes | None, str | None]]
+    ) -> dict[int, np.ndarray]:
+        """
+        Adds the representatives indexed by earlier builds.
+
+        Args:
+            representatives (Iterable[tuple[int, bytes | None,
+                str | None]]): Chunk ID, stored signature and, where
+                the signature is missing or outdated, the content to
+                compute it from.
+
+        Returns:
+            dict[int, np.ndarray]: Signatures computed from content,
+                which should be stored.
+        """
+        computed = {}
+        for chunk_id, signature, content in representatives:
+            if signature is not None and len(signature) == NUM_PERM * 4:
+                signature = np.frombuffer(signature, dtype=np.uint32)
+            else:
+                signature = minhash(content or '')
+                computed[chunk_id] = signature
+            self.add(chunk_id, signature)
+
+        return computed
+
+    def find(
+        self,
+        signature: np.ndarray
+    ) -> int | None:
+        """
+        Looks up the most similar representative of a signature.
+
+        Args:
+            signature (np.ndarray): The signature.
+
+        Returns:
+            int | None: Chunk ID of the representative, or None if no
+                representative reaches the threshold.
+        """
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._bands(signature)):
+            candidates.update(bucket.get(key, ()))
+
+        best, best_similarity = None, self.threshold
+        for chunk_id in candidates:
+            value = similarity(signature, self._signatures[chunk_id])
+            if value >= best_similarity:
+                best, best_similarity = chunk_id, value
+
+        return best
+
+    def deduplicate(
+        self,
+        chunks: list[dict]
+    ) -> tuple[list[dict], list[tuple[dict, int]], np.ndarray]:
+        """
+        Splits chunks into new representatives and near-duplicates of
+        known representatives or of earlier chunks of the list.
+
+        Args:
+            chunks (list[dict]): Chunks to check.
+
+        Returns:
+            tuple[list[dict], list[tuple[dict, int]], np.ndarray]: The
+                new representatives, each duplicate with the chunk ID
+                of its representative, and the signatures of the new
+                representatives, one row each.
+        """
+        unique = []
+        duplicates = []
+        signatures = []
+        for chunk in chunks:
+            signature = minhash(chunk['content'])
+            rep = self.find(signature)
+            if rep is None:
+                self.add(chunk['id'], signature)
+                unique.append(chunk)
+                signatures.append(signature)
+            else:
+                duplicates.append((chunk, rep))
+                self.duplicate_tokens += estimate_tokens(chunk['content'])
+
+        self.chunks += len(chunks)
+        self.duplicates += len(duplicates)
+
+        return unique, duplicates, (
+            np.vstack(signatures) if signatures
+            else np.zeros((0, NUM_PERM), dtype=np.uint32)
+        )
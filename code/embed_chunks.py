@@ -1,177 +1,159 @@
 """
-Embeds text chunks using OpenAI and saves the embeddings to
-a .npy file or embedded_chunks.json with metadata.
+Embeds a stream of text chunks with any Embedder backend, yielding the
+embeddings to the caller batch by batch.
+
+This is the batching layer shared by all backends: texts are split into
+batches within the backend's limits, embedded concurrently and cached.
 """
 
-import os
-import json
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from openai import OpenAI
-
-
-def _load_chunks(
-    path: str
-) -> list[dict]:
-    """
-    Loads text chunks from a JSON file.
-
-    Args:
-        path (str): Path to the JSON file containing text chunks.
-
-    Returns:
-        list[dict]: List of dictionaries containing text chunks and
-            metadata.
-    """
-    with open(path, 'r', encoding='utf-8') as fin:
-        return json.load(fin)
-
-
-def _save_embeddings_npy(
-    embeddings: np.ndarray,
-    output_path: str
-) -> None:
-    """
-    Saves embeddings to a .npy file.
-
-    Args:
-        embeddings (np.ndarray): Array of embeddings.
-        output_path (str): Path to save the .npy file.
-    """
-    np.save(output_path, embeddings)
-    print(f'Saved NumPy embeddings to {output_path}')
-
-
-def _save_embedded_chunks(
-    chunks: list[dict],
-    embeddings: np.ndarray,
-    output_path: str
-) -> None:
-    """
-    Saves text chunks along with their embeddings to a JSON file.
-
-    Args:
-        chunks (list[dict]): List of dictionaries containing text
-            chunks and metadata.
-        embeddings (np.ndarray): Array of embeddings.
-        output_path (str): Path to save the JSON file.
-    """
-    for chunk, embedding in zip(chunks, embeddings):
-        chunk['embedding'] = embedding.tolist()
 
-    with open(output_path, 'w', encoding='utf-8') as fout:
-        json.dump(chunks, fout, ensure_ascii=False, indent=4)
+import tracing
+from rate_limit import RateLimiter
+from embedders import Embedder, estimate_tokens
+from embedding_cache import EmbeddingCache
 
-    print(f'Saved embedded chunks to {output_path}')
 
-
-def _embed_with_openai(
-    client: OpenAI,
-    texts: list[str],
-    model_name: str = 'text-embedding-3-small'
-) -> np.ndarray:
+def _stream_batches(
+    chunk_lists: Iterable[list[dict]],
+    max_batch_size: int,
+    max_batch_tokens: int
+) -> Iterator[list[dict]]:
     """
-    Embeds a list of texts using the OpenAI API.
+    Regroups a stream of chunk lists into batches bounded by both the
+    number of chunks and the estimated number of tokens.
 
     Args:
-        client (OpenAI): An instance of the OpenAI client.
-        texts (list[str]): List of texts to embed.
-        model_name (str): Name of the OpenAI embedding model to use.
-            Default is 'text-embedding-3-small'.
+        chunk_lists (Iterable[list[dict]]): Chunks, e.g. one list per
+            PDF.
+        max_batch_size (int): Maximum number of chunks per batch.
+        max_batch_tokens (int): Maximum estimated tokens per batch.
 
-    Returns:
-        np.ndarray: Array of embeddings.
-    """
-    response = client.embeddings.create(
-        input=texts,
-        model=model_name
-    )
-    embeddings = [data.embedding for data in response.data]
-
-    return np.array(embeddings, dtype=np.float32)
-
-
-def embed_chunks(
-    client: OpenAI,
-    input_path: str,
-    out_npy: str = None,
-    out_json: str = None,
-    model_name: str = 'text-embedding-3-small'
-) -> None:
+    Yields:
+        list[dict]: Successive batches of chunks.
     """
-    Embeds text chunks from a JSON file using OpenAI and
-    saves the embeddings to a .npy file or embedded_chunks.json with
-    metadata.
-
-    Args:
-        client (OpenAI): An instance of the OpenAI client.
-        input_path (str): Path to the JSON file containing text chunks.
-        out_npy (str): Path to save the .npy file. Default is None.
-        out_json (str): Path to save the JSON file with embeddings.
-            Default is None.
-        model_name (str): Name of the OpenAI model to use.
-            Default is 'text-embedding-3-small'.
+    batch = []
+    tokens = 0
+    for chunks in chunk_lists:
+        for chunk in chunks:
+            chunk_tokens = estimate_tokens(chunk['content'])
+            if batch and (
+                len(batch) >= max_batch_size
+                or tokens + chunk_tokens > max_batch_tokens
+            ):
+                yield batch
+                batch = []
+                tokens = 0
+            batch.append(chunk)
+            tokens += chunk_tokens
+
+    if batch:
+        yield batch
+
+
+def embed_stream(
+    embedder: Embedder,
+    chunk_lists: Iterable[list[dict]],
+    cache: EmbeddingCache = None,
+    max_workers: int = None,
+    limiter: RateLimiter = None,
+    token_limiter: RateLimiter = None
+) -> Iterator[tuple[list[dict], np.ndarray]]:
     """
-    print('-' * 72)
+    Embeds a stream of chunks batch by batch, in order.
 
-    print(f'Loading chunks from {input_path}...')
-    chunks = _load_chunks(input_path)
-    texts = [chunk['content'] for chunk in chunks]
-    print(f'Loaded {len(chunks)} chunks.')
-
-    print('-' * 72)
-
-    print('Embedding chunks...')
-    embeddings = _embed_with_openai(client, texts, model_name)
-
-    if out_npy:
-        _save_embeddings_npy(embeddings, out_npy)
-
-    if out_json:
-        _save_embedded_chunks(chunks, embeddings, out_json)
-
-    print('-' * 72)
-
-
-def merge_embedded_chunks(
-    project_folder: str,
-    global_folder: str
-):
-    """
-    Merges embedded chunks from multiple projects into a global one.
+    Chunks are regrouped into batches within the embedder's limits, of
+    which at most max_workers are embedded concurrently, so memory is
+    bounded however many chunks flow through. Cached embeddings are
+    reused and new ones written back to the cache as each batch
+    finishes, so an interrupted build resumes from the cache. Requests
+    wait for the rate limiters, which may be shared by several
+    concurrent streams.
 
     Args:
-        project_folder (str): Path to the project folder.
-        global_folder (str): Path to the global folder.
+        embedder (Embedder): The embedding backend.
+        chunk_lists (Iterable[list[dict]]): Chunks, e.g. one list per
+            PDF.
+        cache (EmbeddingCache): Embedding cache to read from and write
+            back to. Default is None (no caching).
+        max_workers (int): Maximum number of concurrent batches.
+            Default is None (the embedder's max_workers).
+        limiter (RateLimiter): Limiter of the request rate, taking one
+            token per request. Default is None (no limit).
+        token_limiter (RateLimiter): Limiter of the rate of embedded
+            tokens, taking the estimated tokens of each request.
+            Default is None (no limit).
+
+    Yields:
+        tuple[list[dict], np.ndarray]: A batch of chunks and their
+            embeddings.
     """
-    global_embeddings = []
-    global_chunks = []
-
-    for project in os.listdir(project_folder):
-        if project == 'global':
-            continue
-
-        project_path = os.path.join(project_folder, project)
-        emb_path = os.path.join(project_path, 'embeddings.npy')
-        chunk_path = os.path.join(project_path, 'embedded_chunks.json')
-
-        embeddings = np.load(emb_path)
-        with open(chunk_path, 'r', encoding='utf-8') as fin:
-            chunks = json.load(fin)
-
-        global_embeddings.append(embeddings)
-        global_chunks.extend(chunks)
-
-    os.makedirs(global_folder, exist_ok=True)
-    merged_embeddings = np.vstack(global_embeddings)
-    np.save(
-        os.path.join(global_folder, 'embeddings.npy'),
-        merged_embeddings
-    )
-
-    with open(
-        os.path.join(global_folder, 'embedded_chunks.json'),
-        'w',
-        encoding='utf-8'
-    ) as fout:
-        json.dump(global_chunks, fout, ensure_ascii=False, indent=4)
+    max_workers = max_workers or embedder.max_workers
+
+    def _run(batch):
+        texts = [chunk['content'] for chunk in batch]
+        if cache is not None:
+            embeddings = cache.get_many(embedder.model_id, texts)
+        else:
+            embeddings = [None] * len(texts)
+        missing = list(dict.fromkeys(
+            text for text, embedding in zip(texts, embeddings)
+            if embedding is None
+        ))
+        if missing:
+            if limiter is not None:
+                limiter.acquire()
+            if token_limiter is not None:
+                token_limiter.acquire(
+                    sum(estimate_tokens(text) for text in missing)
+                )
+            start = time.perf_counter()
+            new_embeddings = embedder.embed_batch(missing)
+            tracing.observe(
+                'embed_batch_seconds', time.perf_counter() - start,
+                model=embedder.model_id
+            )
+            tracing.count(
+                'embedded_texts_total', len(missing), model=embedder.model_id
+            )
+            if cache is not None:
+                cache.put_many(embedder.model_id, missing, new_embeddings)
+            lookup = dict(zip(missing, new_embeddings))
+            embeddings = [
+                lookup[text] if embedding is None else embedding
+                for text, embedding in zip(texts, embeddings)
+            ]
+
+        return batch, np.vstack(embeddings).astype(np.float32), len(missing)
+
+    start = time.perf_counter()
+    num_chunks = 0
+    num_embedded = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch in _stream_batches(
+            chunk_lists, embedder.max_batch_size, embedder.max_batch_tokens
+        ):
+            pending.append(executor.submit(_run, batch))
+            if len(pending) < max_workers:
+                continue
+            batch, embeddings, embedded = pending.popleft().result()
+            num_chunks += len(batch)
+            num_embedded += embedded
+            yield batch, embeddings
+
+        while pending:
+            batch, embeddings, embedded = pending.popleft().result()
+            num_chunks += len(batch)
+            num_embedded += embedded
+            yield batch, embeddings
+
+    elapsed = time.perf_counter() - start
+    print(f'Embedded {num_chunks} chunks with {embedder.model_id} '
+          f'({num_embedded} unique texts not cached) in {elapsed:.2f}s '
+          f'({num_chunks / max(elapsed, 1e-9):.1f} chunks/s).')
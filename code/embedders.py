@@ -0,0 +1,438 @@
+"""
+Embedding backends used by both the build and the query paths.
+
+Every backend implements the Embedder interface: embed_batch embeds one
+batch of texts, and the batching, threading and caching around it are
+shared (see embed_chunks). Backends are created by name from a
+registry, so a build can be switched to a local model by
+configuration alone. Each embedder has a model ID and dimension, which
+are stored with the index and checked when it is loaded.
+"""
+
+import re
+import time
+import random
+import hashlib
+from collections.abc import Callable
+
+import numpy as np
+from openai import OpenAI, RateLimitError
+
+import tracing
+
+
+MAX_RETRIES = 6
+
+HASHING_DIM = 1024
+
+
+def estimate_tokens(
+    text: str
+) -> int:
+    """
+    Roughly estimates the number of tokens in a text (~4 characters
+    per token for English text). Shared by the embedding batch limits,
+    deduplication savings and the prompt budget.
+
+    Args:
+        text (str): The text to estimate.
+
+    Returns:
+        int: Estimated number of tokens.
+    """
+    return len(text) // 4 + 1
+
+
+class Embedder:
+    """
+    Base class of embedding backends.
+
+    Subclasses set model_id and dim and implement embed_batch. The
+    batch limits and worker count tell the shared batching layer how
+    to split and parallelize work for this backend.
+    """
+
+    model_id: str
+    dim: int
+    max_batch_size: int = 512
+    max_batch_tokens: int = 250_000
+    max_workers: int = 4
+
+    def embed_batch(
+        self,
+        texts: list[str]
+    ) -> np.ndarray:
+        """
+        Embeds a single batch of texts.
+
+        Args:
+            texts (list[str]): Texts in the batch.
+
+        Returns:
+            np.ndarray: float32 array of shape (len(texts), dim).
+        """
+        raise NotImplementedError
+
+    def embed_query(
+        self,
+        query: str
+    ) -> np.ndarray:
+        """
+        Embeds a query string.
+
+        Args:
+            query (str): The query string to embed.
+
+        Returns:
+            np.ndarray: float32 array of shape (1, dim).
+        """
+        return self.embed_batch([query])
+
+    def info(self) -> dict:
+        """
+        Describes the embedder for storing with an index.
+
+        Returns:
+            dict: Model ID, dimension, and the backend and options it
+                was created from by make_embedder (None otherwise), so
+                the query path can recreate it.
+        """
+        return {
+            'model_id': self.model_id,
+            'dim': self.dim,
+            'embedder': getattr(self, 'spec', None)
+        }
+
+
+def _is_rate_limit_error(
+    error: Exception
+) -> bool:
+    """
+    Checks whether an exception signals an API rate limit (HTTP 429).
+
+    Args:
+        error (Exception): The raised exception.
+
+    Returns:
+        bool: True if the request should be retried after a backoff.
+    """
+    return (
+        isinstance(error, RateLimitError)
+        or getattr(error, 'status_code', None) == 429
+    )
+
+
+class OpenAIEmbedder(Embedder):
+    """
+    Embeds texts with the OpenAI embeddings API, retrying with
+    exponential backoff and jitter when rate limited.
+    """
+
+    DIMS = {
+        'text-embedding-3-small': 1536,
+        'text-embedding-3-large': 3072,
+        'text-embedding-ada-002': 1536
+    }
+
+    def __init__(
+        self,
+        client: OpenAI,
+        model_name: str = 'text-embedding-3-small',
+        max_workers: int = 4,
+        max_retries: int = MAX_RETRIES
+    ) -> None:
+        """
+        Creates the embedder.
+
+        Args:
+            client (OpenAI): An instance of the OpenAI client.
+            model_name (str): Name of the OpenAI embedding model.
+                Default is 'text-embedding-3-small'.
+            max_workers (int): Maximum number of concurrent requests.
+                Default is 4.
+            max_retries (int): Maximum number of retries on rate-limit
+                errors. Default is MAX_RETRIES.
+        """
+        if model_name not in self.DIMS:
+            raise ValueError(f'Unknown OpenAI embedding model: {model_name}')
+
+        self.client = client
+        self.model_name = model_name
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        # The bare model name keeps existing cache entries valid.
+        self.model_id = model_name
+        self.dim = self.DIMS[model_name]
+
+    def embed_batch(
+        self,
+        texts: list[str]
+    ) -> np.ndarray:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.client.embeddings.create(
+                    input=texts,
+                    model=self.model_name
+                )
+                break
+            except Exception as e:
+                if not _is_rate_limit_error(e) or attempt == self.max_retries:
+                    tracing.count(
+                        'openai_errors_total', endpoint='embeddings'
+                    )
+                    raise
+                tracing.count('openai_retries_total', endpoint='embeddings')
+                delay = min(60.0, 2 ** attempt) * (0.5 + random.random())
+                time.sleep(delay)
+
+        tracing.count(
+            'openai_requests_total', endpoint='embeddings',
+            model=self.model_name
+        )
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            tracing.count(
+                'openai_tokens_total', usage.prompt_tokens,
+                endpoint='embeddings', model=self.model_name, kind='prompt'
+            )
+        embeddings = [data.embedding for data in response.data]
+
+        return np.array(embeddings, dtype=np.float32)
+
+
+class HashingEmbedder(Embedder):
+    """
+    Fully local, deterministic embedder using signed feature hashing of
+    word unigrams and bigrams. No model download, no network; suited to
+    offline builds and tests, and to lexical-style similarity.
+    """
+
+    max_batch_size = 2048
+    max_batch_tokens = 10_000_000
+    max_workers = 1
+
+    def __init__(
+        self,
+        dim: int = HASHING_DIM
+    ) -> None:
+        """
+        Creates the embedder.
+
+        Args:
+            dim (int): Dimension of the embeddings. Default is
+                HASHING_DIM.
+        """
+        self.dim = dim
+        self.model_id = f'hashing-{dim}'
+
+    def _features(
+        self,
+        text: str
+    ) -> list[str]:
+        """
+        Extracts the hashed features of a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            list[str]: Unigrams and bigrams of the lower-cased words.
+        """
+        words = re.findall(r'\w+', text.lower())
+
+        return words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+
+    def embed_batch(
+        self,
+        texts: list[str]
+    ) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = hashlib.blake2b(
+                    feature.encode('utf-8'), digest_size=8
+                ).digest()
+                value = int.from_bytes(digest, 'little')
+                sign = 1.0 if value >> 63 else -1.0
+                embeddings[row, value % self.dim] += sign
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+class SentenceTransformerEmbedder(Embedder):
+    """
+    Local CPU embedder running a sentence-transformers model loaded from
+    a local path, so no network access is needed at build or query
+    time. Requires the optional sentence-transformers package.
+    """
+
+    max_batch_size = 64
+    max_batch_tokens = 10_000_000
+    max_workers = 1
+
+    def __init__(
+        self,
+        model_path: str,
+        device: str = 'cpu'
+    ) -> None:
+        """
+        Loads the model.
+
+        Args:
+            model_path (str): Path to the saved model folder.
+            device (str): Torch device to run on. Default is 'cpu'.
+        """
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                'The sentence-transformers backend needs the '
+                'sentence-transformers package: '
+                'pip install sentence-transformers'
+            ) from e
+
+        self.model = SentenceTransformer(model_path, device=device)
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.model_id = f'sentence-transformers:{model_path}'
+
+    def embed_batch(
+        self,
+        texts: list[str]
+    ) -> np.ndarray:
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.max_batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        )
+
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+EMBEDDERS: dict[str, Callable[..., Embedder]] = {
+    'openai': OpenAIEmbedder,
+    'hashing': HashingEmbedder,
+    'sentence-transformers': SentenceTransformerEmbedder
+}
+
+
+def register_embedder(
+    backend: str,
+    factory: Callable[..., Embedder]
+) -> None:
+    """
+    Registers an embedding backend under a name.
+
+    Args:
+        backend (str): Name of the backend.
+        factory (Callable[..., Embedder]): Creates the embedder from
+            keyword options.
+    """
+    EMBEDDERS[backend] = factory
+
+
+def make_embedder(
+    backend: str,
+    options: dict = None,
+    client: OpenAI = None
+) -> Embedder:
+    """
+    Creates an embedder from the registry.
+
+    Args:
+        backend (str): Name of a registered backend.
+        options (dict): Keyword options of the backend, e.g.
+            {'model_name': 'text-embedding-3-small'} or {'dim': 1024}.
+            Default is None.
+        client (OpenAI): OpenAI client, required by the 'openai'
+            backend only. Default is None.
+
+    Returns:
+        Embedder: The embedder.
+    """
+    if backend not in EMBEDDERS:
+        raise ValueError(
+            f'Unknown embedder backend {backend!r}, expected one of '
+            f'{sorted(EMBEDDERS)}.'
+        )
+
+    kwargs = dict(options or {})
+    if backend == 'openai':
+        if client is None:
+            raise ValueError('The openai embedder backend needs a client.')
+        kwargs['client'] = client
+
+    embedder = EMBEDDERS[backend](**kwargs)
+    embedder.spec = {'backend': backend, 'options': dict(options or {})}
+
+    return embedder
+
+
+def embedder_spec(
+    info: dict
+) -> dict:
+    """
+    Returns the backend and options an index was built with.
+
+    Args:
+        info (dict): Index info saved with the index.
+
+    Returns:
+        dict: {'backend': ..., 'options': ...}. Indices built before
+            the spec was recorded used OpenAI's text-embedding-3-small.
+    """
+    return info.get('embedder') or {
+        'backend': 'openai',
+        'options': {'model_name': 'text-embedding-3-small'}
+    }
+
+
+def embedder_from_info(
+    info: dict,
+    client: OpenAI = None
+) -> Embedder:
+    """
+    Recreates the embedder an index was built with.
+
+    Args:
+        info (dict): Index info saved with the index.
+        client (OpenAI): OpenAI client, needed if the index was built
+            with the 'openai' backend. Default is None.
+
+    Returns:
+        Embedder: The embedder.
+    """
+    spec = embedder_spec(info)
+
+    return make_embedder(spec['backend'], spec['options'], client)
+
+
+def check_embedder(
+    embedder: Embedder,
+    info: dict
+) -> None:
+    """
+    Checks that an embedder produces vectors compatible with an index.
+
+    Args:
+        embedder (Embedder): The embedder used for queries or updates.
+        info (dict): Index info saved with the index.
+
+    Raises:
+        ValueError: If the model ID or dimension differ.
+    """
+    # Indices built before model IDs were recorded used OpenAI's
+    # text-embedding-3-small.
+    expected = (
+        info.get('model_id', 'text-embedding-3-small'), info.get('dim')
+    )
+
+    if (embedder.model_id, embedder.dim) != expected:
+        raise ValueError(
+            f'Embedder {embedder.model_id} (dim {embedder.dim}) does not '
+            f'match the index, built with {expected[0]} (dim '
+            f'{expected[1]}). Rebuild the index or configure the same '
+            'embedder.'
+        )
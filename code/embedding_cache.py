@@ -0,0 +1,228 @@
+"""
+Persistent, content-addressed cache of text embeddings backed by SQLite.
+
+Embeddings are keyed by (model name, SHA-256 of the text), so unchanged
+chunks are never sent to the embedding API twice. The cache is bounded
+by size and evicts the least recently used entries first.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+import tracing
+
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def _hash_text(
+    text: str
+) -> str:
+    """
+    Hashes a text for use as a cache key.
+
+    Args:
+        text (str): The text to hash.
+
+    Returns:
+        str: Hex SHA-256 digest of the text.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite-backed embedding cache with hit/miss statistics and
+    size-based LRU eviction. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = DEFAULT_MAX_BYTES
+    ) -> None:
+        """
+        Opens (or creates) the cache database.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            max_bytes (int): Maximum total size of stored vectors in
+                bytes. Default is DEFAULT_MAX_BYTES (2 GiB).
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'model TEXT NOT NULL, '
+            'text_hash TEXT NOT NULL, '
+            'vector BLOB NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'last_access REAL NOT NULL, '
+            'PRIMARY KEY (model, text_hash))'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_last_access '
+            'ON embeddings (last_access)'
+        )
+        self._conn.commit()
+
+    def get_many(
+        self,
+        model_name: str,
+        texts: list[str]
+    ) -> list[np.ndarray | None]:
+        """
+        Looks up the embeddings of several texts.
+
+        Args:
+            model_name (str): Name of the embedding model.
+            texts (list[str]): Texts to look up.
+
+        Returns:
+            list[np.ndarray | None]: Cached embedding for each text, or
+                None for a miss.
+        """
+        hashes = [_hash_text(text) for text in texts]
+        found = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                batch = list(set(hashes[i:i + 500]))
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(
+                    'SELECT text_hash, vector FROM embeddings '
+                    f'WHERE model = ? AND text_hash IN ({placeholders})',
+                    [model_name, *batch]
+                ).fetchall()
+                found.update(rows)
+
+            now = time.time()
+            self._conn.executemany(
+                'UPDATE embeddings SET last_access = ? '
+                'WHERE model = ? AND text_hash = ?',
+                [(now, model_name, h) for h in found]
+            )
+            self._conn.commit()
+
+            results = []
+            for h in hashes:
+                if h in found:
+                    self.hits += 1
+                    results.append(np.frombuffer(found[h], dtype=np.float32))
+                else:
+                    self.misses += 1
+                    results.append(None)
+
+        hits = sum(result is not None for result in results)
+        tracing.count('cache_lookups_total', hits, cache='embedding', hit=True)
+        tracing.count(
+            'cache_lookups_total', len(results) - hits,
+            cache='embedding', hit=False
+        )
+
+        return results
+
+    def put_many(
+        self,
+        model_name: str,
+        texts: list[str],
+        embeddings: np.ndarray
+    ) -> None:
+        """
+        Stores the embeddings of several texts, then evicts old entries
+        if the cache is over its size limit.
+
+        Args:
+            model_name (str): Name of the embedding model.
+            texts (list[str]): Texts that were embedded.
+            embeddings (np.ndarray): Embeddings, one row per text.
+        """
+        now = time.time()
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32).tobytes()
+            rows.append(
+                (model_name, _hash_text(text), vector, len(vector), now)
+            )
+
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings '
+                '(model, text_hash, vector, size, last_access) '
+                'VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            self._conn.commit()
+            self._evict()
+
+    def _evict(self) -> None:
+        """
+        Deletes least recently used entries until the total size is
+        within max_bytes. Must be called with the lock held.
+        """
+        total = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM embeddings'
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        excess = total - self.max_bytes
+        victims = []
+        cursor = self._conn.execute(
+            'SELECT model, text_hash, size FROM embeddings '
+            'ORDER BY last_access ASC'
+        )
+        for model_name, text_hash, size in cursor:
+            victims.append((model_name, text_hash))
+            excess -= size
+            if excess <= 0:
+                break
+
+        self._conn.executemany(
+            'DELETE FROM embeddings WHERE model = ? AND text_hash = ?',
+            victims
+        )
+        self._conn.commit()
+        self.evictions += len(victims)
+
+    def stats(self) -> dict:
+        """
+        Returns cache statistics.
+
+        Returns:
+            dict: Hits, misses, hit rate, evictions, number of entries
+                and total stored bytes.
+        """
+        with self._lock:
+            entries, size = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embeddings'
+            ).fetchone()
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size
+        }
+
+    def close(self) -> None:
+        """
+        Closes the underlying database connection.
+        """
+        with self._lock:
+            self._conn.close()
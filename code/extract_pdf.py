@@ -1,109 +1,500 @@
 """
-Extracts text from PDF files in a specified folder, splits the text 
-into chunks, and saves the chunks along with metadata into JSON files.
+Extracts text from PDF files, splits the text into chunks, and streams
+the chunks along with metadata to the caller.
 """
 
 import os
 import json
+import time
+import hashlib
+import weakref
+import threading
+import multiprocessing
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import (
+    Future,
+    Executor,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor
+)
+from concurrent.futures.process import BrokenProcessPool
 
 import fitz # PyMuPDF
-from tqdm import tqdm
 
 
-def _extract_pdf_chunks(
+PAGES_PER_TASK = 50
+
+# PyMuPDF is not thread-safe, and several extractions in threads
+# (max_workers=1) may run at once, so documents are opened one at a time
+# in a process. Worker processes each have their own lock.
+_FITZ_LOCK = threading.Lock()
+
+
+class WorkerCrashError(Exception):
+    """
+    A task whose worker process died again after it was retried.
+    """
+
+
+def make_chunk_id(
+    file_path: str,
+    page_num: int,
+    chunk_num: int
+) -> int:
+    """
+    Derives a stable 63-bit ID for a chunk, used as its FAISS vector ID.
+
+    Args:
+        file_path (str): Absolute path to the source PDF.
+        page_num (int): Page number of the chunk (1-indexed).
+        chunk_num (int): Position of the chunk within the page.
+
+    Returns:
+        int: Non-negative 63-bit chunk ID.
+    """
+    key = f'{file_path}\0{page_num}\0{chunk_num}'.encode('utf-8')
+    digest = hashlib.sha1(key).digest()
+
+    return int.from_bytes(digest[:8], 'big') >> 1
+
+
+def _extract_page_range(
     pdf_path: str,
+    start: int = 0,
+    end: int = None,
     chunk_size: int = 500,
     chunk_overlap: int = 50
-) -> list[dict]:
+) -> tuple[list[dict], int, float, int]:
     """
-    Extracts text from a PDF and splits it into chunks with metadata.
+    Extracts text from a range of pages of a PDF and splits it into
+    chunks with metadata. Runs in worker processes, so it only takes
+    and returns picklable values. The PDF is only ever opened here, so
+    a file crashing MuPDF takes down a worker rather than the caller.
 
     Args:
         pdf_path (str): Path to the PDF file.
-        chunk_size (int): Maximum number of words in each chunk. 
+        start (int): First page to extract (0-indexed). Default is 0.
+        end (int): Page to stop before (0-indexed). Default is None
+            (the last page).
+        chunk_size (int): Maximum number of words in each chunk.
             Default is 500.
         chunk_overlap (int): Number of overlapping words between chunks.
             Default is 50.
 
     Returns:
-        list[dict]: List of dictionaries containing text chunks and 
-            metadata.
+        tuple[list[dict], int, float, int]: Chunks with metadata,
+            number of pages processed, elapsed time in seconds, and
+            number of pages of the PDF.
     """
+    begin = time.perf_counter()
     chunks = []
     file_name = os.path.basename(pdf_path)
     file_path = os.path.abspath(pdf_path)
 
-    doc = fitz.open(pdf_path)
-    for page_num, page in enumerate(doc, start=1):
-        text = page.get_text()
-        if not text.strip():
-            continue
-
-        words = text.split()
-        for i in range(0, len(words), chunk_size - chunk_overlap):
-            chunk = ' '.join(words[i:i + chunk_size])
-            chunks.append({
-                'content': chunk,
-                'metadata': {
-                    'source': file_name,
-                    'path': file_path,
-                    'page_number': page_num
-                }
-            })
+    with _FITZ_LOCK, fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+        end = page_count if end is None else min(end, page_count)
+        for page_idx in range(start, end):
+            page_num = page_idx + 1
+            text = doc.load_page(page_idx).get_text()
+            if not text.strip():
+                continue
 
-    return chunks
+            words = text.split()
+            starts = range(0, len(words), chunk_size - chunk_overlap)
+            for chunk_num, i in enumerate(starts):
+                chunk = ' '.join(words[i:i + chunk_size])
+                chunks.append({
+                    'id': make_chunk_id(file_path, page_num, chunk_num),
+                    'content': chunk,
+                    'metadata': {
+                        'source': file_name,
+                        'path': file_path,
+                        'page_number': page_num
+                    }
+                })
 
+    return (
+        chunks,
+        max(end - start, 0),
+        time.perf_counter() - begin,
+        page_count
+    )
 
-def extract_folder(
-    folder_path: str,
-    output_dir: str
-) -> None:
+
+class ExtractPool(Executor):
     """
-    Processes all PDF files in a folder, extracts text chunks, and saves
-    them as JSON files.
-    
-    Args:
-        folder_path (str): Path to the folder containing PDF files.
-        output_dir (str): Directory path to save the JSON files.
+    Pool that extract_stream extracts pages on. A worker dying, e.g.
+    crashing inside MuPDF on a malformed PDF, breaks a process pool for
+    every pending and later task; the pool is then replaced, so one bad
+    file does not fail the extractions sharing it. The broken tasks are
+    retried in processes of their own, so a task crashing again breaks
+    only itself. Thread-safe.
     """
-    os.makedirs(output_dir, exist_ok=True)
 
-    pdf_files = [
-        f for f in os.listdir(folder_path) if f.lower().endswith('.pdf')
-    ]
-    for pdf_file in tqdm(pdf_files):
-        pdf_path = os.path.join(folder_path, pdf_file)
-        chunks = _extract_pdf_chunks(pdf_path)
+    def __init__(
+        self,
+        max_workers: int = None
+    ) -> None:
+        """
+        Creates the pool.
 
-        output_path = os.path.join(
-            output_dir, pdf_file.replace('.pdf', '.json')
+        Args:
+            max_workers (int): Number of worker processes. 1 extracts
+                in a thread of the current process. Default is None
+                (one per CPU).
+        """
+        self.max_workers = max_workers
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = self._create()
+        # Threads each running one retried task in its own process, up
+        # to max_workers at once.
+        self._retries = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='extract-retry'
         )
-        with open(output_path, 'w', encoding='utf-8') as fout:
-            json.dump(chunks, fout, ensure_ascii=False, indent=4)
+        # Futures of the current pool, telling a broken future of it
+        # from one of a pool that was replaced already.
+        self._futures = weakref.WeakSet()
+
+    def _create(self) -> Executor:
+        """
+        Creates the underlying pool.
+
+        Returns:
+            Executor: The pool.
+        """
+        if self.max_workers == 1:
+            return ThreadPoolExecutor(max_workers=1)
+
+        # Workers are spawned rather than forked, as callers may run
+        # this from a thread while other threads hold locks.
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+    def _replace(self) -> None:
+        """
+        Replaces the broken pool. Must be called with the lock held.
+        """
+        # The tasks of a broken pool have all failed already, so it is
+        # not waited on.
+        self._executor.shutdown(wait=False)
+        self._executor = self._create()
+        self._futures = weakref.WeakSet()
+        self.restarts += 1
+        print('An extraction worker died; restarted the extraction pool.')
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        """
+        Schedules a task, replacing the pool first if it is broken.
+
+        Args:
+            fn (Callable): Picklable function to run.
+            *args: Its positional arguments.
+            **kwargs: Its keyword arguments.
+
+        Returns:
+            Future: The task's future.
+        """
+        with self._lock:
+            try:
+                future = self._executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                self._replace()
+                future = self._executor.submit(fn, *args, **kwargs)
+            self._futures.add(future)
+
+            return future
+
+    def retry(self, fn, /, *args, **kwargs) -> Future:
+        """
+        Schedules a task broken by a dying worker again, in a process
+        of its own.
+
+        Args:
+            fn (Callable): Picklable function to run.
+            *args: Its positional arguments.
+            **kwargs: Its keyword arguments.
+
+        Returns:
+            Future: The task's future, failing with BrokenProcessPool
+                if the task's process dies.
+        """
+        def run():
+            executor = ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context('spawn')
+            )
+            try:
+                return executor.submit(fn, *args, **kwargs).result()
+            finally:
+                executor.shutdown()
+
+        return self._retries.submit(run)
+
+    def restart(
+        self,
+        future: Future
+    ) -> None:
+        """
+        Replaces the pool after a task failed with BrokenProcessPool,
+        unless that pool was replaced already.
 
+        Args:
+            future (Future): The failed task's future.
+        """
+        with self._lock:
+            if future in self._futures:
+                self._replace()
 
-def merge_chunks(
-    chunk_dir: str,
-    output_path: str
+    def shutdown(
+        self,
+        wait: bool = True,
+        *,
+        cancel_futures: bool = False
+    ) -> None:
+        """
+        Shuts the pool down.
+
+        Args:
+            wait (bool): Whether to wait for running tasks. Default is
+                True.
+            cancel_futures (bool): Whether to cancel pending tasks.
+                Default is False.
+        """
+        with self._lock:
+            executor = self._executor
+        executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+        self._retries.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+def make_extract_executor(
+    max_workers: int = None
+) -> ExtractPool:
+    """
+    Creates the pool that extract_stream extracts pages on, e.g. to
+    share one pool between several concurrent extractions.
+
+    Args:
+        max_workers (int): Number of worker processes. 1 extracts in
+            a thread of the current process. Default is None (one per
+            CPU).
+
+    Returns:
+        ExtractPool: The pool.
+    """
+    return ExtractPool(max_workers)
+
+
+def extract_stream(
+    pdf_paths: Iterable[str],
+    max_workers: int = None,
+    pages_per_task: int = PAGES_PER_TASK,
+    max_pending: int = None,
+    executor: Executor = None
+) -> Iterator[tuple[str, list[dict] | None, dict]]:
+    """
+    Extracts PDFs on a pool of worker processes and yields the chunks
+    of one file at a time, in input order.
+
+    PDFs are split into page-range tasks, of which at most max_pending
+    are in flight, so only a bounded window of files is held in memory
+    however many are processed. Files are only opened by the workers:
+    the first task of a file also counts its pages, and the rest of a
+    large file is scheduled once that task is done. A file that fails
+    to open or extract is reported without aborting the run. Chunks
+    are always in page order, regardless of which worker finished
+    first.
+
+    If a worker dies, the pool is replaced and the tasks it broke are
+    retried once, each in a process of its own. A task crashing again
+    raises, failing only this extraction.
+
+    Args:
+        pdf_paths (Iterable[str]): Paths to the PDF files.
+        max_workers (int): Number of worker processes. 1 extracts in
+            a thread of the current process. Default is None (one per
+            CPU).
+        pages_per_task (int): Maximum number of pages per task.
+            Default is PAGES_PER_TASK.
+        max_pending (int): Maximum number of tasks in flight. Default
+            is None (twice the number of workers).
+        executor (ExtractPool): Pool made by make_extract_executor to
+            extract on instead of creating one, e.g. shared with other
+            extractions. It is not shut down. Default is None.
+
+    Yields:
+        tuple[str, list[dict] | None, dict]: Path of the PDF, its
+            chunks (None if it failed), and its report entry with
+            pages, chunks and seconds, or the error.
+
+    Raises:
+        WorkerCrashError: If a retried task crashed again.
+    """
+    if max_pending is None:
+        max_pending = 2 * (max_workers or os.cpu_count() or 1)
+
+    shared = executor is not None
+    if not shared:
+        executor = make_extract_executor(max_workers)
+    pending = deque()
+    in_flight = 0
+    paths = iter(pdf_paths)
+
+    def submit(pdf_path: str, start: int) -> dict:
+        return {
+            'start': start,
+            'end': start + pages_per_task,
+            'future': executor.submit(
+                _extract_page_range, pdf_path, start, start + pages_per_task
+            ),
+            'retried': False
+        }
+
+    def expand(pdf_path: str, tasks: list[dict], page_count: int) -> int:
+        # Schedules the remaining page ranges of a file once its first
+        # task counted the pages.
+        tasks[0]['expanded'] = True
+        more = [
+            submit(pdf_path, start)
+            for start in range(pages_per_task, page_count, pages_per_task)
+        ]
+        tasks.extend(more)
+
+        return len(more)
+
+    def result(
+        pdf_path: str,
+        task: dict
+    ) -> tuple[list[dict], int, float, int]:
+        try:
+            return task['future'].result()
+        except BrokenProcessPool:
+            if task['retried']:
+                raise WorkerCrashError(
+                    f'An extraction worker died twice on pages '
+                    f'{task["start"] + 1}-{task["end"]} of {pdf_path}.'
+                ) from None
+
+        # Every task in the dead pool is broken; they are all retried at
+        # once rather than as each is reached.
+        executor.restart(task['future'])
+        for path, tasks in [(pdf_path, [task]), *pending]:
+            for other in tasks:
+                future = other['future']
+                if (
+                    not other['retried'] and future.done()
+                    and isinstance(future.exception(), BrokenProcessPool)
+                ):
+                    other['future'] = executor.retry(
+                        _extract_page_range, path,
+                        other['start'], other['end']
+                    )
+                    other['retried'] = True
+
+        return result(pdf_path, task)
+
+    try:
+        while True:
+            for path, tasks in pending:
+                first = tasks[0]['future']
+                if (
+                    not tasks[0]['expanded'] and first.done()
+                    and first.exception() is None
+                ):
+                    in_flight += expand(path, tasks, first.result()[3])
+            for pdf_path in paths:
+                tasks = [{**submit(pdf_path, 0), 'expanded': False}]
+                pending.append((pdf_path, tasks))
+                in_flight += 1
+                if in_flight >= max_pending:
+                    break
+            if not pending:
+                return
+
+            pdf_path, tasks = pending.popleft()
+            in_flight -= len(tasks)
+            error = None
+            chunks = []
+            pages = 0
+            seconds = 0.0
+            # Grows while iterated if the first task schedules the rest.
+            for i, task in enumerate(tasks):
+                try:
+                    part, num_pages, elapsed, page_count = result(
+                        pdf_path, task
+                    )
+                except WorkerCrashError:
+                    # Not yet collected, so not cancelled below.
+                    pending.appendleft((pdf_path, tasks[i + 1:]))
+                    raise
+                except Exception as e:
+                    error = error or f'{type(e).__name__}: {e}'
+                    continue
+                if i == 0 and not task['expanded']:
+                    expand(pdf_path, tasks, page_count)
+                chunks.extend(part)
+                pages += num_pages
+                seconds += elapsed
+
+            if error is not None:
+                yield pdf_path, None, {'error': error}
+            else:
+                yield pdf_path, chunks, {
+                    'pages': pages,
+                    'chunks': len(chunks),
+                    'seconds': round(seconds, 4)
+                }
+    finally:
+        if shared:
+            for _, tasks in pending:
+                for task in tasks:
+                    task['future'].cancel()
+        else:
+            executor.shutdown(cancel_futures=True)
+
+
+def report_extraction(
+    report: dict[str, dict],
+    elapsed: float,
+    report_path: str = None
 ) -> None:
     """
-    Merges all JSON chunk files in a directory into a single JSON
-    file.
+    Prints a summary of an extraction run and optionally saves the
+    full report.
 
     Args:
-        chunk_dir (str): Directory containing JSON chunk files.
-        output_path (str): Path to save the merged JSON file.
+        report (dict[str, dict]): Report entry of each PDF file, as
+            yielded by extract_stream.
+        elapsed (float): Wall-clock time of the run in seconds.
+        report_path (str): Path to save a JSON report of per-file
+            pages, chunks, timings and errors. Default is None.
     """
-    all_chunks = []
-
-    json_files = [
-        f for f in os.listdir(chunk_dir) if f.lower().endswith('.json')
-    ]
-    for json_file in tqdm(json_files):
-        json_path = os.path.join(chunk_dir, json_file)
-        with open(json_path, 'r', encoding='utf-8') as fin:
-            chunks = json.load(fin)
-            all_chunks.extend(chunks)
-
-    with open(output_path, 'w', encoding='utf-8') as fout:
-        json.dump(all_chunks, fout, ensure_ascii=False, indent=4)
+    errors = {
+        pdf_file: entry['error']
+        for pdf_file, entry in report.items() if 'error' in entry
+    }
+    total_pages = sum(entry.get('pages', 0) for entry in report.values())
+
+    print(f'Extracted {total_pages} pages from '
+          f'{len(report) - len(errors)} PDFs in {elapsed:.2f}s '
+          f'({total_pages / max(elapsed, 1e-9):.1f} pages/s).')
+    slowest = sorted(
+        (entry['seconds'], pdf_file) for pdf_file, entry in report.items()
+        if 'seconds' in entry
+    )[-5:]
+    for seconds, pdf_file in reversed(slowest):
+        print(f'  {seconds:8.2f}s  {pdf_file}')
+    for pdf_file, error in errors.items():
+        print(f'Failed to extract {pdf_file}: {error}')
+
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as fout:
+            json.dump({
+                'pages': total_pages,
+                'seconds': round(elapsed, 4),
+                'pages_per_second': total_pages / max(elapsed, 1e-9),
+                'files': report
+            }, fout, ensure_ascii=False, indent=4)
@@ -1,45 +1,669 @@
 """
 Builds a FAISS index from .npy embeddings and saves it to disk.
+
+Besides the exact flat index, approximate IVF, HNSW and IVF-PQ indices
+are supported. Flat, IVF and HNSW indices can also store their vectors
+quantized (float16, int8 or product quantization) to cut memory; the
+top candidates of a search are then rescored against the full-precision
+embeddings of the chunk store. The index type and its build/search
+parameters are saved next to the index in a JSON sidecar, together with
+a recall@k vs. exact search report measured at build time.
 """
 
+import os
+import json
+import time
+import math
+import threading
+
 import faiss
 import numpy as np
 
+from faiss_search import make_search_parameters
+
+
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'ivfpq')
+
+# Vector encodings of the 'quantization' parameter: 2 bytes, 1 byte or
+# pq_m * pq_nbits / 8 bytes per vector instead of 4 bytes per dimension.
+QUANTIZATIONS = ('fp16', 'int8', 'pq')
+
+# Candidates fetched per result and rescored with full-precision
+# vectors when the index is quantized.
+RESCORE_FACTOR = 4
+
+FLAT_MAX_VECTORS = 20_000
+IVF_MAX_VECTORS = 1_000_000
+
+RECALL_K = 10
+RECALL_QUERIES = 200
+TARGET_RECALL = 0.95
+
+SEARCH_PARAM_SWEEP = {
+    'nprobe': (1, 2, 4, 8, 16, 32, 64, 128, 256),
+    'efSearch': (16, 32, 64, 128, 256, 512)
+}
+
+
+def choose_index_type(
+    num_vectors: int
+) -> str:
+    """
+    Picks an index type for a corpus size: exact search while a scan is
+    cheap, IVF for medium corpora and IVF-PQ once vectors no longer
+    comfortably fit in RAM.
+
+    Args:
+        num_vectors (int): Number of vectors to index.
+
+    Returns:
+        str: One of INDEX_TYPES.
+    """
+    if num_vectors <= FLAT_MAX_VECTORS:
+        return 'flat'
+    if num_vectors <= IVF_MAX_VECTORS:
+        return 'ivf'
+
+    return 'ivfpq'
+
+
+def _pq_params(
+    num_vectors: int,
+    dim: int
+) -> dict:
+    """
+    Returns default product quantization parameters.
+
+    Args:
+        num_vectors (int): Number of vectors to index.
+        dim (int): Dimension of the vectors.
+
+    Returns:
+        dict: pq_m sub-quantizers of pq_nbits bits each.
+    """
+    # Sub-quantizers of at least 8 dimensions each (96 x 16 for 1536-d
+    # embeddings).
+    pq_m = next(
+        (m for m in (96, 64, 48, 32, 16, 8, 4, 2)
+         if dim % m == 0 and dim // m >= 8),
+        1
+    )
+    pq_nbits = max(1, min(8, int(math.log2(max(num_vectors, 2)))))
+
+    return {'pq_m': pq_m, 'pq_nbits': pq_nbits}
+
+
+def default_params(
+    index_type: str,
+    num_vectors: int,
+    dim: int,
+    quantization: str = None
+) -> dict:
+    """
+    Returns default build and search parameters for an index type.
+
+    Args:
+        index_type (str): One of INDEX_TYPES.
+        num_vectors (int): Number of vectors to index.
+        dim (int): Dimension of the vectors.
+        quantization (str): One of QUANTIZATIONS, or None to store full
+            vectors. Ignored by IVF-PQ indices, which always use
+            product quantization. Default is None.
+
+    Returns:
+        dict: Parameters (nlist, nprobe, M, efConstruction, efSearch,
+            pq_m, pq_nbits, rescore) relevant to the index type.
+    """
+    if index_type in ('ivf', 'ivfpq'):
+        # Keep at least ~39 training points per centroid.
+        nlist = int(4 * math.sqrt(num_vectors))
+        nlist = max(1, min(nlist, num_vectors // 39, 65536))
+        params = {'nlist': nlist, 'nprobe': max(1, nlist // 16)}
+    elif index_type == 'hnsw':
+        params = {'M': 32, 'efConstruction': 40, 'efSearch': 64}
+    else:
+        params = {}
+
+    if index_type == 'ivfpq' or quantization == 'pq':
+        params.update(_pq_params(num_vectors, dim))
+    if index_type == 'ivfpq' or quantization is not None:
+        params['rescore'] = RESCORE_FACTOR
+
+    return params
+
+
+def index_info_path(
+    index_path: str
+) -> str:
+    """
+    Returns the path of the JSON sidecar describing an index.
+
+    Args:
+        index_path (str): Path to the FAISS index file.
+
+    Returns:
+        str: Path to the sidecar JSON file.
+    """
+    return os.path.splitext(index_path)[0] + '.json'
+
+
+def load_index_info(
+    index_path: str
+) -> dict:
+    """
+    Loads the sidecar describing an index.
+
+    Args:
+        index_path (str): Path to the FAISS index file.
+
+    Returns:
+        dict: Index type, parameters and recall report, or a flat index
+            description for indices built before sidecars existed.
+    """
+    info_path = index_info_path(index_path)
+    if not os.path.exists(info_path):
+        return {'index_type': 'flat', 'params': {}}
+
+    with open(info_path, 'r', encoding='utf-8') as fin:
+        return json.load(fin)
+
+
+def _save_index_info(
+    info: dict,
+    index_path: str
+) -> None:
+    """
+    Atomically saves the sidecar describing an index, like the index
+    itself.
+
+    Args:
+        info (dict): Index description.
+        index_path (str): Path to the FAISS index file.
+    """
+    path = index_info_path(index_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fout:
+        json.dump(info, fout, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _scalar_quantizer_type(
+    quantization: str
+) -> int:
+    """
+    Returns the FAISS scalar quantizer type of a quantization.
+
+    Args:
+        quantization (str): 'fp16' or 'int8'.
+
+    Returns:
+        int: The faiss.ScalarQuantizer quantizer type.
+    """
+    if quantization == 'fp16':
+        return faiss.ScalarQuantizer.QT_fp16
+
+    return faiss.ScalarQuantizer.QT_8bit
+
+
+def _create_index(
+    index_type: str,
+    dim: int,
+    params: dict
+) -> faiss.Index:
+    """
+    Creates an empty inner-product index that accepts explicit IDs.
+    IVF indices store IDs natively; the others are wrapped in an
+    IndexIDMap2.
+
+    Args:
+        index_type (str): One of INDEX_TYPES.
+        dim (int): Dimension of the vectors.
+        params (dict): Build parameters of the index type, with an
+            optional 'quantization' (one of QUANTIZATIONS).
+
+    Returns:
+        faiss.Index: The untrained, empty index.
+
+    Raises:
+        ValueError: If the quantization is unknown.
+    """
+    metric = faiss.METRIC_INNER_PRODUCT
+    quantization = params.get('quantization')
+    if quantization is not None and quantization not in QUANTIZATIONS:
+        raise ValueError(f'Unknown quantization: {quantization}')
+    if quantization == 'pq' and index_type == 'ivf':
+        index_type = 'ivfpq'
+
+    if index_type == 'ivf':
+        quantizer = faiss.IndexFlatIP(dim)
+        if quantization is not None:
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dim, params['nlist'],
+                _scalar_quantizer_type(quantization), metric
+            )
+        else:
+            index = faiss.IndexIVFFlat(
+                quantizer, dim, params['nlist'], metric
+            )
+        index.nprobe = params['nprobe']
+        return index
+
+    if index_type == 'ivfpq':
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(
+            quantizer, dim, params['nlist'],
+            params['pq_m'], params['pq_nbits'], metric
+        )
+        index.nprobe = params['nprobe']
+        return index
+
+    if index_type == 'hnsw':
+        if quantization == 'pq':
+            index = faiss.IndexHNSWPQ(
+                dim, params['pq_m'], params['M'], params['pq_nbits'], metric
+            )
+        elif quantization is not None:
+            index = faiss.IndexHNSWSQ(
+                dim, _scalar_quantizer_type(quantization), params['M'],
+                metric
+            )
+        else:
+            index = faiss.IndexHNSWFlat(dim, params['M'], metric)
+        index.hnsw.efConstruction = params['efConstruction']
+        index.hnsw.efSearch = params['efSearch']
+        return faiss.IndexIDMap2(index)
+
+    if quantization == 'pq':
+        index = faiss.IndexPQ(
+            dim, params['pq_m'], params['pq_nbits'], metric
+        )
+    elif quantization is not None:
+        index = faiss.IndexScalarQuantizer(
+            dim, _scalar_quantizer_type(quantization), metric
+        )
+    else:
+        index = faiss.IndexFlatIP(dim)
+
+    return faiss.IndexIDMap2(index)
+
+
+def _search_param_name(
+    index_type: str
+) -> str | None:
+    """
+    Returns the name of the main search-time parameter of an index
+    type.
+
+    Args:
+        index_type (str): One of INDEX_TYPES.
+
+    Returns:
+        str | None: 'nprobe', 'efSearch', or None for exact search.
+    """
+    if index_type in ('ivf', 'ivfpq'):
+        return 'nprobe'
+    if index_type == 'hnsw':
+        return 'efSearch'
+
+    return None
+
+
+def evaluate_recall(
+    index: faiss.Index,
+    embeddings: np.ndarray,
+    ids: np.ndarray,
+    index_type: str,
+    params: dict,
+    k: int = RECALL_K,
+    num_queries: int = RECALL_QUERIES
+) -> list[dict]:
+    """
+    Measures recall@k and query latency of an index against exact
+    search, sweeping its search-time parameter. A quantized flat index
+    has no such parameter and is measured once.
+
+    Args:
+        index (faiss.Index): The index to evaluate.
+        embeddings (np.ndarray): Normalized embeddings in the index.
+        ids (np.ndarray): IDs of the embeddings.
+        index_type (str): One of INDEX_TYPES.
+        params (dict): Build parameters of the index.
+        k (int): Number of neighbors compared. Default is RECALL_K.
+        num_queries (int): Number of sampled queries. Default is
+            RECALL_QUERIES.
+
+    Returns:
+        list[dict]: One row per parameter value with 'param', 'value'
+            (both None for a flat index), 'recall' and 'ms_per_query'.
+    """
+    name = _search_param_name(index_type)
+    if name is None and params.get('quantization') is None:
+        return []
+    if len(embeddings) == 0:
+        return []
+
+    rng = np.random.default_rng(0)
+    sample = rng.choice(
+        len(embeddings), min(num_queries, len(embeddings)), replace=False
+    )
+    queries = np.ascontiguousarray(embeddings[sample])
+    k = min(k, len(embeddings))
+
+    exact = faiss.IndexFlatIP(embeddings.shape[1])
+    exact.add(embeddings)
+    _, truth = exact.search(queries, k)
+    truth = ids[truth]
+
+    values = [None] if name is None else [
+        value for value in SEARCH_PARAM_SWEEP[name]
+        if name != 'nprobe' or value <= params['nlist']
+    ]
+    report = []
+    for value in values:
+        search_params = make_search_parameters(
+            index, {name: value} if name is not None else None
+        )
+        start = time.perf_counter()
+        _, found = index.search(queries, k, params=search_params)
+        elapsed = time.perf_counter() - start
+
+        hits = sum(
+            len(set(row_found) & set(row_truth))
+            for row_found, row_truth in zip(found, truth)
+        )
+        report.append({
+            'param': name,
+            'value': value,
+            'recall': hits / truth.size,
+            'ms_per_query': elapsed * 1000 / len(queries)
+        })
+
+    return report
+
+
+def _train_and_add(
+    index: faiss.Index,
+    embeddings: np.ndarray,
+    ids: np.ndarray
+) -> None:
+    """
+    Trains an index if needed and adds embeddings under their IDs.
+
+    Args:
+        index (faiss.Index): The empty index.
+        embeddings (np.ndarray): Normalized embeddings to add.
+        ids (np.ndarray): IDs of the embeddings.
+    """
+    if not index.is_trained:
+        print(f'Training index on {len(embeddings)} vectors...')
+        index.train(embeddings)
+    index.add_with_ids(embeddings, ids)
+
 
 def build_faiss_index(
-    embeddings_path: str, 
-    output_path: str
+    embeddings_path: str,
+    output_path: str,
+    ids_path: str = None,
+    index_type: str = 'auto',
+    params: dict = None,
+    target_recall: float = TARGET_RECALL,
+    embedder_info: dict = None
 ) -> None:
     """
     Builds a FAISS index from .npy embeddings and saves it to disk.
 
     Args:
-        embeddings_path (str): Path to the .npy file containing 
+        embeddings_path (str): Path to the .npy file containing
             embeddings.
         output_path (str): Path to save the FAISS index file.
+        ids_path (str): Path to the .npy file of chunk IDs aligned with
+            the embeddings. If given, vectors are stored under these
+            IDs so they can later be removed or replaced individually.
+            Default is None (IDs are row positions).
+        index_type (str): One of INDEX_TYPES, or 'auto' to choose by
+            corpus size. Default is 'auto'.
+        params (dict): Build/search parameters overriding the defaults
+            (nlist, nprobe, M, efConstruction, efSearch, pq_m,
+            pq_nbits). Default is None.
+        target_recall (float): If the search parameter was not given
+            explicitly, the smallest swept value reaching this recall@k
+            is saved as the default. Default is TARGET_RECALL.
+        embedder_info (dict): Embedder.info() of the embedder that
+            produced the embeddings, saved with the index so queries
+            use the same model. Default is None.
     """
     print(f'Loading embeddings from {embeddings_path}...')
     embeddings = np.load(embeddings_path).astype('float32')
     print(f'Loaded {embeddings.shape[0]} embeddings of dimension '
           f'{embeddings.shape[1]}.')
-    
+    if ids_path:
+        ids = np.load(ids_path).astype(np.int64)
+    else:
+        ids = np.arange(len(embeddings), dtype=np.int64)
+
     print('-' * 72)
 
     print('Normalizing vectors for cosine similarity...')
     faiss.normalize_L2(embeddings)
     print('Normalization completed.')
 
-    print('-' * 72) 
+    print('-' * 72)
 
-    print('Building FAISS index...')
-    index = faiss.IndexFlatIP(embeddings.shape[1])
-    index.add(embeddings)
-    print(f'FAISS index built with {index.ntotal} vectors.')
+    num_vectors, dim = embeddings.shape
+    if index_type == 'auto':
+        index_type = choose_index_type(num_vectors)
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f'Unknown index type: {index_type}')
+    explicit = set(params or {})
+    params = {
+        **default_params(
+            index_type, num_vectors, dim, (params or {}).get('quantization')
+        ),
+        **(params or {})
+    }
+
+    print(f'Building {index_type} FAISS index with {params}...')
+    start = time.perf_counter()
+    index = _create_index(index_type, dim, params)
+    _train_and_add(index, embeddings, ids)
+    build_seconds = time.perf_counter() - start
+    print(f'FAISS index built with {index.ntotal} vectors in '
+          f'{build_seconds:.2f}s.')
 
     print('-' * 72)
 
+    recall = evaluate_recall(index, embeddings, ids, index_type, params)
+    if recall:
+        print(f'Recall@{RECALL_K} vs. exact search:')
+        for row in recall:
+            setting = (
+                f'{row["param"]}={row["value"]:<5}'
+                if row['param'] is not None else params['quantization']
+            )
+            print(f'  {setting} '
+                  f'recall={row["recall"]:.3f}  '
+                  f'{row["ms_per_query"]:.3f} ms/query')
+
+        name = _search_param_name(index_type)
+        if name is not None and name not in explicit:
+            reached = [
+                row for row in recall if row['recall'] >= target_recall
+            ]
+            best = reached[0] if reached else recall[-1]
+            params[name] = best['value']
+            print(f'Using {name}={best["value"]} '
+                  f'(recall {best["recall"]:.3f}).')
+
+        print('-' * 72)
+
     print(f'Saving FAISS index to {output_path}...')
-    faiss.write_index(index, output_path)
+    tmp_path = output_path + '.tmp'
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, output_path)
+    _save_index_info({
+        **(embedder_info or {}),
+        'index_type': index_type,
+        'params': params,
+        'ntotal': index.ntotal,
+        'dim': dim,
+        'build_seconds': build_seconds,
+        'recall_k': RECALL_K,
+        'recall': recall
+    }, output_path)
     print('FAISS index saved successfully.')
 
     print('-' * 72)
+
+
+def embedder_info(
+    info: dict
+) -> dict:
+    """
+    Extracts the embedder fields of an index's info, to carry them over
+    when the index is rebuilt.
+
+    Args:
+        info (dict): Index info saved with the index.
+
+    Returns:
+        dict: The model ID and embedder spec, where recorded.
+    """
+    return {
+        key: info[key] for key in ('model_id', 'embedder') if key in info
+    }
+
+
+class FaissIndexUpdater:
+    """
+    Updates a FAISS index on disk by removing vectors by ID and adding
+    new ones batch by batch, without rebuilding it.
+
+    HNSW indices do not support removal; if vectors must be removed
+    from one, or added ones discarded, it is rebuilt by close() with
+    the same type and parameters from the updated embeddings instead.
+    """
+
+    def __init__(
+        self,
+        index_path: str,
+        remove_ids: list[int]
+    ) -> None:
+        """
+        Loads the index and removes vectors from it.
+
+        Args:
+            index_path (str): Path to the FAISS index file.
+            remove_ids (list[int]): Chunk IDs of the vectors to remove.
+        """
+        self.index_path = index_path
+        self.info = load_index_info(index_path)
+        self.added = 0
+        self._lock = threading.Lock()
+        self.rebuild = bool(len(remove_ids)) and (
+            self.info['index_type'] == 'hnsw'
+        )
+        if self.rebuild:
+            print('HNSW indices do not support removal, the index will be '
+                  'rebuilt.')
+            self.index = None
+            return
+
+        print(f'Updating FAISS index at {index_path}...')
+        self.index = faiss.read_index(index_path)
+        if len(remove_ids):
+            removed = self.index.remove_ids(
+                np.array(remove_ids, dtype=np.int64)
+            )
+            print(f'Removed {removed} vectors.')
+
+    def add(
+        self,
+        embeddings: np.ndarray,
+        ids: np.ndarray
+    ) -> None:
+        """
+        Adds vectors. Safe to call from several threads.
+
+        Args:
+            embeddings (np.ndarray): New embeddings to add.
+            ids (np.ndarray): Chunk IDs of the new embeddings.
+        """
+        if not len(ids):
+            return
+        if embeddings.shape[1] != self.info['dim']:
+            raise ValueError(
+                f'Embeddings of dimension {embeddings.shape[1]} cannot be '
+                f'added to an index of dimension {self.info["dim"]}.'
+            )
+
+        with self._lock:
+            self.added += len(ids)
+            if self.rebuild:
+                return
+            embeddings = np.array(embeddings, dtype=np.float32)
+            faiss.normalize_L2(embeddings)
+            self.index.add_with_ids(
+                embeddings, np.asarray(ids, dtype=np.int64)
+            )
+
+    def discard(
+        self,
+        ids: list[int]
+    ) -> None:
+        """
+        Removes vectors added since the index was loaded, e.g. those of
+        a project whose build failed. Safe to call from several threads.
+
+        Args:
+            ids (list[int]): Chunk IDs of the vectors.
+        """
+        if not len(ids):
+            return
+
+        with self._lock:
+            if not self.rebuild and self.info['index_type'] == 'hnsw':
+                print('HNSW indices do not support removal, the index will '
+                      'be rebuilt.')
+                self.rebuild = True
+                self.index = None
+            if self.rebuild:
+                self.added -= len(ids)
+                return
+            self.added -= self.index.remove_ids(
+                np.asarray(ids, dtype=np.int64)
+            )
+
+    def close(
+        self,
+        embeddings_path: str = None,
+        ids_path: str = None
+    ) -> None:
+        """
+        Saves the updated index, or rebuilds it if needed.
+
+        Args:
+            embeddings_path (str): Path to the updated .npy embeddings,
+                used for rebuilds. Default is None.
+            ids_path (str): Path to the updated .npy chunk IDs, used for
+                rebuilds. Default is None.
+        """
+        if self.rebuild:
+            build_faiss_index(
+                embeddings_path=embeddings_path,
+                output_path=self.index_path,
+                ids_path=ids_path,
+                index_type=self.info['index_type'],
+                params=self.info['params'],
+                embedder_info=embedder_info(self.info)
+            )
+            return
+
+        print(f'Added {self.added} vectors.')
+        tmp_path = self.index_path + '.tmp'
+        faiss.write_index(self.index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+        self.info['ntotal'] = self.index.ntotal
+        _save_index_info(self.info, self.index_path)
+        print(f'FAISS index now holds {self.index.ntotal} vectors.')
+
+        print('-' * 72)
@@ -4,55 +4,243 @@ Performs Top-K semantic search using a FAISS index.
 
 import faiss
 import numpy as np
-from openai import OpenAI
+
+import tracing
+from embedders import Embedder
+from chunk_store import ChunkStore
+from query_cache import QueryEmbeddingCache
 
 
 def load_index(
-    index_path: str
+    index_path: str,
+    mmap: bool = False
 ) -> faiss.Index:
     """
     Loads a FAISS index from disk.
 
     Args:
         index_path (str): Path to the FAISS index file.
+        mmap (bool): Whether to memory-map the vectors read-only
+            instead of copying them into RAM, so the OS page cache is
+            shared between processes. Default is False.
 
     Returns:
         faiss.Index: Loaded FAISS index.
     """
-    return faiss.read_index(index_path)
+    with tracing.span('load_index', mmap=mmap) as span:
+        if mmap:
+            flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+            index = faiss.read_index(
+                index_path, flags | faiss.IO_FLAG_READ_ONLY
+            )
+        else:
+            index = faiss.read_index(index_path)
+        span.set(vectors=index.ntotal)
+
+    return index
 
 
 def embed_query(
-    client: OpenAI,
+    embedder: Embedder,
     query: str,
-    model_name: str = 'text-embedding-3-small'
+    cache: QueryEmbeddingCache = None
 ) -> np.ndarray:
     """
-    Embeds a query string using the OpenAI API.
+    Embeds a query string with the embedder the index was built with.
 
     Args:
-        client (OpenAI): An instance of the OpenAI client.
+        embedder (Embedder): The embedding backend.
         query (str): The query string to embed.
-        model_name (str): Name of the OpenAI model to use.
-            Default is 'text-embedding-3-small'.
+        cache (QueryEmbeddingCache): Cache of query embeddings, keyed
+            by the embedder's model ID. A repeat query is served from
+            it without calling the embedder. Default is None (no
+            caching).
 
     Returns:
         np.ndarray: The embedded query vector.
     """
-    response = client.embeddings.create(
-        input=[query],
-        model=model_name
-    )
-    embedding = np.array([response.data[0].embedding], dtype=np.float32)
+    with tracing.span('embed_query', model=embedder.model_id) as span:
+        if cache is not None:
+            embedding = cache.get(embedder.model_id, query)
+            if embedding is not None:
+                span.set(cached=True)
+                return embedding
+
+        embedding = embedder.embed_query(query)
+        span.set(cached=False)
+
+        if cache is not None:
+            cache.put(embedder.model_id, query, embedding)
 
     return embedding
 
 
+def embed_queries(
+    embedder: Embedder,
+    queries: list[str],
+    cache: QueryEmbeddingCache = None
+) -> np.ndarray:
+    """
+    Embeds many query strings, in as few embedding requests as the
+    embedder's batch size allows.
+
+    Args:
+        embedder (Embedder): The embedding backend.
+        queries (list[str]): The query strings to embed.
+        cache (QueryEmbeddingCache): Cache of query embeddings, keyed
+            by the embedder's model ID. Cached queries are not sent to
+            the embedder, and new ones are added. Default is None (no
+            caching).
+
+    Returns:
+        np.ndarray: float32 array of shape (len(queries), dim).
+    """
+    with tracing.span(
+        'embed_queries', model=embedder.model_id, queries=len(queries)
+    ) as span:
+        embeddings = {}
+        if cache is not None:
+            for query in set(queries):
+                embedding = cache.get(embedder.model_id, query)
+                if embedding is not None:
+                    embeddings[query] = embedding.reshape(-1)
+
+        missing = [
+            query for query in dict.fromkeys(queries)
+            if query not in embeddings
+        ]
+        for start in range(0, len(missing), embedder.max_batch_size):
+            batch = missing[start:start + embedder.max_batch_size]
+            for query, embedding in zip(batch, embedder.embed_batch(batch)):
+                embeddings[query] = embedding
+                if cache is not None:
+                    cache.put(embedder.model_id, query, embedding[None, :])
+        span.set(cached=len(set(queries)) - len(missing))
+
+    if not queries:
+        return np.zeros((0, embedder.dim), dtype=np.float32)
+
+    return np.vstack([embeddings[query] for query in queries]).astype(
+        np.float32
+    )
+
+
+def make_id_selector(
+    ids: np.ndarray
+) -> faiss.IDSelector:
+    """
+    Builds a selector restricting a search to a set of vector IDs, e.g.
+    the chunks of one project.
+
+    Args:
+        ids (np.ndarray): Vector IDs to allow.
+
+    Returns:
+        faiss.IDSelector: Selector to pass to search_faiss_index.
+    """
+    return faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype=np.int64))
+
+
+def make_search_parameters(
+    index: faiss.Index,
+    search_params: dict = None,
+    id_selector: faiss.IDSelector = None
+) -> faiss.SearchParameters | None:
+    """
+    Builds per-query FAISS search parameters for an index, so that
+    settings such as nprobe or efSearch, and ID filters, can vary
+    between calls without mutating a shared index.
+
+    Args:
+        index (faiss.Index): The FAISS index to search.
+        search_params (dict): Search-time parameters, e.g.
+            {'nprobe': 16} for IVF or {'efSearch': 64} for HNSW.
+            Parameters that do not apply to the index are ignored.
+            Default is None.
+        id_selector (faiss.IDSelector): Restricts results to the
+            selected vector IDs. Default is None.
+
+    Returns:
+        faiss.SearchParameters | None: Parameters to pass to
+            index.search, or None if there are none to apply.
+    """
+    search_params = search_params or {}
+    if not search_params and id_selector is None:
+        return None
+
+    if faiss.try_extract_index_ivf(index) is not None:
+        params = faiss.SearchParametersIVF()
+        if 'nprobe' in search_params:
+            params.nprobe = int(search_params['nprobe'])
+    elif isinstance(
+        faiss.downcast_index(getattr(index, 'index', index)),
+        faiss.IndexHNSW
+    ):
+        params = faiss.SearchParametersHNSW()
+        if 'efSearch' in search_params:
+            params.efSearch = int(search_params['efSearch'])
+    elif id_selector is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+
+    if id_selector is not None:
+        params.sel = id_selector
+
+    return params
+
+
+def rescore_candidates(
+    query_embeddings: np.ndarray,
+    candidates: list[list[int]],
+    store: ChunkStore,
+    top_k: int
+) -> list[list[int]]:
+    """
+    Reorders the candidates of a quantized index search by their exact
+    cosine similarity to the query, computed from the memory-mapped
+    full-precision embeddings of the chunk store.
+
+    Args:
+        query_embeddings (np.ndarray): Embedded queries, one per row.
+        candidates (list[list[int]]): Candidate IDs of each query.
+        store (ChunkStore): Chunk store holding the embeddings.
+        top_k (int): Number of results kept per query.
+
+    Returns:
+        list[list[int]]: IDs of the top K candidates of each query.
+    """
+    unique_ids = sorted({idx for row in candidates for idx in row})
+    if not unique_ids:
+        return [[] for _ in candidates]
+
+    with tracing.span('rescore', candidates=len(unique_ids)):
+        embeddings = store.get_embeddings(unique_ids)
+        faiss.normalize_L2(embeddings)
+        queries = np.array(query_embeddings, dtype=np.float32)
+        faiss.normalize_L2(queries)
+        positions = {idx: i for i, idx in enumerate(unique_ids)}
+
+        results = []
+        for query, row in zip(queries, candidates):
+            if not row:
+                results.append([])
+                continue
+            scores = embeddings[[positions[idx] for idx in row]] @ query
+            order = np.argsort(-scores, kind='stable')[:top_k]
+            results.append([row[i] for i in order])
+
+    return results
+
+
 def search_faiss_index(
     index: faiss.Index,
     query_embedding: np.ndarray,
-    top_k: int = 5
-) -> np.ndarray:
+    top_k: int = 5,
+    search_params: dict = None,
+    id_selector: faiss.IDSelector = None,
+    store: ChunkStore = None
+) -> list[int]:
     """
     Performs a Top-K search in the FAISS index.
 
@@ -60,10 +248,81 @@ def search_faiss_index(
         index (faiss.Index): The FAISS index to search.
         query_embedding (np.ndarray): The embedded query vector.
         top_k (int): Number of top results to return. Default is 5.
+        search_params (dict): Search-time parameters such as nprobe or
+            efSearch, usually the 'params' saved with the index.
+            Default is None.
+        id_selector (faiss.IDSelector): Restricts results to the
+            selected vector IDs, e.g. one project's chunks in the
+            shared index. Default is None.
+        store (ChunkStore): Chunk store holding the full-precision
+            embeddings, used to rescore the results of a quantized
+            index (see search_faiss_index_batch). Default is None.
+
+    Returns:
+        list[int]: IDs of the top K nearest neighbors.
+    """
+    return search_faiss_index_batch(
+        index, query_embedding, top_k, search_params, id_selector, store
+    )[0]
+
+
+def search_faiss_index_batch(
+    index: faiss.Index,
+    query_embeddings: np.ndarray,
+    top_k: int = 5,
+    search_params: dict = None,
+    id_selector: faiss.IDSelector = None,
+    store: ChunkStore = None
+) -> list[list[int]]:
+    """
+    Performs a Top-K search for every row of a query matrix in a single
+    index.search call, which FAISS parallelizes across queries.
+
+    If the index is quantized, its search parameters hold a 'rescore'
+    factor: given the chunk store, rescore * top_k candidates are then
+    fetched and reordered by their exact similarity, which recovers
+    most of the recall lost to quantization.
+
+    Args:
+        index (faiss.Index): The FAISS index to search.
+        query_embeddings (np.ndarray): Embedded queries, one per row.
+        top_k (int): Number of top results per query. Default is 5.
+        search_params (dict): Search-time parameters such as nprobe or
+            efSearch, usually the 'params' saved with the index.
+            Default is None.
+        id_selector (faiss.IDSelector): Restricts results to the
+            selected vector IDs. Default is None.
+        store (ChunkStore): Chunk store holding the full-precision
+            embeddings, used for rescoring. Default is None (no
+            rescoring).
 
     Returns:
-        np.ndarray: Indices of the top K nearest neighbors.
+        list[list[int]]: IDs of the top K nearest neighbors of each
+            query.
     """
-    _, indices = index.search(query_embedding, top_k)
+    rescore = 1
+    if store is not None and search_params:
+        rescore = max(1, int(search_params.get('rescore', 1)))
+
+    with tracing.span(
+        'faiss_search',
+        top_k=top_k,
+        queries=len(query_embeddings),
+        filtered=id_selector is not None,
+        rescore=rescore
+    ):
+        _, indices = index.search(
+            np.ascontiguousarray(query_embeddings, dtype=np.float32),
+            top_k * rescore,
+            params=make_search_parameters(index, search_params, id_selector)
+        )
+
+    results = [
+        [idx for idx in row if idx != -1] for row in indices.tolist()
+    ]
+    if rescore > 1:
+        results = rescore_candidates(
+            query_embeddings, results, store, top_k
+        )
 
-    return indices[0].tolist()
+    return results
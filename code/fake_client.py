@@ -0,0 +1,181 @@
+"""
+Offline stand-in for the OpenAI client, for exercising the pipeline and
+the app without network access or an API key.
+
+Embeddings are deterministic pseudo-random unit vectors derived from
+the text, and chat completions echo the end of the prompt word by word,
+optionally streamed, with configurable latencies.
+"""
+
+import time
+import hashlib
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+
+FAKE_EMBEDDING_DIM = 1536
+
+
+def _fake_embedding(
+    text: str,
+    dim: int
+) -> list[float]:
+    """
+    Derives a deterministic unit vector from a text.
+
+    Args:
+        text (str): The text to embed.
+        dim (int): Dimension of the vector.
+
+    Returns:
+        list[float]: The embedding.
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8])
+    vector = np.random.default_rng(seed).standard_normal(dim)
+
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class _FakeEmbeddings:
+    """
+    Mimics client.embeddings.
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        latency: float
+    ) -> None:
+        self.dim = dim
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def create(
+        self,
+        input: list[str],
+        model: str
+    ) -> SimpleNamespace:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+        return SimpleNamespace(data=[
+            SimpleNamespace(embedding=_fake_embedding(text, self.dim))
+            for text in input
+        ])
+
+
+class _FakeStream:
+    """
+    Mimics the stream returned by chat.completions.create(stream=True).
+    """
+
+    def __init__(
+        self,
+        words: list[str],
+        first_token_latency: float,
+        token_latency: float
+    ) -> None:
+        self._words = words
+        self._first_token_latency = first_token_latency
+        self._token_latency = token_latency
+        self.closed = False
+
+    def __iter__(self):
+        time.sleep(self._first_token_latency)
+        for i, word in enumerate(self._words):
+            if self.closed:
+                return
+            if i:
+                time.sleep(self._token_latency)
+            yield SimpleNamespace(choices=[
+                SimpleNamespace(delta=SimpleNamespace(
+                    content=word.lstrip() if not i else word
+                ))
+            ])
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class _FakeCompletions:
+    """
+    Mimics client.chat.completions.
+    """
+
+    def __init__(
+        self,
+        first_token_latency: float,
+        token_latency: float
+    ) -> None:
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def create(
+        self,
+        model: str,
+        messages: list[dict],
+        max_tokens: int = 512,
+        stream: bool = False,
+        **kwargs
+    ):
+        with self._lock:
+            self.calls += 1
+
+        question = messages[-1]['content'].rsplit('User Question:', 1)[-1]
+        question = question.split('Answer:', 1)[0]
+        words = f'(fake {model} answer) {question.strip()}'.split()
+        words = [' ' + word for word in words[:max_tokens]]
+
+        if stream:
+            return _FakeStream(
+                words, self.first_token_latency, self.token_latency
+            )
+
+        time.sleep(
+            self.first_token_latency
+            + self.token_latency * max(len(words) - 1, 0)
+        )
+        return SimpleNamespace(choices=[
+            SimpleNamespace(message=SimpleNamespace(
+                content=''.join(words).strip()
+            ))
+        ])
+
+
+class FakeOpenAI:
+    """
+    Drop-in replacement for openai.OpenAI covering the calls made by
+    this project: embeddings.create and chat.completions.create (with
+    or without stream=True). Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        dim: int = FAKE_EMBEDDING_DIM,
+        embedding_latency: float = 0.0,
+        first_token_latency: float = 0.0,
+        token_latency: float = 0.0
+    ) -> None:
+        """
+        Creates the fake client.
+
+        Args:
+            dim (int): Dimension of the fake embeddings. Default is
+                FAKE_EMBEDDING_DIM, that of text-embedding-3-small.
+            embedding_latency (float): Seconds each embeddings request
+                takes. Default is 0.0.
+            first_token_latency (float): Seconds before the first token
+                of a completion. Default is 0.0.
+            token_latency (float): Seconds between later tokens.
+                Default is 0.0.
+        """
+        self.embeddings = _FakeEmbeddings(dim, embedding_latency)
+        self.chat = SimpleNamespace(
+            completions=_FakeCompletions(first_token_latency, token_latency)
+        )
@@ -0,0 +1,192 @@
+"""
+Combines lexical (BM25) and vector (FAISS) retrieval.
+
+Identifier-style queries (drawing numbers, clause numbers, project
+codes) are answered from the BM25 index alone, without embedding the
+query. Other queries merge both rankings with reciprocal rank fusion.
+"""
+
+import re
+from collections.abc import Callable
+
+import numpy as np
+
+import tracing
+from bm25_index import BM25Index
+
+
+SEARCH_MODES = ('hybrid', 'vector', 'lexical')
+
+# Constant of reciprocal rank fusion; larger values flatten the weight
+# of top ranks.
+RRF_K = 60
+
+# Each ranking contributes this many times top_k candidates to fusion.
+FUSION_CANDIDATES = 4
+
+# Identifier-style queries are short and contain a token mixing digits
+# with letters or separators, e.g. 'DWG-C-1203', 'P21045' or '4.2.1'.
+IDENTIFIER_MAX_WORDS = 4
+_IDENTIFIER_RE = re.compile(r'^(?=.*\d)(?=.*[a-z\-./_])[\w\-./]+$')
+
+
+def is_identifier_query(
+    query: str
+) -> bool:
+    """
+    Checks whether a query looks up an identifier rather than asking a
+    question in words.
+
+    Args:
+        query (str): The user query.
+
+    Returns:
+        bool: True if the query is short and contains an identifier.
+    """
+    words = query.lower().split()
+    if not words or len(words) > IDENTIFIER_MAX_WORDS:
+        return False
+
+    return any(
+        _IDENTIFIER_RE.match(word.strip('?,;:()\'"')) for word in words
+    )
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[int]],
+    top_k: int = 5,
+    k: int = RRF_K
+) -> list[int]:
+    """
+    Merges several rankings by summing 1 / (k + rank) for each item.
+
+    Args:
+        rankings (list[list[int]]): Ranked IDs, best first.
+        top_k (int): Number of top results to return. Default is 5.
+        k (int): Fusion constant. Default is RRF_K.
+
+    Returns:
+        list[int]: IDs of the top K fused results.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking):
+            scores[idx] = scores.get(idx, 0.0) + 1.0 / (k + rank + 1)
+
+    return sorted(scores, key=lambda idx: -scores[idx])[:top_k]
+
+
+def hybrid_search(
+    query: str,
+    lexical_index: BM25Index | None,
+    vector_search: Callable[[int], list[int]],
+    top_k: int = 5,
+    mode: str = 'hybrid',
+    allowed_ids: np.ndarray = None
+) -> tuple[list[int], str]:
+    """
+    Retrieves the top chunks for a query lexically, by vector, or both.
+
+    In hybrid mode, an identifier-style query with lexical matches is
+    served from the BM25 index alone and vector_search is never
+    called, so no embedding request is made.
+
+    Args:
+        query (str): The user query.
+        lexical_index (BM25Index | None): The BM25 index, or None if
+            the build has none (vector search only).
+        vector_search (Callable[[int], list[int]]): Runs the vector
+            search for a number of results, embedding the query on
+            demand.
+        top_k (int): Number of top results to return. Default is 5.
+        mode (str): One of SEARCH_MODES. Default is 'hybrid'.
+        allowed_ids (np.ndarray): Restricts lexical results to these
+            chunk IDs; vector_search must apply the same filter.
+            Default is None.
+
+    Returns:
+        tuple[list[int], str]: IDs of the top K chunks, and the route
+            that produced them ('lexical', 'vector' or 'hybrid').
+    """
+    with tracing.span('retrieve', mode=mode, top_k=top_k) as span:
+        results, route = hybrid_search_batch(
+            [query],
+            lexical_index,
+            lambda positions, k: [vector_search(k)],
+            top_k,
+            mode,
+            allowed_ids
+        )[0]
+        span.set(route=route, results=len(results))
+
+    return results, route
+
+
+def hybrid_search_batch(
+    queries: list[str],
+    lexical_index: BM25Index | None,
+    vector_search: Callable[[list[int], int], list[list[int]]],
+    top_k: int = 5,
+    mode: str = 'hybrid',
+    allowed_ids: np.ndarray = None
+) -> list[tuple[list[int], str]]:
+    """
+    Retrieves the top chunks for many queries, routed as in
+    hybrid_search, with a single vector search call for all queries
+    that need one, e.g. one batched embedding request and one
+    multi-row FAISS search.
+
+    Args:
+        queries (list[str]): The user queries.
+        lexical_index (BM25Index | None): The BM25 index, or None if
+            the build has none (vector search only).
+        vector_search (Callable[[list[int], int], list[list[int]]]):
+            Runs the vector search of the queries at the given
+            positions for a number of results each, and returns their
+            rankings in the same order. Not called if no query needs
+            it.
+        top_k (int): Number of top results to return. Default is 5.
+        mode (str): One of SEARCH_MODES. Default is 'hybrid'.
+        allowed_ids (np.ndarray): Restricts lexical results to these
+            chunk IDs; vector_search must apply the same filter.
+            Default is None.
+
+    Returns:
+        list[tuple[list[int], str]]: IDs of the top K chunks of each
+            query, and the route that produced them.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(
+            f'Unknown search mode {mode!r}, expected one of {SEARCH_MODES}.'
+        )
+
+    if lexical_index is None or mode == 'vector':
+        vector = vector_search(list(range(len(queries))), top_k)
+        return [(ranking, 'vector') for ranking in vector]
+
+    if mode == 'lexical':
+        return [
+            (lexical_index.search(query, top_k, allowed_ids), 'lexical')
+            for query in queries
+        ]
+
+    candidates = top_k * FUSION_CANDIDATES
+    results = [None] * len(queries)
+    lexical = {}
+    for i, query in enumerate(queries):
+        ranking = lexical_index.search(query, candidates, allowed_ids)
+        if ranking and is_identifier_query(query):
+            results[i] = (ranking[:top_k], 'lexical')
+        else:
+            lexical[i] = ranking
+
+    if lexical:
+        positions = list(lexical)
+        vector = vector_search(positions, candidates)
+        for i, ranking in zip(positions, vector):
+            results[i] = (
+                reciprocal_rank_fusion([lexical[i], ranking], top_k),
+                'hybrid'
+            )
+
+    return results
@@ -0,0 +1,119 @@
+"""
+Tracks the PDFs of a project in a manifest file so that builds only
+reprocess files that were added, changed or deleted since the last run.
+"""
+
+import os
+import json
+import hashlib
+
+
+def _hash_file(
+    path: str,
+    block_size: int = 1 << 20
+) -> str:
+    """
+    Computes the SHA-256 digest of a file's content.
+
+    Args:
+        path (str): Path to the file.
+        block_size (int): Number of bytes read at a time. Default is
+            1 MiB.
+
+    Returns:
+        str: Hex SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def load_manifest(
+    path: str
+) -> dict:
+    """
+    Loads a manifest from disk.
+
+    Args:
+        path (str): Path to the manifest JSON file.
+
+    Returns:
+        dict: The manifest, or an empty dict if it does not exist.
+    """
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, 'r', encoding='utf-8') as fin:
+        return json.load(fin)
+
+
+def save_manifest(
+    manifest: dict,
+    path: str
+) -> None:
+    """
+    Atomically saves a manifest to disk.
+
+    Args:
+        manifest (dict): The manifest to save.
+        path (str): Path to the manifest JSON file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fout:
+        json.dump(manifest, fout, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def diff_manifest(
+    manifest: dict,
+    folder_path: str
+) -> tuple[list[str], list[str], list[str], dict]:
+    """
+    Compares the PDFs in a folder against a manifest.
+
+    Files whose size and mtime match the manifest are treated as
+    unchanged without being read. Only files whose stats differ are
+    hashed, so touching a file without editing it is not a change.
+
+    Args:
+        manifest (dict): Manifest from the previous build.
+        folder_path (str): Path to the folder containing PDF files.
+
+    Returns:
+        tuple[list[str], list[str], list[str], dict]: Added, changed
+            and removed PDF file names, and the updated manifest.
+    """
+    old_files = manifest.get('files', {})
+    new_files = {}
+    added = []
+    changed = []
+
+    pdf_files = sorted(
+        f for f in os.listdir(folder_path) if f.lower().endswith('.pdf')
+    )
+    for pdf_file in pdf_files:
+        stat = os.stat(os.path.join(folder_path, pdf_file))
+        old = old_files.get(pdf_file)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+        if (
+            old is not None
+            and old['size'] == entry['size']
+            and old['mtime'] == entry['mtime']
+        ):
+            entry['sha256'] = old['sha256']
+        else:
+            entry['sha256'] = _hash_file(os.path.join(folder_path, pdf_file))
+            if old is None:
+                added.append(pdf_file)
+            elif old['sha256'] != entry['sha256']:
+                changed.append(pdf_file)
+
+        new_files[pdf_file] = entry
+
+    removed = sorted(set(old_files) - set(new_files))
+
+    return added, changed, removed, {'files': new_files}
@@ -0,0 +1,365 @@
+"""
+Renders PDF pages into compact preview images and caches them on disk.
+
+Images are keyed by (PDF path, PDF mtime, page, width, format), so an
+edited PDF never serves stale previews; outdated entries simply age out
+of the size-capped LRU. Open documents are pooled so hot PDFs are not
+reopened on every render.
+"""
+
+import io
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+from tqdm import tqdm
+
+import tracing
+
+
+PREVIEW_WIDTH = 600
+PREVIEW_FORMAT = 'webp'
+PREVIEW_QUALITY = 80
+
+DEFAULT_MAX_BYTES = 1024 ** 3
+MAX_OPEN_DOCUMENTS = 16
+
+IMAGE_FORMATS = ('jpeg', 'webp', 'png')
+
+# PyMuPDF is not thread-safe, so pages rendered from worker threads are
+# rasterized one at a time. The lock also guards the document pool.
+_FITZ_LOCK = threading.Lock()
+
+
+class DocumentPool:
+    """
+    Keeps the most recently used PDFs open. A document is reopened if
+    its file changed since it was opened. Must be used with _FITZ_LOCK
+    held.
+    """
+
+    def __init__(
+        self,
+        max_open: int = MAX_OPEN_DOCUMENTS
+    ) -> None:
+        """
+        Creates an empty pool.
+
+        Args:
+            max_open (int): Maximum number of open documents. Default is
+                MAX_OPEN_DOCUMENTS.
+        """
+        self.max_open = max_open
+        self.hits = 0
+        self.opens = 0
+        self._documents = OrderedDict()
+
+    def get(
+        self,
+        pdf_path: str,
+        mtime_ns: int
+    ) -> fitz.Document:
+        """
+        Returns an open document, opening it if needed.
+
+        Args:
+            pdf_path (str): Path to the PDF file.
+            mtime_ns (int): Current mtime of the file in nanoseconds.
+
+        Returns:
+            fitz.Document: The open document.
+        """
+        entry = self._documents.get(pdf_path)
+        if entry is not None and entry[0] == mtime_ns:
+            self._documents.move_to_end(pdf_path)
+            self.hits += 1
+            return entry[1]
+
+        if entry is not None:
+            entry[1].close()
+        doc = fitz.open(pdf_path)
+        self._documents[pdf_path] = (mtime_ns, doc)
+        self._documents.move_to_end(pdf_path)
+        self.opens += 1
+
+        while len(self._documents) > self.max_open:
+            _, (_, old_doc) = self._documents.popitem(last=False)
+            old_doc.close()
+
+        return doc
+
+
+_documents = DocumentPool()
+
+
+def render_page(
+    pdf_path: str,
+    page_number: int = 1,
+    width: int = PREVIEW_WIDTH,
+    fmt: str = PREVIEW_FORMAT,
+    quality: int = PREVIEW_QUALITY,
+    mtime_ns: int = None
+) -> bytes:
+    """
+    Rasterizes a page of a PDF file at the width it is displayed at.
+    Safe to call from worker threads.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        page_number (int): Page number to render (1-indexed). Default
+            is 1.
+        width (int): Width of the image in pixels. Default is
+            PREVIEW_WIDTH.
+        fmt (str): Image format, one of IMAGE_FORMATS. Default is
+            PREVIEW_FORMAT.
+        quality (int): JPEG/WebP quality from 1 to 100. Default is
+            PREVIEW_QUALITY.
+        mtime_ns (int): mtime of the file, if already known. Default is
+            None (stat the file).
+
+    Returns:
+        bytes: The encoded image.
+    """
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(
+            f'Unknown image format {fmt!r}, expected one of {IMAGE_FORMATS}.'
+        )
+    if mtime_ns is None:
+        mtime_ns = os.stat(pdf_path).st_mtime_ns
+
+    with _FITZ_LOCK:
+        page = _documents.get(pdf_path, mtime_ns).load_page(page_number - 1)
+        zoom = width / page.rect.width
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+        if fmt == 'jpeg':
+            return pix.tobytes('jpeg', jpg_quality=quality)
+        if fmt == 'png':
+            return pix.tobytes('png')
+
+        samples = bytes(pix.samples)
+        size = (pix.width, pix.height)
+
+    # Pillow ships with Streamlit; only WebP output needs it.
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', size, samples).save(
+        buffer, 'WEBP', quality=quality
+    )
+
+    return buffer.getvalue()
+
+
+class PageImageCache:
+    """
+    SQLite-backed cache of rendered page images with hit/miss statistics
+    and size-based LRU eviction. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        fmt: str = PREVIEW_FORMAT,
+        quality: int = PREVIEW_QUALITY
+    ) -> None:
+        """
+        Opens (or creates) the cache database.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            max_bytes (int): Maximum total size of stored images in
+                bytes. Default is DEFAULT_MAX_BYTES (1 GiB).
+            fmt (str): Image format, one of IMAGE_FORMATS. Default is
+                PREVIEW_FORMAT.
+            quality (int): JPEG/WebP quality from 1 to 100. Default is
+                PREVIEW_QUALITY.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.fmt = fmt
+        self.quality = quality
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'path TEXT NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, '
+            'page INTEGER NOT NULL, '
+            'width INTEGER NOT NULL, '
+            'format TEXT NOT NULL, '
+            'image BLOB NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'last_access REAL NOT NULL, '
+            'PRIMARY KEY (path, mtime_ns, page, width, format))'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_pages_last_access '
+            'ON pages (last_access)'
+        )
+        self._conn.commit()
+
+    def get(
+        self,
+        pdf_path: str,
+        page_number: int,
+        width: int = PREVIEW_WIDTH
+    ) -> bytes:
+        """
+        Returns the image of a page, rendering and storing it on a miss.
+
+        Args:
+            pdf_path (str): Path to the PDF file.
+            page_number (int): Page number (1-indexed).
+            width (int): Width of the image in pixels. Default is
+                PREVIEW_WIDTH.
+
+        Returns:
+            bytes: The encoded image.
+        """
+        pdf_path = os.path.abspath(pdf_path)
+        mtime_ns = os.stat(pdf_path).st_mtime_ns
+        key = (pdf_path, mtime_ns, page_number, width, self.fmt)
+
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT image FROM pages WHERE path = ? AND mtime_ns = ? '
+                'AND page = ? AND width = ? AND format = ?',
+                key
+            ).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    'UPDATE pages SET last_access = ? WHERE path = ? '
+                    'AND mtime_ns = ? AND page = ? AND width = ? '
+                    'AND format = ?',
+                    (time.time(), *key)
+                )
+                self._conn.commit()
+                self.hits += 1
+                tracing.count('cache_lookups_total', cache='page', hit=True)
+                return row[0]
+            self.misses += 1
+        tracing.count('cache_lookups_total', cache='page', hit=False)
+
+        with tracing.span('render_page', page=page_number) as span:
+            image = render_page(
+                pdf_path, page_number, width, self.fmt, self.quality,
+                mtime_ns
+            )
+            span.set(bytes=len(image))
+
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO pages (path, mtime_ns, page, width, '
+                'format, image, size, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (*key, image, len(image), time.time())
+            )
+            self._conn.commit()
+            self._evict()
+
+        return image
+
+    def _evict(self) -> None:
+        """
+        Deletes least recently used images until the total size is
+        within max_bytes. Must be called with the lock held.
+        """
+        total = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM pages'
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        excess = total - self.max_bytes
+        victims = []
+        cursor = self._conn.execute(
+            'SELECT rowid, size FROM pages ORDER BY last_access ASC'
+        )
+        for rowid, size in cursor:
+            victims.append((rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+
+        self._conn.executemany('DELETE FROM pages WHERE rowid = ?', victims)
+        self._conn.commit()
+        self.evictions += len(victims)
+
+    def stats(self) -> dict:
+        """
+        Returns cache statistics.
+
+        Returns:
+            dict: Hits, misses, hit rate, evictions, number of entries,
+                total stored bytes, and documents reused from and
+                opened into the document pool.
+        """
+        with self._lock:
+            entries, size = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages'
+            ).fetchone()
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size,
+            'document_hits': _documents.hits,
+            'document_opens': _documents.opens
+        }
+
+    def close(self) -> None:
+        """
+        Closes the underlying database connection.
+        """
+        with self._lock:
+            self._conn.close()
+
+
+def prerender_pages(
+    cache: PageImageCache,
+    pages: list[tuple[str, int]],
+    width: int = PREVIEW_WIDTH,
+    max_workers: int = 4
+) -> None:
+    """
+    Renders pages into the cache ahead of time, e.g. at build time, so
+    that their first preview is served without rasterizing.
+
+    Args:
+        cache (PageImageCache): Cache to fill.
+        pages (list[tuple[str, int]]): (PDF path, page number) pairs.
+        width (int): Width of the images in pixels. Default is
+            PREVIEW_WIDTH.
+        max_workers (int): Number of worker threads, which overlap
+            encoding and database writes with rasterization. Default
+            is 4.
+    """
+    if not pages:
+        return
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(cache.get, pdf_path, page_number, width)
+            for pdf_path, page_number in pages
+        ]
+        for future in tqdm(futures, desc='Pre-rendering previews'):
+            future.result()
+
+    elapsed = time.perf_counter() - start
+    print(f'Pre-rendered {len(pages)} page previews in {elapsed:.2f}s.')
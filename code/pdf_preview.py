@@ -2,16 +2,32 @@
 Displays a preview of a PDF file on a specified page using Streamlit.
 """
 
-import base64
-
-import fitz
 import streamlit as st
 
+from page_cache import PageImageCache, PREVIEW_WIDTH, render_page
+
+
+def display_page_image(
+    img_bytes: bytes,
+    width: int = PREVIEW_WIDTH
+) -> None:
+    """
+    Displays a rendered page image. Streamlit serves the image as a
+    media file rather than inlining it into the page.
+
+    Args:
+        img_bytes (bytes): The encoded page image.
+        width (int): Width of the displayed image in pixels. Default
+            is PREVIEW_WIDTH.
+    """
+    st.image(img_bytes, width=width)
+
 
 def display_pdf_preview(
-    pdf_path: str, 
+    pdf_path: str,
     page_number: int = 0,
-    width: int = 600
+    width: int = PREVIEW_WIDTH,
+    cache: PageImageCache = None
 ) -> None:
     """
     Displays a preview of a PDF file on a specified page.
@@ -21,19 +37,15 @@ def display_pdf_preview(
         page_number (int): Page number to display (1-indexed). Default
             is 0.
         width (int): Width of the displayed image in pixels. Default
-            is 600.
+            is PREVIEW_WIDTH.
+        cache (PageImageCache): Cache of rendered pages. Default is
+            None (render on every call).
     """
     try:
-        doc = fitz.open(pdf_path)
-        page = doc.load_page(page_number - 1)
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-        img_bytes = pix.tobytes('png')
-        base64_img = base64.b64encode(img_bytes).decode('utf-8')
-
-        st.markdown(
-            f'<img src="data:image/png;base64,{base64_img}" '
-            f'width="{width}px">',
-            unsafe_allow_html=True
-        )
+        if cache is not None:
+            img_bytes = cache.get(pdf_path, page_number, width)
+        else:
+            img_bytes = render_page(pdf_path, page_number, width)
+        display_page_image(img_bytes, width)
     except Exception as e:
         st.error(f'Unable to load page {page_number}: {e}')
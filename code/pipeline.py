@@ -0,0 +1,285 @@
+"""
+Runs generator stages concurrently, connected by bounded queues.
+
+Each stage is a function from an iterator of inputs to an iterator of
+outputs and runs in its own thread, so e.g. batch N is embedded while
+file N+1 is extracted. The queues between stages hold at most a few
+items, which keeps memory flat regardless of how much data flows
+through: a fast stage blocks until the next one catches up.
+
+Every stage reports its items, wall-clock time, time spent waiting on
+its neighbours (the rest is its own work) and the peak RSS of the
+process observed while it ran, and is traced as a span when tracing is
+enabled.
+"""
+
+import time
+import queue
+import threading
+import contextvars
+from dataclasses import dataclass
+from collections.abc import Callable, Iterator
+
+import tracing
+from profiling import rss_bytes, peak_rss_bytes
+
+
+QUEUE_SIZE = 4
+
+# How often blocked stages check whether the pipeline was stopped.
+POLL_SECONDS = 0.1
+
+_END = object()
+
+
+@dataclass
+class StageStats:
+    """
+    Statistics of one pipeline stage.
+    """
+    name: str
+    items: int = 0
+    wall_seconds: float = 0.0
+    wait_seconds: float = 0.0
+    peak_rss_bytes: int | None = None
+
+    @property
+    def busy_seconds(self) -> float:
+        """
+        float: Time spent on the stage's own work.
+        """
+        return max(self.wall_seconds - self.wait_seconds, 0.0)
+
+    def sample_rss(self) -> None:
+        """
+        Records the current RSS if it is the highest seen so far.
+        """
+        rss = rss_bytes()
+        if rss is not None and (
+            self.peak_rss_bytes is None or rss > self.peak_rss_bytes
+        ):
+            self.peak_rss_bytes = rss
+
+
+class _Stopped(BaseException):
+    """
+    Raised inside a stage when the pipeline is stopped. Derives from
+    BaseException so stages that isolate their own errors do not
+    swallow it.
+    """
+
+
+class _Channel:
+    """
+    Bounded queue between two stages that gives up waiting when the
+    pipeline is stopped.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        stop: threading.Event
+    ) -> None:
+        """
+        Creates an empty channel.
+
+        Args:
+            maxsize (int): Maximum number of waiting items.
+            stop (threading.Event): Set when the pipeline stops.
+        """
+        self._queue = queue.Queue(maxsize)
+        self._stop = stop
+
+    def put(
+        self,
+        item,
+        stats: StageStats
+    ) -> None:
+        """
+        Adds an item, blocking while the channel is full.
+
+        Args:
+            item: The item.
+            stats (StageStats): Statistics of the producing stage,
+                charged with the time spent blocked.
+
+        Raises:
+            _Stopped: If the pipeline stops while blocked.
+        """
+        start = time.perf_counter()
+        try:
+            while True:
+                if self._stop.is_set():
+                    raise _Stopped
+                try:
+                    self._queue.put(item, timeout=POLL_SECONDS)
+                    return
+                except queue.Full:
+                    pass
+        finally:
+            stats.wait_seconds += time.perf_counter() - start
+
+    def drain(
+        self,
+        stats: StageStats
+    ) -> Iterator:
+        """
+        Yields items until the producing stage ends.
+
+        Args:
+            stats (StageStats): Statistics of the consuming stage,
+                charged with the time spent blocked.
+
+        Yields:
+            The items in order.
+
+        Raises:
+            _Stopped: If the pipeline stops while blocked.
+        """
+        while True:
+            start = time.perf_counter()
+            try:
+                while True:
+                    if self._stop.is_set():
+                        raise _Stopped
+                    try:
+                        item = self._queue.get(timeout=POLL_SECONDS)
+                        break
+                    except queue.Empty:
+                        pass
+            finally:
+                stats.wait_seconds += time.perf_counter() - start
+            if item is _END:
+                return
+            yield item
+
+
+def run_stages(
+    stages: list[tuple[str, Callable[[Iterator], Iterator]]],
+    sink: str = 'write',
+    queue_size: int = QUEUE_SIZE,
+    stats: list[StageStats] = None
+) -> Iterator:
+    """
+    Runs stages concurrently and yields the outputs of the last one.
+
+    The first stage receives an empty iterator and acts as the source.
+    The caller consuming the outputs is the sink; its statistics are
+    reported under the name sink. An exception in any stage stops the
+    pipeline and is re-raised to the caller; a caller that stops
+    iterating stops the stages too.
+
+    Args:
+        stages (list[tuple[str, Callable[[Iterator], Iterator]]]):
+            (name, function) of each stage in order.
+        sink (str): Name reported for the consuming caller. Default is
+            'write'.
+        queue_size (int): Maximum number of items waiting between two
+            stages. Default is QUEUE_SIZE.
+        stats (list[StageStats]): Filled with the statistics of each
+            stage and the sink once the pipeline ends. Default is None.
+
+    Yields:
+        The outputs of the last stage.
+    """
+    stop = threading.Event()
+    errors = []
+    channels = [_Channel(queue_size, stop) for _ in stages]
+    stage_stats = [StageStats(name) for name, _ in stages]
+    sink_stats = StageStats(sink)
+
+    def run(i, func):
+        stage = stage_stats[i]
+        start = time.perf_counter()
+        inputs = channels[i - 1].drain(stage) if i else iter(())
+        outputs = None
+        try:
+            with tracing.span(stage.name) as span:
+                outputs = func(inputs)
+                for item in outputs:
+                    stage.items += 1
+                    stage.sample_rss()
+                    channels[i].put(item, stage)
+                channels[i].put(_END, stage)
+                span.set(
+                    items=stage.items,
+                    wait_seconds=round(stage.wait_seconds, 4)
+                )
+        except _Stopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if outputs is not None and hasattr(outputs, 'close'):
+                outputs.close()
+            stage.wall_seconds = time.perf_counter() - start
+
+    # Each stage runs in a copy of the caller's context, so its spans
+    # nest under the caller's.
+    threads = [
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(run, i, func),
+            daemon=True
+        )
+        for i, (_, func) in enumerate(stages)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    try:
+        for item in channels[-1].drain(sink_stats):
+            yield item
+            sink_stats.items += 1
+            sink_stats.sample_rss()
+    except _Stopped:
+        pass
+    finally:
+        # After a normal end every stage has finished already; if the
+        # caller stopped early, this unblocks the stages still running.
+        stop.set()
+        for thread in threads:
+            thread.join()
+        sink_stats.wall_seconds = time.perf_counter() - start
+        for stage in stage_stats + [sink_stats]:
+            tracing.count('stage_items_total', stage.items, stage=stage.name)
+            tracing.count(
+                'stage_busy_seconds_total', stage.busy_seconds,
+                stage=stage.name
+            )
+            tracing.count(
+                'stage_wait_seconds_total', stage.wait_seconds,
+                stage=stage.name
+            )
+        if stats is not None:
+            stats.extend(stage_stats + [sink_stats])
+
+    if errors:
+        raise errors[0]
+
+
+def print_stage_stats(
+    stats: list[StageStats]
+) -> None:
+    """
+    Prints a table of stage statistics and the peak RSS of the process.
+
+    Args:
+        stats (list[StageStats]): Statistics filled in by run_stages.
+    """
+    print(f'{"Stage":<10} {"Items":>8} {"Wall s":>9} {"Busy s":>9} '
+          f'{"Wait s":>9} {"Peak RSS MiB":>13}')
+    for stage in stats:
+        peak = (
+            f'{stage.peak_rss_bytes / 1024 ** 2:.1f}'
+            if stage.peak_rss_bytes is not None else '-'
+        )
+        print(f'{stage.name:<10} {stage.items:>8} '
+              f'{stage.wall_seconds:>9.2f} {stage.busy_seconds:>9.2f} '
+              f'{stage.wait_seconds:>9.2f} {peak:>13}')
+
+    peak = peak_rss_bytes()
+    if peak is not None:
+        print(f'Peak RSS of the build process: {peak / 1024 ** 2:.1f} MiB.')
@@ -0,0 +1,46 @@
+"""
+Process memory figures used to report the cost of loading indices and
+of each build stage.
+"""
+
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def rss_bytes() -> int | None:
+    """
+    Returns the resident set size of the current process.
+
+    Returns:
+        int | None: RSS in bytes, or None if it cannot be read on this
+            platform.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as fin:
+            resident_pages = int(fin.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def peak_rss_bytes() -> int | None:
+    """
+    Returns the peak resident set size of the current process since it
+    started.
+
+    Returns:
+        int | None: Peak RSS in bytes, or None if it cannot be read on
+            this platform.
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in KiB elsewhere.
+    return peak if sys.platform == 'darwin' else peak * 1024
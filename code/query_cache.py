@@ -0,0 +1,825 @@
+"""
+Caches on the query path: query embeddings (an in-memory LRU in front
+of a persistent EmbeddingCache) and generated answers (SQLite with a TTL
+and size-based eviction), so repeated questions skip both API calls.
+Paraphrased questions are served by a semantic answer cache, which
+matches new queries against the embeddings of past ones.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+import tracing
+from chunk_store import ChunkStore
+from embedding_cache import EmbeddingCache
+
+
+QUERY_MEMORY_ENTRIES = 1024
+QUERY_STORE_MAX_BYTES = 256 * 1024 ** 2
+
+ANSWER_TTL_SECONDS = 7 * 24 * 3600
+ANSWER_MAX_ENTRIES = 10_000
+
+# A past answer is served for a new query if their embeddings reach
+# SEMANTIC_THRESHOLD cosine similarity and the Jaccard overlap of their
+# retrieved chunk IDs reaches SEMANTIC_MIN_OVERLAP. The overlap check
+# keeps answers grounded in the chunks the new query retrieves.
+SEMANTIC_THRESHOLD = 0.92
+SEMANTIC_MIN_OVERLAP = 0.6
+SEMANTIC_CANDIDATES = 4
+SEMANTIC_MAX_ENTRIES = 5_000
+
+
+def normalize_query(
+    query: str
+) -> str:
+    """
+    Normalizes a query so trivially different spellings of the same
+    question share cache entries.
+
+    Args:
+        query (str): The user query.
+
+    Returns:
+        str: The query in lower case with whitespace collapsed.
+    """
+    return ' '.join(query.lower().split())
+
+
+class QueryEmbeddingCache:
+    """
+    Two-level cache of query embeddings keyed by (model, normalized
+    query): an in-memory LRU backed by a persistent EmbeddingCache that
+    survives restarts. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = QUERY_MEMORY_ENTRIES,
+        max_bytes: int = QUERY_STORE_MAX_BYTES
+    ) -> None:
+        """
+        Opens (or creates) the persistent store.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            max_entries (int): Maximum number of embeddings kept in
+                memory. Default is QUERY_MEMORY_ENTRIES.
+            max_bytes (int): Maximum size of the persistent store in
+                bytes. Default is QUERY_STORE_MAX_BYTES (256 MiB).
+        """
+        self.max_entries = max_entries
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._store = EmbeddingCache(path, max_bytes=max_bytes)
+
+    def get(
+        self,
+        model_name: str,
+        query: str
+    ) -> np.ndarray | None:
+        """
+        Looks up the embedding of a query, promoting store hits into
+        memory.
+
+        Args:
+            model_name (str): Name of the embedding model.
+            query (str): The user query.
+
+        Returns:
+            np.ndarray | None: Embedding of shape (1, dim), or None for
+                a miss.
+        """
+        key = (model_name, normalize_query(query))
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+
+        embedding = self._store.get_many(model_name, [key[1]])[0]
+        with self._lock:
+            if embedding is None:
+                self.misses += 1
+                return None
+
+            self.store_hits += 1
+            embedding = embedding.reshape(1, -1)
+            self._remember(key, embedding)
+
+        return embedding
+
+    def put(
+        self,
+        model_name: str,
+        query: str,
+        embedding: np.ndarray
+    ) -> None:
+        """
+        Stores the embedding of a query in memory and on disk.
+
+        Args:
+            model_name (str): Name of the embedding model.
+            query (str): The user query.
+            embedding (np.ndarray): Embedding of shape (1, dim).
+        """
+        key = (model_name, normalize_query(query))
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        self._store.put_many(model_name, [key[1]], embedding)
+        with self._lock:
+            self._remember(key, embedding)
+
+    def _remember(
+        self,
+        key: tuple,
+        embedding: np.ndarray
+    ) -> None:
+        """
+        Inserts an embedding into the in-memory LRU. Must be called with
+        the lock held.
+
+        Args:
+            key (tuple): (model name, normalized query).
+            embedding (np.ndarray): Embedding of shape (1, dim).
+        """
+        embedding.flags.writeable = False
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        Returns cache statistics.
+
+        Returns:
+            dict: Memory hits, persistent store hits, misses, overall
+                hit rate and number of entries held in memory.
+        """
+        with self._lock:
+            hits = self.memory_hits + self.store_hits
+            lookups = hits + self.misses
+
+            return {
+                'memory_hits': self.memory_hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory)
+            }
+
+    def close(self) -> None:
+        """
+        Closes the persistent store.
+        """
+        self._store.close()
+
+
+def content_digest(
+    chunks: dict[int, dict],
+    ids: list[int]
+) -> str:
+    """
+    Digests the content of some chunks, in order.
+
+    Args:
+        chunks (dict[int, dict]): Chunks keyed by ID.
+        ids (list[int]): IDs of the chunks to digest.
+
+    Returns:
+        str: Hex SHA-256 digest.
+    """
+    content = hashlib.sha256()
+    for idx in ids:
+        content.update(chunks[idx]['content'].encode('utf-8'))
+        content.update(b'\0')
+
+    return content.hexdigest()
+
+
+def answer_key(
+    project_name: str,
+    query: str,
+    chunks: dict[int, dict],
+    top_indices: list[int],
+    model_name: str,
+    prompt_version: int
+) -> str:
+    """
+    Builds the answer cache key of a question.
+
+    The retrieved chunks are identified by ID and a digest of their
+    content, since a rebuilt PDF keeps its chunk IDs but may change
+    their text. The order of the chunks is kept because it shapes the
+    prompt.
+
+    Args:
+        project_name (str): Selected project, or 'All Projects'.
+        query (str): The user query.
+        chunks (dict[int, dict]): The retrieved chunks, keyed by ID.
+        top_indices (list[int]): The IDs of the top chunks, in order.
+        model_name (str): Name of the chat model.
+        prompt_version (int): Version of the prompt templates.
+
+    Returns:
+        str: Hex SHA-256 digest identifying the answer.
+    """
+    key = json.dumps([
+        project_name,
+        normalize_query(query),
+        [int(idx) for idx in top_indices],
+        content_digest(chunks, top_indices),
+        model_name,
+        prompt_version
+    ])
+
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """
+    SQLite-backed cache of generated answers with a time-to-live and a
+    bound on the number of entries, evicting the least recently used
+    first. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: float = ANSWER_TTL_SECONDS,
+        max_entries: int = ANSWER_MAX_ENTRIES
+    ) -> None:
+        """
+        Opens (or creates) the cache database.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            ttl_seconds (float): Age after which an answer expires.
+                Default is ANSWER_TTL_SECONDS (7 days).
+            max_entries (int): Maximum number of stored answers.
+                Default is ANSWER_MAX_ENTRIES.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS answers ('
+            'key TEXT PRIMARY KEY, '
+            'answer TEXT NOT NULL, '
+            'created REAL NOT NULL, '
+            'last_access REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_answers_last_access '
+            'ON answers (last_access)'
+        )
+        self._conn.commit()
+
+    def get(
+        self,
+        key: str
+    ) -> str | None:
+        """
+        Looks up an answer, dropping it if it has expired.
+
+        Args:
+            key (str): Key built by answer_key.
+
+        Returns:
+            str | None: The cached answer, or None for a miss.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT answer, created FROM answers WHERE key = ?', (key,)
+            ).fetchone()
+
+            if row is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute('DELETE FROM answers WHERE key = ?', (key,))
+                self._conn.commit()
+                self.expired += 1
+                row = None
+
+            if row is None:
+                self.misses += 1
+                tracing.count('cache_lookups_total', cache='answer', hit=False)
+                return None
+
+            self._conn.execute(
+                'UPDATE answers SET last_access = ? WHERE key = ?', (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            tracing.count('cache_lookups_total', cache='answer', hit=True)
+
+            return row[0]
+
+    def put(
+        self,
+        key: str,
+        answer: str
+    ) -> None:
+        """
+        Stores an answer, then evicts expired and least recently used
+        entries if the cache is over its limit.
+
+        Args:
+            key (str): Key built by answer_key.
+            answer (str): The generated answer.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO answers '
+                '(key, answer, created, last_access) VALUES (?, ?, ?, ?)',
+                (key, answer, now, now)
+            )
+            self._conn.commit()
+            self._evict(now)
+
+    def _evict(
+        self,
+        now: float
+    ) -> None:
+        """
+        Deletes expired answers, then the least recently used ones
+        until at most max_entries remain. Must be called with the lock
+        held.
+
+        Args:
+            now (float): Current time in seconds since the epoch.
+        """
+        count = self._conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+        if count <= self.max_entries:
+            return
+
+        cursor = self._conn.execute(
+            'DELETE FROM answers WHERE created < ?', (now - self.ttl_seconds,)
+        )
+        self.expired += cursor.rowcount
+        count -= cursor.rowcount
+
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM answers WHERE key IN ('
+                'SELECT key FROM answers ORDER BY last_access ASC LIMIT ?)',
+                (count - self.max_entries,)
+            )
+            self.evictions += count - self.max_entries
+        self._conn.commit()
+
+    def stats(self) -> dict:
+        """
+        Returns cache statistics.
+
+        Returns:
+            dict: Hits, misses, hit rate, expired and evicted answers,
+                and number of entries.
+        """
+        with self._lock:
+            entries = self._conn.execute(
+                'SELECT COUNT(*) FROM answers'
+            ).fetchone()[0]
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'entries': entries
+        }
+
+    def close(self) -> None:
+        """
+        Closes the underlying database connection.
+        """
+        with self._lock:
+            self._conn.close()
+
+
+def semantic_scope(
+    project_name: str,
+    model_name: str,
+    prompt_version: int,
+    embedder_id: str
+) -> str:
+    """
+    Builds the scope of the semantic answer cache within which past
+    answers may be served to paraphrased queries.
+
+    Args:
+        project_name (str): Selected project, or 'All Projects'.
+        model_name (str): Name of the chat model.
+        prompt_version (int): Version of the prompt templates.
+        embedder_id (str): Model ID of the query embedder.
+
+    Returns:
+        str: The scope.
+    """
+    return json.dumps([project_name, model_name, prompt_version, embedder_id])
+
+
+class SemanticAnswerCache:
+    """
+    Cache of generated answers looked up by query similarity rather
+    than by exact query, so colleagues asking the same question in
+    different words share one LLM call.
+
+    Each scope (project, chat model, prompt version and embedder) has an
+    in-memory FAISS inner-product index of the normalized embeddings of
+    past queries, loaded from SQLite on first use. An answer is served
+    if its query is similar enough and the chunks it was generated from
+    overlap the newly retrieved ones enough. Answers whose chunks were
+    changed or removed by a rebuild are invalidated when they are next
+    matched. Expired and least recently used entries are evicted. Safe
+    to share between threads.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        threshold: float = SEMANTIC_THRESHOLD,
+        min_overlap: float = SEMANTIC_MIN_OVERLAP,
+        ttl_seconds: float = ANSWER_TTL_SECONDS,
+        max_entries: int = SEMANTIC_MAX_ENTRIES
+    ) -> None:
+        """
+        Opens (or creates) the cache database.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            threshold (float): Minimum cosine similarity of the query
+                embeddings. Default is SEMANTIC_THRESHOLD.
+            min_overlap (float): Minimum Jaccard overlap of the
+                retrieved chunk IDs. Default is SEMANTIC_MIN_OVERLAP.
+            ttl_seconds (float): Age after which an answer expires.
+                Default is ANSWER_TTL_SECONDS (7 days).
+            max_entries (int): Maximum number of stored answers.
+                Default is SEMANTIC_MAX_ENTRIES.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.threshold = threshold
+        self.min_overlap = min_overlap
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.invalidated = 0
+        self.expired = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._indices = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS answers ('
+            'id INTEGER PRIMARY KEY, '
+            'scope TEXT NOT NULL, '
+            'project TEXT NOT NULL, '
+            'query TEXT NOT NULL, '
+            'embedding BLOB NOT NULL, '
+            'chunk_ids TEXT NOT NULL, '
+            'digest TEXT NOT NULL, '
+            'answer TEXT NOT NULL, '
+            'created REAL NOT NULL, '
+            'last_access REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_answers_scope ON answers (scope)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_answers_project '
+            'ON answers (project)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_answers_last_access '
+            'ON answers (last_access)'
+        )
+        self._conn.commit()
+
+    def _index(
+        self,
+        scope: str,
+        dim: int
+    ) -> faiss.Index:
+        """
+        Returns the query index of a scope, loading it on first use.
+        Must be called with the lock held.
+
+        Args:
+            scope (str): Scope built by semantic_scope.
+            dim (int): Dimension of the query embeddings.
+
+        Returns:
+            faiss.Index: Index of the scope's query embeddings, keyed by
+                entry ID.
+        """
+        index = self._indices.get(scope)
+        if index is not None:
+            return index
+
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        rows = self._conn.execute(
+            'SELECT id, embedding FROM answers WHERE scope = ?', (scope,)
+        ).fetchall()
+        rows = [row for row in rows if len(row[1]) == dim * 4]
+        if rows:
+            index.add_with_ids(
+                np.vstack([
+                    np.frombuffer(embedding, dtype=np.float32)
+                    for _, embedding in rows
+                ]),
+                np.array([entry_id for entry_id, _ in rows], dtype=np.int64)
+            )
+        self._indices[scope] = index
+
+        return index
+
+    def _delete(
+        self,
+        entry_ids: list[int]
+    ) -> None:
+        """
+        Deletes entries from the database and the loaded indices. Must
+        be called with the lock held.
+
+        Args:
+            entry_ids (list[int]): IDs of the entries.
+        """
+        if not entry_ids:
+            return
+
+        self._conn.executemany(
+            'DELETE FROM answers WHERE id = ?',
+            ((entry_id,) for entry_id in entry_ids)
+        )
+        self._conn.commit()
+        selector = faiss.IDSelectorBatch(
+            np.array(entry_ids, dtype=np.int64)
+        )
+        for index in self._indices.values():
+            index.remove_ids(selector)
+
+    def get(
+        self,
+        scope: str,
+        embedding: np.ndarray,
+        top_indices: list[int],
+        store: ChunkStore
+    ) -> str | None:
+        """
+        Looks up the answer of the most similar past query whose chunks
+        overlap the retrieved ones, dropping matched answers that have
+        expired or whose chunks have changed since.
+
+        Args:
+            scope (str): Scope built by semantic_scope.
+            embedding (np.ndarray): Query embedding of shape (1, dim).
+            top_indices (list[int]): The IDs of the retrieved chunks.
+            store (ChunkStore): The chunk store, used to check that the
+                chunks of a matched answer are unchanged.
+
+        Returns:
+            str | None: The cached answer, or None for a miss.
+        """
+        query = np.array(embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(query)
+        retrieved = {int(idx) for idx in top_indices}
+        now = time.time()
+
+        with self._lock:
+            index = self._index(scope, query.shape[1])
+            if index.ntotal:
+                scores, entry_ids = index.search(
+                    query, min(SEMANTIC_CANDIDATES, index.ntotal)
+                )
+            else:
+                scores, entry_ids = np.zeros((1, 0)), np.zeros((1, 0))
+
+            stale = []
+            answer = None
+            for score, entry_id in zip(scores[0], entry_ids[0]):
+                if entry_id < 0 or score < self.threshold:
+                    break
+                row = self._conn.execute(
+                    'SELECT chunk_ids, digest, answer, created FROM answers '
+                    'WHERE id = ?', (int(entry_id),)
+                ).fetchone()
+                if row is None:
+                    # Deleted by another process, e.g. a build.
+                    stale.append(int(entry_id))
+                    continue
+                if now - row[3] > self.ttl_seconds:
+                    stale.append(int(entry_id))
+                    self.expired += 1
+                    continue
+
+                chunk_ids = json.loads(row[0])
+                overlap = len(retrieved & set(chunk_ids)) / len(
+                    retrieved | set(chunk_ids)
+                )
+                if overlap < self.min_overlap:
+                    self.rejected += 1
+                    continue
+
+                chunks = store.get_many(chunk_ids)
+                if (
+                    len(chunks) < len(chunk_ids)
+                    or content_digest(chunks, chunk_ids) != row[1]
+                ):
+                    stale.append(int(entry_id))
+                    self.invalidated += 1
+                    continue
+
+                answer = row[2]
+                self._conn.execute(
+                    'UPDATE answers SET last_access = ? WHERE id = ?',
+                    (now, int(entry_id))
+                )
+                self._conn.commit()
+                break
+
+            self._delete(stale)
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            tracing.count(
+                'cache_lookups_total', cache='semantic',
+                hit=answer is not None
+            )
+
+        return answer
+
+    def put(
+        self,
+        scope: str,
+        project_name: str,
+        query: str,
+        embedding: np.ndarray,
+        chunks: dict[int, dict],
+        top_indices: list[int],
+        answer: str
+    ) -> None:
+        """
+        Stores an answer, then evicts expired and least recently used
+        entries if the cache is over its limit.
+
+        Args:
+            scope (str): Scope built by semantic_scope.
+            project_name (str): Selected project, or 'All Projects'.
+            query (str): The user query.
+            embedding (np.ndarray): Query embedding of shape (1, dim).
+            chunks (dict[int, dict]): The retrieved chunks, keyed by ID.
+            top_indices (list[int]): The IDs of the top chunks the
+                answer was generated from.
+            answer (str): The generated answer.
+        """
+        vector = np.array(embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        chunk_ids = [int(idx) for idx in top_indices]
+        now = time.time()
+
+        with self._lock:
+            index = self._index(scope, vector.shape[1])
+            cursor = self._conn.execute(
+                'INSERT INTO answers (scope, project, query, embedding, '
+                'chunk_ids, digest, answer, created, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    scope,
+                    project_name,
+                    normalize_query(query),
+                    vector.tobytes(),
+                    json.dumps(chunk_ids),
+                    content_digest(chunks, chunk_ids),
+                    answer,
+                    now,
+                    now
+                )
+            )
+            self._conn.commit()
+            index.add_with_ids(
+                vector, np.array([cursor.lastrowid], dtype=np.int64)
+            )
+            self._evict(now)
+
+    def _evict(
+        self,
+        now: float
+    ) -> None:
+        """
+        Deletes expired answers, then the least recently used ones
+        until at most max_entries remain. Must be called with the lock
+        held.
+
+        Args:
+            now (float): Current time in seconds since the epoch.
+        """
+        count = self._conn.execute(
+            'SELECT COUNT(*) FROM answers'
+        ).fetchone()[0]
+        if count <= self.max_entries:
+            return
+
+        expired = [row[0] for row in self._conn.execute(
+            'SELECT id FROM answers WHERE created < ?',
+            (now - self.ttl_seconds,)
+        )]
+        self._delete(expired)
+        self.expired += len(expired)
+        count -= len(expired)
+
+        if count > self.max_entries:
+            evicted = [row[0] for row in self._conn.execute(
+                'SELECT id FROM answers ORDER BY last_access ASC LIMIT ?',
+                (count - self.max_entries,)
+            )]
+            self._delete(evicted)
+            self.evictions += len(evicted)
+
+    def invalidate(
+        self,
+        projects: list[str]
+    ) -> int:
+        """
+        Drops the answers of rebuilt or deleted projects. Answers across
+        all projects are left to be checked when they are next matched.
+
+        Args:
+            projects (list[str]): Names of the projects.
+
+        Returns:
+            int: Number of answers dropped.
+        """
+        with self._lock:
+            entry_ids = [
+                row[0]
+                for project in projects
+                for row in self._conn.execute(
+                    'SELECT id FROM answers WHERE project = ?', (project,)
+                )
+            ]
+            self._delete(entry_ids)
+            self.invalidated += len(entry_ids)
+
+        return len(entry_ids)
+
+    def stats(self) -> dict:
+        """
+        Returns cache statistics.
+
+        Returns:
+            dict: Hits, misses, hit rate, similar queries rejected for
+                retrieving different chunks, invalidated, expired and
+                evicted answers, and number of entries.
+        """
+        with self._lock:
+            entries = self._conn.execute(
+                'SELECT COUNT(*) FROM answers'
+            ).fetchone()[0]
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'rejected': self.rejected,
+            'invalidated': self.invalidated,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'entries': entries
+        }
+
+    def close(self) -> None:
+        """
+        Closes the underlying database connection.
+        """
+        with self._lock:
+            self._conn.close()
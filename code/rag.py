@@ -2,8 +2,15 @@
 Retrieval-Augmented Generation (RAG) implementation.
 """
 
+import time
+import threading
+from collections.abc import Iterator
+
 from openai import OpenAI
 
+import tracing
+from embedders import estimate_tokens
+
 
 SYSTEM_PROMPT = (
     "You are an expert assistant specialized in providing factual, well-reasoned, and concise answers "
@@ -24,6 +31,24 @@ User Question: {query}
 Answer: """
 )
 
+# Bump whenever the prompts or format_prompt change, so that answers
+# cached under the old prompt are no longer served.
+PROMPT_VERSION = 2
+
+# Estimated token budget of the retrieved context for each model. Prompt
+# size drives both latency and cost, so it is capped well below the
+# context windows; the lowest-ranked chunks are dropped to fit.
+CONTEXT_TOKEN_BUDGETS = {
+    'gpt-3.5-turbo': 6000,
+    'gpt-4o-mini': 8000,
+    'gpt-4o': 8000
+}
+DEFAULT_CONTEXT_TOKENS = 6000
+
+# Chunks of the same page are merged if the end of one repeats at least
+# this many words of the start of the other (chunks overlap by 50).
+MIN_MERGE_OVERLAP = 8
+
 
 def load_openai_api_key(key_path: str) -> OpenAI:
     """
@@ -41,30 +66,225 @@ def load_openai_api_key(key_path: str) -> OpenAI:
     return OpenAI(api_key=api_key)
 
 
+def context_budget(
+    model_name: str
+) -> int:
+    """
+    Returns the context token budget of a model.
+
+    Args:
+        model_name (str): The name of the OpenAI model.
+
+    Returns:
+        int: Estimated number of context tokens allowed.
+    """
+    return CONTEXT_TOKEN_BUDGETS.get(model_name, DEFAULT_CONTEXT_TOKENS)
+
+
+def _source_header(
+    metadata: dict
+) -> str:
+    """
+    Formats the source line of a context section.
+
+    Args:
+        metadata (dict): Chunk metadata.
+
+    Returns:
+        str: The source line.
+    """
+    return f'[Source: {metadata["source"]} - Page: {metadata["page_number"]}]'
+
+
+def _combine_words(
+    first: list[str],
+    second: list[str]
+) -> list[str] | None:
+    """
+    Combines two word windows of the same page into one passage if one
+    contains the other or the end of one overlaps the start of the
+    other.
+
+    Args:
+        first (list[str]): Words of one window.
+        second (list[str]): Words of the other window.
+
+    Returns:
+        list[str] | None: The combined words, or None if the windows
+            overlap by fewer than MIN_MERGE_OVERLAP words.
+    """
+    first_text = f' {" ".join(first)} '
+    second_text = f' {" ".join(second)} '
+    if second_text in first_text:
+        return first
+    if first_text in second_text:
+        return second
+
+    for head, tail in ((first, second), (second, first)):
+        for i, word in enumerate(head):
+            overlap = len(head) - i
+            if overlap < MIN_MERGE_OVERLAP:
+                break
+            if word == tail[0] and head[i:] == tail[:overlap]:
+                return head + tail[overlap:]
+
+    return None
+
+
+def pack_context(
+    chunks: dict[int, dict],
+    top_indices: list[int],
+    max_tokens: int = None
+) -> tuple[str, dict]:
+    """
+    Builds the context of a prompt from ranked chunks with as few
+    tokens as possible.
+
+    Duplicate chunks (the same text in several files, or a window
+    contained in another) are removed, overlapping windows of the same
+    page are merged into one passage, and the sections of each page
+    are grouped under one source line. If the result exceeds
+    max_tokens, the lowest-ranked passages are dropped.
+
+    Args:
+        chunks (dict[int, dict]): The retrieved chunks with metadata,
+            keyed by chunk ID.
+        top_indices (list[int]): The IDs of the top chunks, best first.
+            IDs missing from chunks are skipped.
+        max_tokens (int): Estimated token budget of the context.
+            Default is None (no budget).
+
+    Returns:
+        tuple[str, dict]: The context, and packing statistics: number
+            of chunks given, duplicates removed, merges, passages
+            dropped for the budget, and estimated tokens before and
+            after packing and saved.
+    """
+    # Chunks missing from the store (replaced since the search) are
+    # skipped.
+    top_indices = [idx for idx in top_indices if idx in chunks]
+
+    # The context format_prompt built before packing, for comparison.
+    naive = '\n\n'.join(
+        _source_header(chunks[idx]['metadata']) + '\n'
+        + chunks[idx]['content'].strip().replace('\n', ' ')
+        for idx in top_indices
+    )
+
+    # Passages of each page as word lists; a passage ranks as its best
+    # chunk.
+    pages = {}
+    seen = set()
+    duplicates = 0
+    merges = 0
+    for rank, idx in enumerate(top_indices):
+        metadata = chunks[idx]['metadata']
+        words = chunks[idx]['content'].split()
+        text = ' '.join(words)
+        if not words or text in seen:
+            duplicates += 1
+            continue
+        seen.add(text)
+
+        key = (metadata['path'], metadata['page_number'])
+        page = pages.setdefault(key, {'metadata': metadata, 'items': []})
+        passage = {'rank': rank, 'words': words}
+        combined = True
+        while combined:
+            # A merged passage may in turn overlap another one.
+            combined = False
+            for item in page['items']:
+                merged = _combine_words(item['words'], passage['words'])
+                if merged is not None:
+                    page['items'].remove(item)
+                    passage = {
+                        'rank': min(item['rank'], passage['rank']),
+                        'words': merged
+                    }
+                    merges += 1
+                    combined = True
+                    break
+        page['items'].append(passage)
+
+    passages = sorted(
+        (
+            (item['rank'], key, ' '.join(item['words']))
+            for key, page in pages.items() for item in page['items']
+        ),
+        key=lambda passage: passage[0]
+    )
+
+    kept = []
+    used = 0
+    dropped = 0
+    for rank, key, text in passages:
+        header = _source_header(pages[key]['metadata'])
+        tokens = estimate_tokens(text) + estimate_tokens(header)
+        if max_tokens is not None and used + tokens > max_tokens:
+            if kept:
+                dropped += 1
+                continue
+            # Even the best passage is too long; keep what fits of it.
+            text = text[:max(max_tokens - estimate_tokens(header), 1) * 4]
+            tokens = max_tokens
+        kept.append((rank, key, text))
+        used += tokens
+
+    # Sections are grouped by page, pages ordered by their best passage.
+    sections = {}
+    for rank, key, text in kept:
+        sections.setdefault(key, []).append(text)
+    context = '\n\n'.join(
+        _source_header(pages[key]['metadata']) + '\n' + '\n...\n'.join(texts)
+        for key, texts in sections.items()
+    )
+
+    tokens_before = estimate_tokens(naive)
+    tokens_after = estimate_tokens(context)
+
+    return context, {
+        'chunks': len(top_indices),
+        'duplicates': duplicates,
+        'merges': merges,
+        'dropped': dropped,
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'tokens_saved': max(tokens_before - tokens_after, 0)
+    }
+
+
 def format_prompt(
     query: str,
-    chunks: list[dict],
-    top_indices: list[int]
+    chunks: dict[int, dict],
+    top_indices: list[int],
+    max_context_tokens: int = None,
+    stats: dict = None
 ) -> str:
     """
-    Formats the prompt for the language model.
+    Formats the prompt for the language model, packing the retrieved
+    chunks into as few context tokens as possible (see pack_context).
 
     Args:
         query (str): The user query.
-        chunks (list[dict]): The list of document chunks with metadata.
-        top_indices (list[int]): The indices of the top chunks.
+        chunks (dict[int, dict]): The retrieved chunks with metadata,
+            keyed by chunk ID. Only the top chunks need to be present.
+        top_indices (list[int]): The IDs of the top chunks, best first.
+        max_context_tokens (int): Estimated token budget of the
+            context, e.g. context_budget(model_name). Default is None
+            (no budget).
+        stats (dict): Filled with the packing statistics returned by
+            pack_context. Default is None.
 
     Returns:
         str: The formatted prompt.
     """
-    context = ''
-    for idx in top_indices:
-        chunk = chunks[idx]
-        metadata = chunk['metadata']
-        content = chunk['content'].strip().replace('\n', ' ')
-        context += f'[Source: {metadata["source"]} - Page: '
-        context += f'{metadata["page_number"]}]\n{content}\n\n'
-    context = context.strip()
+    with tracing.span('format_prompt', chunks=len(top_indices)) as span:
+        context, packing = pack_context(
+            chunks, top_indices, max_context_tokens
+        )
+        span.set(**packing)
+    if stats is not None:
+        stats.update(packing)
 
     return USER_PROMPT.format(context=context, query=query)
 
@@ -88,14 +308,121 @@ def call_openai_model(
     Returns:
         str: The generated response from the model.
     """
-    response = client.chat.completions.create(
+    with tracing.span('llm', model=model_name, stream=False) as span:
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {'role': 'system', 'content': SYSTEM_PROMPT},
+                {'role': 'user', 'content': prompt}
+            ],
+            max_tokens=max_tokens,
+            temperature=0.3
+        )
+        answer = response.choices[0].message.content.strip()
+
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            prompt_tokens = usage.prompt_tokens
+            completion_tokens = usage.completion_tokens
+        else:
+            prompt_tokens = estimate_tokens(SYSTEM_PROMPT + prompt)
+            completion_tokens = estimate_tokens(answer)
+        span.set(
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+        )
+        record_llm_usage(model_name, prompt_tokens, completion_tokens)
+
+    return answer
+
+
+def record_llm_usage(
+    model_name: str,
+    prompt_tokens: int,
+    completion_tokens: int
+) -> None:
+    """
+    Adds a chat completion to the request and token counters.
+
+    Args:
+        model_name (str): The name of the OpenAI model used.
+        prompt_tokens (int): Tokens of the prompt.
+        completion_tokens (int): Tokens of the answer.
+    """
+    tracing.count('openai_requests_total', endpoint='chat', model=model_name)
+    tracing.count(
+        'openai_tokens_total', prompt_tokens,
+        endpoint='chat', model=model_name, kind='prompt'
+    )
+    tracing.count(
+        'openai_tokens_total', completion_tokens,
+        endpoint='chat', model=model_name, kind='completion'
+    )
+
+
+def stream_openai_model(
+    client: OpenAI,
+    prompt: str,
+    model_name: str = 'gpt-3.5-turbo',
+    max_tokens: int = 512,
+    cancel: threading.Event = None,
+    timings: dict = None
+) -> Iterator[str]:
+    """
+    Calls the OpenAI API and yields the response text as it arrives.
+
+    The stream is closed as soon as cancel is set or the caller stops
+    iterating, so an abandoned answer stops consuming tokens.
+
+    Args:
+        client (OpenAI): An instance of the OpenAI client.
+        prompt (str): The input prompt for the model.
+        model_name (str): The name of the OpenAI model to use.
+        max_tokens (int): Maximum number of tokens to generate.
+            Default is 512.
+        cancel (threading.Event): Stops the generation when set.
+            Default is None.
+        timings (dict): Filled with 'ttft_seconds' (time to first
+            token, None if none arrived), 'total_seconds' and
+            'cancelled' once the generation ends. Default is None.
+
+    Yields:
+        str: Successive pieces of the generated response.
+    """
+    start = time.perf_counter()
+    ttft = None
+    cancelled = False
+
+    stream = client.chat.completions.create(
         model=model_name,
         messages=[
             {'role': 'system', 'content': SYSTEM_PROMPT},
             {'role': 'user', 'content': prompt}
         ],
         max_tokens=max_tokens,
-        temperature=0.3
+        temperature=0.3,
+        stream=True
     )
+    try:
+        for chunk in stream:
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+            if not chunk.choices:
+                continue
 
-    return response.choices[0].message.content.strip()
+            content = chunk.choices[0].delta.content
+            if content:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                yield content
+    except GeneratorExit:
+        cancelled = True
+        raise
+    finally:
+        stream.close()
+        if timings is not None:
+            timings.update(
+                ttft_seconds=ttft,
+                total_seconds=time.perf_counter() - start,
+                cancelled=cancelled
+            )
@@ -0,0 +1,85 @@
+"""
+Token-bucket rate limiting of API requests shared between threads.
+"""
+
+import time
+import threading
+
+import tracing
+
+
+class RateLimiter:
+    """
+    Token bucket refilled at a constant rate. Each request takes one or
+    more tokens and waits while the bucket is empty, so requests are
+    spread out to the rate while short bursts up to the bucket size
+    pass at once. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = None,
+        name: str = 'api'
+    ) -> None:
+        """
+        Creates a full bucket.
+
+        Args:
+            rate (float): Tokens added per second, e.g. requests per
+                minute / 60.
+            burst (float): Size of the bucket. Default is None (one
+                second's worth of tokens, at least 1).
+            name (str): Label of the wait-time metric. Default is
+                'api'.
+        """
+        if rate <= 0:
+            raise ValueError(f'Rate must be positive, got {rate}.')
+
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self.name = name
+        self.waited_seconds = 0.0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(
+        self,
+        tokens: float = 1.0
+    ) -> float:
+        """
+        Takes tokens from the bucket, waiting until they are available.
+
+        Args:
+            tokens (float): Tokens to take, e.g. 1 per request or the
+                estimated tokens of a request under a tokens-per-minute
+                limit. Capped at the bucket size. Default is 1.0.
+
+        Returns:
+            float: Seconds waited.
+        """
+        tokens = min(tokens, self.burst)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.waited_seconds += waited
+                    break
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+        if waited:
+            tracing.count(
+                'rate_limit_wait_seconds_total', waited, limiter=self.name
+            )
+
+        return waited
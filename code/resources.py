@@ -0,0 +1,454 @@
+"""
+Process-wide registry of warm search resources (the shared FAISS, BM25
+and chunk store, the query embedder matching the index, per-project ID
+filters), the query, answer and preview caches
+and the shared OpenAI client, so they are loaded once and reused across
+queries and sessions instead of on every search.
+"""
+
+import os
+import time
+import threading
+from dataclasses import dataclass
+
+import faiss
+import numpy as np
+from openai import OpenAI
+
+import tracing
+from chunk_store import ChunkStore
+from bm25_index import BM25Index, has_bm25_index
+from rag import load_openai_api_key, PROMPT_VERSION
+from profiling import rss_bytes
+from embedders import (
+    Embedder,
+    embedder_spec,
+    embedder_from_info,
+    check_embedder
+)
+from faiss_search import load_index, make_id_selector, embed_query
+from faiss_index import load_index_info
+from page_cache import PageImageCache
+from catalog import build_version
+from query_cache import (
+    QueryEmbeddingCache,
+    AnswerCache,
+    SemanticAnswerCache,
+    semantic_scope
+)
+
+
+@dataclass
+class IndexResources:
+    """
+    Loaded resources of one build of the shared index.
+    """
+    index: faiss.Index
+    store: ChunkStore
+    lexical: BM25Index | None
+    embedder: Embedder
+    info: dict
+    version: str | tuple
+    load_seconds: float
+    index_bytes: int
+    rss_delta_bytes: int | None
+    project_ids: dict
+    selectors: dict
+
+
+class ResourceRegistry:
+    """
+    Loads the shared index and chunk store once and shares them between
+    all callers, together with one ID selector per project for filtered
+    searches. A rebuilt index is detected by the build ID of its
+    catalog, written once the build is complete, and hot-swapped on
+    the next access; callers holding the old resources keep using them
+    safely because builds replace files atomically.
+    """
+
+    def __init__(
+        self,
+        index_folder: str,
+        key_path: str,
+        cache_folder: str,
+        mmap: bool = True,
+        client: OpenAI = None,
+        semantic: bool = True
+    ) -> None:
+        """
+        Creates an empty registry and opens the query-path caches.
+
+        Args:
+            index_folder (str): Path to the folder of the shared index.
+            key_path (str): Path to the file containing the OpenAI API
+                key.
+            cache_folder (str): Path to the folder holding the query
+                embedding, answer, semantic answer and page image
+                caches.
+            mmap (bool): Whether to memory-map the FAISS index instead
+                of reading it into RAM. Default is True.
+            client (OpenAI): Client to use instead of creating one
+                from key_path, e.g. a FakeOpenAI for benchmarks.
+                Default is None.
+            semantic (bool): Whether to serve cached answers to
+                paraphrased queries. Default is True.
+        """
+        self.index_folder = index_folder
+        self.key_path = key_path
+        self.mmap = mmap
+
+        self.query_cache = QueryEmbeddingCache(
+            os.path.join(cache_folder, 'queries.sqlite')
+        )
+        self.answer_cache = AnswerCache(
+            os.path.join(cache_folder, 'answers.sqlite')
+        )
+        self.semantic_cache = (
+            SemanticAnswerCache(
+                os.path.join(cache_folder, 'semantic_answers.sqlite')
+            )
+            if semantic else None
+        )
+        self.page_cache = PageImageCache(
+            os.path.join(cache_folder, 'pages.sqlite')
+        )
+
+        self._lock = threading.Lock()
+        self._client = client
+        self._resources = None
+
+    def client(self):
+        """
+        Returns the shared OpenAI client, creating it on first use.
+
+        Returns:
+            OpenAI: The shared OpenAI client.
+        """
+        with self._lock:
+            if self._client is None:
+                self._client = load_openai_api_key(self.key_path)
+
+            return self._client
+
+    def index(self) -> IndexResources:
+        """
+        Returns the shared index resources, loading them on first use
+        or reloading them if the index was rebuilt.
+
+        Returns:
+            IndexResources: The loaded resources.
+        """
+        version = build_version(self.index_folder)
+
+        with self._lock:
+            resources = self._resources
+            if resources is not None and resources.version == version:
+                return resources
+
+            with tracing.span('load_resources') as span:
+                resources = self._load(version)
+                span.set(
+                    vectors=resources.index.ntotal,
+                    rss_delta_bytes=resources.rss_delta_bytes
+                )
+            self._resources = resources
+            tracing.gauge('index_vectors', resources.index.ntotal)
+            tracing.gauge('index_load_seconds', resources.load_seconds)
+
+        print(f'Loaded shared index: {resources.index.ntotal} vectors '
+              f'in {resources.load_seconds * 1000:.1f} ms, index '
+              f'{resources.index_bytes / 1024 ** 2:.1f} MiB '
+              f'({"mmap" if self.mmap else "in RAM"}).')
+
+        return resources
+
+    def project_ids(
+        self,
+        resources: IndexResources,
+        project_name: str
+    ) -> np.ndarray:
+        """
+        Returns the sorted chunk IDs of one project, looking them up on
+        first use.
+
+        Args:
+            resources (IndexResources): Resources returned by index().
+            project_name (str): Name of the project folder.
+
+        Returns:
+            np.ndarray: Sorted int64 chunk IDs of the project.
+        """
+        with self._lock:
+            ids = resources.project_ids.get(project_name)
+            if ids is None:
+                ids = np.sort(resources.store.project_ids(project_name))
+                resources.project_ids[project_name] = ids
+
+            return ids
+
+    def selector(
+        self,
+        resources: IndexResources,
+        project_name: str
+    ) -> faiss.IDSelector:
+        """
+        Returns an ID selector restricting searches of the shared index
+        to one project, building it on first use.
+
+        Args:
+            resources (IndexResources): Resources returned by index().
+            project_name (str): Name of the project folder.
+
+        Returns:
+            faiss.IDSelector: Selector of the project's vector IDs.
+        """
+        ids = self.project_ids(resources, project_name)
+        with self._lock:
+            selector = resources.selectors.get(project_name)
+            if selector is None:
+                selector = make_id_selector(ids)
+                resources.selectors[project_name] = selector
+
+            return selector
+
+    def lookup_answer(
+        self,
+        resources: IndexResources,
+        key: str,
+        project_name: str,
+        query: str,
+        top_indices: list[int],
+        route: str,
+        model_name: str
+    ) -> str | None:
+        """
+        Looks up the answer of a query in the answer cache, then in the
+        semantic answer cache. A semantic hit is also stored under the
+        exact key, so repeats of the paraphrase skip the similarity
+        search. Queries served by the lexical index alone are only
+        looked up if their embedding is cached already.
+
+        Args:
+            resources (IndexResources): Resources returned by index().
+            key (str): Key built by answer_key.
+            project_name (str): Selected project, or 'All Projects'.
+            query (str): The user query.
+            top_indices (list[int]): The IDs of the retrieved chunks.
+            route (str): The route that retrieved them.
+            model_name (str): Name of the chat model.
+
+        Returns:
+            str | None: The cached answer, or None for a miss.
+        """
+        response = self.answer_cache.get(key)
+        if (
+            response is not None
+            or self.semantic_cache is None
+            or not top_indices
+        ):
+            return response
+
+        with tracing.span('semantic_cache', project=project_name) as span:
+            embedding = self._query_embedding(resources, query, route)
+            if embedding is None:
+                span.set(hit=False, embedded=False)
+                return None
+            response = self.semantic_cache.get(
+                semantic_scope(
+                    project_name,
+                    model_name,
+                    PROMPT_VERSION,
+                    resources.embedder.model_id
+                ),
+                embedding,
+                top_indices,
+                resources.store
+            )
+            span.set(hit=response is not None)
+        if response is not None:
+            self.answer_cache.put(key, response)
+
+        return response
+
+    def remember_answer(
+        self,
+        resources: IndexResources,
+        key: str,
+        project_name: str,
+        query: str,
+        chunks: dict[int, dict],
+        top_indices: list[int],
+        route: str,
+        model_name: str,
+        response: str
+    ) -> None:
+        """
+        Stores a generated answer in the answer cache and the semantic
+        answer cache. As in lookup_answer, queries served by the
+        lexical index alone are only stored semantically if their
+        embedding is cached already.
+
+        Args:
+            resources (IndexResources): Resources returned by index().
+            key (str): Key built by answer_key.
+            project_name (str): Selected project, or 'All Projects'.
+            query (str): The user query.
+            chunks (dict[int, dict]): The retrieved chunks, keyed by ID.
+            top_indices (list[int]): The IDs of the top chunks.
+            route (str): The route that retrieved them.
+            model_name (str): Name of the chat model.
+            response (str): The generated answer.
+        """
+        self.answer_cache.put(key, response)
+        if self.semantic_cache is None or not top_indices:
+            return
+
+        embedding = self._query_embedding(resources, query, route)
+        if embedding is None:
+            return
+        self.semantic_cache.put(
+            semantic_scope(
+                project_name,
+                model_name,
+                PROMPT_VERSION,
+                resources.embedder.model_id
+            ),
+            project_name,
+            query,
+            embedding,
+            chunks,
+            top_indices,
+            response
+        )
+
+    def _query_embedding(
+        self,
+        resources: IndexResources,
+        query: str,
+        route: str
+    ) -> np.ndarray | None:
+        """
+        Returns the embedding of a query for the semantic answer cache.
+        Vector and hybrid searches have embedded the query already, so
+        it is served from the query embedding cache; a query the
+        lexical index answered alone is not embedded just for the
+        semantic cache.
+
+        Args:
+            resources (IndexResources): Resources returned by index().
+            query (str): The user query.
+            route (str): The route that retrieved the query's chunks.
+
+        Returns:
+            np.ndarray | None: The query embedding, or None if the
+                route was lexical and the embedding is not cached.
+        """
+        if route == 'lexical':
+            return self.query_cache.get(resources.embedder.model_id, query)
+
+        return embed_query(resources.embedder, query, cache=self.query_cache)
+
+    def _load(
+        self,
+        version: str | tuple
+    ) -> IndexResources:
+        """
+        Loads the shared index, chunk store and BM25 index from disk,
+        and creates the embedder the index was built with. Must be
+        called with the lock held.
+
+        Args:
+            version (str | tuple): Build version being loaded.
+
+        Returns:
+            IndexResources: The loaded resources.
+
+        Raises:
+            ValueError: If the embedder does not match the index.
+        """
+        index_path = os.path.join(self.index_folder, 'faiss_index.index')
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+
+        index = load_index(index_path, mmap=self.mmap)
+        store = ChunkStore(self.index_folder)
+        lexical = (
+            BM25Index(self.index_folder)
+            if has_bm25_index(self.index_folder) else None
+        )
+        info = load_index_info(index_path)
+
+        if (
+            embedder_spec(info)['backend'] == 'openai'
+            and self._client is None
+        ):
+            self._client = load_openai_api_key(self.key_path)
+        embedder = embedder_from_info(info, self._client)
+        check_embedder(embedder, info)
+
+        load_seconds = time.perf_counter() - start
+        rss_after = rss_bytes()
+
+        return IndexResources(
+            index=index,
+            store=store,
+            lexical=lexical,
+            embedder=embedder,
+            info=info,
+            version=version,
+            load_seconds=load_seconds,
+            index_bytes=os.path.getsize(index_path),
+            rss_delta_bytes=(
+                rss_after - rss_before
+                if rss_before is not None and rss_after is not None
+                else None
+            ),
+            project_ids={},
+            selectors={}
+        )
+
+    def stats(self) -> dict:
+        """
+        Returns load-time and memory figures of the loaded index and
+        the hit rates of the query-path caches.
+
+        Returns:
+            dict: Vectors, index type and quantization, embedder model
+                ID, load time in seconds, index file size and RSS growth
+                caused by loading, in bytes (None where RSS is
+                unavailable), the near-duplicates behind the indexed
+                chunks, the projects with a cached selector, and query
+                embedding, answer, semantic answer and page image cache
+                stats.
+        """
+        caches = {
+            'query_cache': self.query_cache.stats(),
+            'answer_cache': self.answer_cache.stats(),
+            'semantic_cache': (
+                self.semantic_cache.stats()
+                if self.semantic_cache is not None else None
+            ),
+            'page_cache': self.page_cache.stats()
+        }
+
+        with self._lock:
+            resources = self._resources
+            if resources is None:
+                return caches
+
+            return caches | {
+                'vectors': resources.index.ntotal,
+                'index_type': resources.info['index_type'],
+                'quantization': resources.info['params'].get('quantization'),
+                'embedder': resources.embedder.model_id,
+                'load_seconds': resources.load_seconds,
+                'index_bytes': resources.index_bytes,
+                'rss_delta_bytes': resources.rss_delta_bytes,
+                'mmap': self.mmap,
+                'duplicates': resources.store.duplicate_count(),
+                'lexical_terms': (
+                    resources.lexical.meta['terms']
+                    if resources.lexical is not None else None
+                ),
+                'selectors': sorted(resources.selectors)
+            }
@@ -0,0 +1,75 @@
+"""
+Retrieval of the top chunks of queries from the shared index, shared
+by the query service and batch queries: queries needing a vector search
+are embedded in batched requests and searched with one multi-row FAISS
+search, and fused with the BM25 results (see hybrid_search).
+"""
+
+from resources import ResourceRegistry, IndexResources
+from faiss_search import embed_queries, search_faiss_index_batch
+from hybrid_search import hybrid_search_batch
+
+
+MODEL_NAME = 'gpt-4o-mini'
+
+PROJECT_TOP_K = 5
+GLOBAL_TOP_K = 20
+
+
+def retrieve_batch(
+    registry: ResourceRegistry,
+    resources: IndexResources,
+    queries: list[str],
+    project_name: str = None,
+    top_k: int = GLOBAL_TOP_K,
+    mode: str = 'hybrid'
+) -> list[tuple[list[int], str]]:
+    """
+    Retrieves the top chunks of many queries, embedding those that need
+    a vector search in batched requests and searching them with one
+    multi-row FAISS search.
+
+    Args:
+        registry (ResourceRegistry): The resource registry.
+        resources (IndexResources): Resources returned by
+            registry.index().
+        queries (list[str]): The user queries.
+        project_name (str): Restricts the search to one project.
+            Default is None (all projects).
+        top_k (int): Number of chunks retrieved per query. Default is
+            GLOBAL_TOP_K.
+        mode (str): One of SEARCH_MODES. Default is 'hybrid'.
+
+    Returns:
+        list[tuple[list[int], str]]: IDs of the top chunks of each
+            query, and the route that produced them.
+    """
+    allowed_ids = None
+    id_selector = None
+    if project_name is not None:
+        allowed_ids = registry.project_ids(resources, project_name)
+        id_selector = registry.selector(resources, project_name)
+
+    def vector_search(positions: list[int], k: int) -> list[list[int]]:
+        query_embeddings = embed_queries(
+            resources.embedder,
+            [queries[i] for i in positions],
+            cache=registry.query_cache
+        )
+        return search_faiss_index_batch(
+            index=resources.index,
+            query_embeddings=query_embeddings,
+            top_k=k,
+            search_params=resources.info['params'],
+            id_selector=id_selector,
+            store=resources.store
+        )
+
+    return hybrid_search_batch(
+        queries=queries,
+        lexical_index=resources.lexical,
+        vector_search=vector_search,
+        top_k=top_k,
+        mode=mode,
+        allowed_ids=allowed_ids
+    )
@@ -0,0 +1,174 @@
+"""
+Runs a graph of dependent tasks on a thread pool, e.g. the projects of
+a build, which are independent of each other, and the shared index,
+which waits on all of them.
+
+A task starts as soon as all of its dependencies have finished. A
+failed task fails only itself: the tasks depending on it are skipped,
+unless they are marked to run after failed dependencies too (e.g. to
+finish the work of those that succeeded). While tasks run, the progress
+of each is printed periodically.
+"""
+
+import time
+import contextvars
+from dataclasses import dataclass
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import tracing
+
+
+PROGRESS_SECONDS = 10.0
+
+
+@dataclass
+class Task:
+    """
+    A unit of work in a task graph.
+    """
+    name: str
+    func: Callable[[], object]
+    deps: tuple[str, ...] = ()
+    # Whether the task runs when a dependency failed or was skipped.
+    after_failures: bool = False
+    # Describes the progress of the running task, e.g. '3/10 PDFs'.
+    progress: Callable[[], str] | None = None
+
+
+@dataclass
+class TaskResult:
+    """
+    Outcome of one task.
+    """
+    name: str
+    status: str
+    value: object = None
+    error: Exception | None = None
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        """
+        bool: Whether the task completed successfully.
+        """
+        return self.status == 'done'
+
+
+def _run(
+    task: Task
+) -> tuple[object, float]:
+    """
+    Runs a task in a tracing span.
+
+    Args:
+        task (Task): The task.
+
+    Returns:
+        tuple[object, float]: The task's return value and its
+            wall-clock time in seconds.
+    """
+    start = time.perf_counter()
+    with tracing.span('task', task=task.name):
+        value = task.func()
+
+    return value, time.perf_counter() - start
+
+
+def run_tasks(
+    tasks: list[Task],
+    max_workers: int,
+    progress_seconds: float = PROGRESS_SECONDS
+) -> dict[str, TaskResult]:
+    """
+    Runs tasks in dependency order, up to max_workers at a time.
+
+    Args:
+        tasks (list[Task]): The tasks, with unique names.
+        max_workers (int): Maximum number of tasks running at once.
+        progress_seconds (float): Interval at which the progress of the
+            running tasks is printed. Default is PROGRESS_SECONDS.
+
+    Returns:
+        dict[str, TaskResult]: Result of each task, keyed by name, with
+            status 'done', 'failed' or 'skipped'.
+
+    Raises:
+        ValueError: If task names are not unique, a dependency is
+            unknown, or the dependencies form a cycle.
+    """
+    names = {task.name for task in tasks}
+    if len(names) != len(tasks):
+        raise ValueError('Task names must be unique.')
+    for task in tasks:
+        unknown = set(task.deps) - names
+        if unknown:
+            raise ValueError(
+                f'Task {task.name!r} depends on unknown tasks {unknown}.'
+            )
+
+    results = {}
+    waiting = list(tasks)
+    running = {}
+
+    def finish(result: TaskResult) -> None:
+        results[result.name] = result
+        tracing.count('tasks_total', status=result.status)
+        if result.status == 'failed':
+            message = f'failed: {type(result.error).__name__}: {result.error}'
+        elif result.status == 'skipped':
+            message = 'skipped, a dependency failed.'
+        else:
+            message = f'done in {result.seconds:.2f}s.'
+        print(f'[{len(results)}/{len(tasks)}] {result.name}: {message}')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            # Skipping a task may in turn settle the tasks waiting on it.
+            progressed = True
+            while progressed:
+                progressed = False
+                for task in list(waiting):
+                    if not all(dep in results for dep in task.deps):
+                        continue
+                    waiting.remove(task)
+                    progressed = True
+                    if task.after_failures or all(
+                        results[dep].ok for dep in task.deps
+                    ):
+                        # Tasks run in a copy of the current context, so
+                        # their spans nest under the caller's.
+                        future = executor.submit(
+                            contextvars.copy_context().run, _run, task
+                        )
+                        running[future] = task
+                    else:
+                        finish(TaskResult(task.name, 'skipped'))
+
+            if not running:
+                if waiting:
+                    raise ValueError(
+                        'Task dependencies form a cycle: '
+                        f'{sorted(task.name for task in waiting)}.'
+                    )
+                break
+
+            done, _ = wait(
+                running, timeout=progress_seconds,
+                return_when=FIRST_COMPLETED
+            )
+            if not done:
+                print('In progress: ' + '; '.join(
+                    task.name + (f' ({task.progress()})'
+                                 if task.progress is not None else '')
+                    for task in running.values()
+                ))
+            for future in done:
+                task = running.pop(future)
+                try:
+                    value, seconds = future.result()
+                    finish(TaskResult(task.name, 'done', value, None, seconds))
+                except Exception as e:
+                    finish(TaskResult(task.name, 'failed', error=e))
+
+    return results
@@ -0,0 +1,443 @@
+"""
+Headless HTTP/JSON query service, for other tools and for running the
+Streamlit app as a thin client.
+
+The shared indices, chunk store and per-project filters are loaded
+once at startup and kept warm, and one OpenAI client (with its
+connection pool) is shared by all requests. Requests are served with
+async I/O; searches and API calls run in the worker thread pool, so
+concurrent requests overlap.
+
+Endpoints:
+
+    GET  /health          Liveness and the number of indexed vectors.
+    GET  /projects        Names of the indexed projects.
+    GET  /stats           Index load figures and cache hit rates.
+    POST /retrieve        Top chunks of a query.
+    POST /answer          Answer of a query with its sources.
+    POST /answer/stream   The same as NDJSON events: 'sources', then
+                          'delta' pieces of the answer, then 'done'.
+    GET  /metrics         Prometheus metrics, if tracing is enabled.
+
+POST bodies are JSON objects with a 'query' and the optional 'project',
+'mode', 'top_k' and 'model'. Run with:
+
+    python service.py --port 8000
+    python service.py --stub   # local stub LLM and embeddings, no key
+"""
+
+import os
+import sys
+import json
+import argparse
+import threading
+from contextlib import asynccontextmanager
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+from starlette.requests import Request
+from starlette.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse
+)
+from starlette.routing import Route
+
+import tracing
+from fake_client import FakeOpenAI
+from resources import ResourceRegistry
+from hybrid_search import SEARCH_MODES
+from query_cache import answer_key
+from retrieval import (
+    retrieve_batch,
+    MODEL_NAME,
+    PROJECT_TOP_K,
+    GLOBAL_TOP_K
+)
+from rag import (
+    format_prompt,
+    call_openai_model,
+    stream_openai_model,
+    context_budget,
+    CONTEXT_TOKEN_BUDGETS,
+    PROMPT_VERSION
+)
+
+
+HOST = '127.0.0.1'
+PORT = 8000
+
+MAX_TOP_K = 100
+
+PROJECT_FOLDER = os.path.join(
+    os.path.dirname(__file__), '..', 'data', 'projects'
+)
+OPENAI_KEY_PATH = os.path.join(
+    os.path.dirname(__file__), 'OPENAI_API_KEY.txt'
+)
+CACHE_FOLDER = os.path.join(
+    os.path.dirname(__file__), '..', 'data', 'cache'
+)
+
+# JSON span log ('-' for standard error) and Prometheus metrics file;
+# tracing is disabled while both are None.
+TRACE_LOG_PATH = None
+METRICS_PATH = None
+
+# Latencies of the stub LLM, in seconds.
+STUB_FIRST_TOKEN_LATENCY = 0.2
+STUB_TOKEN_LATENCY = 0.02
+
+
+class RequestError(Exception):
+    """
+    An invalid request, answered with its HTTP status.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        status_code: int = 400
+    ) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def create_app(
+    registry: ResourceRegistry
+) -> Starlette:
+    """
+    Creates the service around a resource registry.
+
+    Args:
+        registry (ResourceRegistry): Registry of the shared index. Its
+            client is used for embeddings and answers, e.g. a
+            FakeOpenAI for a stub service.
+
+    Returns:
+        Starlette: The ASGI application.
+    """
+    # Projects of the loaded index, refreshed when it is rebuilt.
+    known = {'version': None, 'projects': []}
+    known_lock = threading.Lock()
+
+    def indexed_projects(resources) -> list[str]:
+        with known_lock:
+            if known['version'] != resources.version:
+                known['projects'] = resources.store.projects()
+                known['version'] = resources.version
+            return known['projects']
+
+    def warm_up():
+        resources = registry.index()
+        for project in indexed_projects(resources):
+            registry.selector(resources, project)
+        registry.client()
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await run_in_threadpool(warm_up)
+        yield
+
+    async def parse(request: Request) -> dict:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise RequestError('The request body must be JSON.')
+        if not isinstance(body, dict):
+            raise RequestError('The request body must be a JSON object.')
+
+        query = body.get('query')
+        if not isinstance(query, str) or not query.strip():
+            raise RequestError("'query' must be a non-empty string.")
+
+        project = body.get('project') or None
+        if project is not None and not isinstance(project, str):
+            raise RequestError("'project' must be a string.")
+
+        mode = body.get('mode', 'hybrid')
+        if not isinstance(mode, str) or mode not in SEARCH_MODES:
+            raise RequestError(f"'mode' must be one of {SEARCH_MODES}.")
+
+        top_k = body.get('top_k')
+        if top_k is None:
+            top_k = PROJECT_TOP_K if project is not None else GLOBAL_TOP_K
+        if (
+            isinstance(top_k, bool)
+            or not isinstance(top_k, int)
+            or not 0 < top_k <= MAX_TOP_K
+        ):
+            raise RequestError(
+                f"'top_k' must be an integer from 1 to {MAX_TOP_K}."
+            )
+
+        model = body.get('model', MODEL_NAME)
+        if not isinstance(model, str) or model not in CONTEXT_TOKEN_BUDGETS:
+            raise RequestError(
+                f"'model' must be one of {sorted(CONTEXT_TOKEN_BUDGETS)}."
+            )
+
+        return {
+            'query': query,
+            'project': project,
+            'mode': mode,
+            'top_k': top_k,
+            'model': model
+        }
+
+    def retrieve(params: dict) -> dict:
+        resources = registry.index()
+        project = params['project']
+        if project is not None and project not in indexed_projects(
+            resources
+        ):
+            raise RequestError(f'Unknown project {project!r}.', 404)
+
+        top_indices, route = retrieve_batch(
+            registry,
+            resources,
+            [params['query']],
+            project,
+            params['top_k'],
+            params['mode']
+        )[0]
+        chunks = resources.store.get_many(top_indices)
+        # IDs missing from a store replaced since the search.
+        top_indices = [idx for idx in top_indices if idx in chunks]
+
+        return {
+            'resources': resources,
+            'route': route,
+            'top_indices': top_indices,
+            'chunks': chunks,
+            'sources': [chunks[idx]['metadata'] for idx in top_indices]
+        }
+
+    def cached_answer(params: dict, retrieved: dict) -> tuple[str, str]:
+        key = answer_key(
+            project_name=params['project'] or 'All Projects',
+            query=params['query'],
+            chunks=retrieved['chunks'],
+            top_indices=retrieved['top_indices'],
+            model_name=params['model'],
+            prompt_version=PROMPT_VERSION
+        )
+
+        return key, registry.lookup_answer(
+            resources=retrieved['resources'],
+            key=key,
+            project_name=params['project'] or 'All Projects',
+            query=params['query'],
+            top_indices=retrieved['top_indices'],
+            route=retrieved['route'],
+            model_name=params['model']
+        )
+
+    def remember(
+        params: dict,
+        retrieved: dict,
+        key: str,
+        response: str
+    ) -> None:
+        registry.remember_answer(
+            resources=retrieved['resources'],
+            key=key,
+            project_name=params['project'] or 'All Projects',
+            query=params['query'],
+            chunks=retrieved['chunks'],
+            top_indices=retrieved['top_indices'],
+            route=retrieved['route'],
+            model_name=params['model'],
+            response=response
+        )
+
+    def prompt(params: dict, retrieved: dict) -> str:
+        return format_prompt(
+            query=params['query'],
+            chunks=retrieved['chunks'],
+            top_indices=retrieved['top_indices'],
+            max_context_tokens=context_budget(params['model'])
+        )
+
+    def generate(params: dict, retrieved: dict) -> str:
+        return call_openai_model(
+            client=registry.client(),
+            prompt=prompt(params, retrieved),
+            model_name=params['model']
+        )
+
+    async def health(request: Request) -> JSONResponse:
+        resources = await run_in_threadpool(registry.index)
+        return JSONResponse(
+            {'status': 'ok', 'vectors': resources.index.ntotal}
+        )
+
+    async def projects(request: Request) -> JSONResponse:
+        resources = await run_in_threadpool(registry.index)
+        return JSONResponse(
+            {'projects': await run_in_threadpool(indexed_projects, resources)}
+        )
+
+    async def stats(request: Request) -> JSONResponse:
+        return JSONResponse(await run_in_threadpool(registry.stats))
+
+    async def metrics(request: Request) -> PlainTextResponse:
+        if not tracing.enabled():
+            return PlainTextResponse('Tracing is disabled.', 404)
+        return PlainTextResponse(
+            tracing.render_metrics(),
+            media_type='text/plain; version=0.0.4'
+        )
+
+    async def retrieve_endpoint(request: Request) -> JSONResponse:
+        params = await parse(request)
+        with tracing.span('service_retrieve', project=params['project']):
+            retrieved = await run_in_threadpool(retrieve, params)
+
+        return JSONResponse({
+            'route': retrieved['route'],
+            'chunks': [
+                retrieved['chunks'][idx]
+                for idx in retrieved['top_indices']
+            ]
+        })
+
+    async def answer_endpoint(request: Request) -> JSONResponse:
+        params = await parse(request)
+        with tracing.span(
+            'service_answer', project=params['project']
+        ) as span:
+            retrieved = await run_in_threadpool(retrieve, params)
+            key, response = await run_in_threadpool(
+                cached_answer, params, retrieved
+            )
+            cached = response is not None
+            span.set(cached=cached)
+            if not cached:
+                response = await run_in_threadpool(
+                    generate, params, retrieved
+                )
+                await run_in_threadpool(
+                    remember, params, retrieved, key, response
+                )
+
+        return JSONResponse({
+            'answer': response,
+            'cached': cached,
+            'route': retrieved['route'],
+            'sources': retrieved['sources']
+        })
+
+    async def stream_endpoint(request: Request) -> StreamingResponse:
+        params = await parse(request)
+        retrieved = await run_in_threadpool(retrieve, params)
+        key, cached = await run_in_threadpool(
+            cached_answer, params, retrieved
+        )
+        if cached is None:
+            text = await run_in_threadpool(prompt, params, retrieved)
+
+        def event(**fields) -> str:
+            return json.dumps(fields, ensure_ascii=False) + '\n'
+
+        async def events():
+            yield event(
+                type='sources',
+                route=retrieved['route'],
+                sources=retrieved['sources']
+            )
+            if cached is not None:
+                yield event(type='delta', text=cached)
+                yield event(type='done', cached=True, cancelled=False)
+                return
+
+            # Set when the client disconnects, which stops the upstream
+            # stream at its next piece.
+            cancel = threading.Event()
+            timings = {}
+            response = ''
+            pieces = stream_openai_model(
+                client=registry.client(),
+                prompt=text,
+                model_name=params['model'],
+                cancel=cancel,
+                timings=timings
+            )
+            try:
+                async for piece in iterate_in_threadpool(pieces):
+                    response += piece
+                    yield event(type='delta', text=piece)
+            finally:
+                cancel.set()
+                await run_in_threadpool(pieces.close)
+
+            if not timings.get('cancelled'):
+                await run_in_threadpool(
+                    remember, params, retrieved, key, response
+                )
+            yield event(
+                type='done',
+                cached=False,
+                cancelled=bool(timings.get('cancelled')),
+                ttft_seconds=timings.get('ttft_seconds')
+            )
+
+        return StreamingResponse(
+            events(), media_type='application/x-ndjson'
+        )
+
+    async def request_error(
+        request: Request,
+        error: RequestError
+    ) -> JSONResponse:
+        return JSONResponse({'error': str(error)}, error.status_code)
+
+    return Starlette(
+        routes=[
+            Route('/health', health),
+            Route('/projects', projects),
+            Route('/stats', stats),
+            Route('/metrics', metrics),
+            Route('/retrieve', retrieve_endpoint, methods=['POST']),
+            Route('/answer', answer_endpoint, methods=['POST']),
+            Route('/answer/stream', stream_endpoint, methods=['POST'])
+        ],
+        exception_handlers={RequestError: request_error},
+        lifespan=lifespan
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument(
+        '--stub', action='store_true',
+        help='answer with a local stub LLM and embeddings (testing only)'
+    )
+    args = parser.parse_args()
+
+    tracing.configure(log_path=TRACE_LOG_PATH, metrics_path=METRICS_PATH)
+
+    client = None
+    cache_folder = CACHE_FOLDER
+    if args.stub:
+        client = FakeOpenAI(
+            first_token_latency=STUB_FIRST_TOKEN_LATENCY,
+            token_latency=STUB_TOKEN_LATENCY
+        )
+        # Stub answers must not be served to the real app.
+        cache_folder = os.path.join(CACHE_FOLDER, 'stub')
+    registry = ResourceRegistry(
+        os.path.join(PROJECT_FOLDER, 'global'),
+        OPENAI_KEY_PATH,
+        cache_folder,
+        client=client
+    )
+
+    uvicorn.run(create_app(registry), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
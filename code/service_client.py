@@ -0,0 +1,192 @@
+"""
+Client of the query service (see service.py), using only the standard
+library so tools can call the service without extra dependencies.
+"""
+
+import json
+import urllib.error
+import urllib.request
+from collections.abc import Iterator
+
+
+TIMEOUT_SECONDS = 120
+
+
+class ServiceError(Exception):
+    """
+    A request the service rejected or failed to answer.
+    """
+
+
+class ServiceClient:
+    """
+    Calls the endpoints of a running query service.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        timeout: float = TIMEOUT_SECONDS
+    ) -> None:
+        """
+        Creates the client.
+
+        Args:
+            base_url (str): URL of the service, e.g.
+                'http://127.0.0.1:8000'.
+            timeout (float): Seconds to wait for a response. Default is
+                TIMEOUT_SECONDS.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _open(
+        self,
+        path: str,
+        body: dict = None
+    ):
+        """
+        Sends a request, as a POST of JSON if a body is given.
+
+        Args:
+            path (str): Path of the endpoint.
+            body (dict): JSON body. Default is None (a GET).
+
+        Returns:
+            http.client.HTTPResponse: The open response.
+
+        Raises:
+            ServiceError: If the service is unreachable or answers with
+                an error status.
+        """
+        request = urllib.request.Request(self.base_url + path)
+        if body is not None:
+            request.data = json.dumps(body).encode('utf-8')
+            request.add_header('Content-Type', 'application/json')
+
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read())['error']
+            except (ValueError, KeyError):
+                message = e.reason
+            raise ServiceError(f'{e.code}: {message}') from e
+        except urllib.error.URLError as e:
+            raise ServiceError(
+                f'Query service at {self.base_url} is unreachable: '
+                f'{e.reason}'
+            ) from e
+
+    def _get(
+        self,
+        path: str
+    ) -> dict:
+        """
+        Sends a GET request.
+
+        Args:
+            path (str): Path of the endpoint.
+
+        Returns:
+            dict: The JSON response.
+        """
+        with self._open(path) as response:
+            return json.load(response)
+
+    def _post(
+        self,
+        path: str,
+        body: dict
+    ) -> dict:
+        """
+        Sends a POST request with a JSON body.
+
+        Args:
+            path (str): Path of the endpoint.
+            body (dict): JSON body.
+
+        Returns:
+            dict: The JSON response.
+        """
+        with self._open(path, body) as response:
+            return json.load(response)
+
+    def projects(self) -> list[str]:
+        """
+        Lists the projects of the shared index.
+
+        Returns:
+            list[str]: Names of the indexed projects.
+        """
+        return self._get('/projects')['projects']
+
+    def stats(self) -> dict:
+        """
+        Returns the service's index and cache figures.
+
+        Returns:
+            dict: Index load figures and cache hit rates.
+        """
+        return self._get('/stats')
+
+    def retrieve(
+        self,
+        query: str,
+        **options
+    ) -> dict:
+        """
+        Retrieves the top chunks of a query.
+
+        Args:
+            query (str): The user query.
+            **options: Optional 'project', 'mode', 'top_k' and 'model'.
+
+        Returns:
+            dict: 'route' and 'chunks' (with 'id', 'content' and
+                'metadata'), best first.
+        """
+        return self._post('/retrieve', {'query': query, **options})
+
+    def answer(
+        self,
+        query: str,
+        **options
+    ) -> dict:
+        """
+        Answers a query.
+
+        Args:
+            query (str): The user query.
+            **options: Optional 'project', 'mode', 'top_k' and 'model'.
+
+        Returns:
+            dict: 'answer', 'cached', 'route' and 'sources' (metadata of
+                the retrieved chunks, best first).
+        """
+        return self._post('/answer', {'query': query, **options})
+
+    def stream_answer(
+        self,
+        query: str,
+        **options
+    ) -> Iterator[dict]:
+        """
+        Answers a query, yielding events as the answer is generated.
+        Closing the iterator closes the connection, which cancels the
+        generation.
+
+        Args:
+            query (str): The user query.
+            **options: Optional 'project', 'mode', 'top_k' and 'model'.
+
+        Yields:
+            dict: A 'sources' event (with 'route' and 'sources'), then
+                'delta' events (with 'text'), then a 'done' event.
+        """
+        with self._open(
+            '/answer/stream', {'query': query, **options}
+        ) as response:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
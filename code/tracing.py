@@ -0,0 +1,464 @@
+"""
+Lightweight tracing and metrics for the build and query paths.
+
+Code wraps each stage in a span:
+
+    with tracing.span('faiss_search', top_k=top_k) as span:
+        ...
+        span.set(results=len(results))
+
+and records counts (tokens, API retries, cache hits) with count(). Once
+configure() enables tracing, every finished span is written as one JSON
+line (name, duration, trace and parent IDs, attributes, error) and is
+added to a per-stage latency histogram. Metrics can be written to a
+file and/or served over HTTP in the Prometheus text format.
+
+Tracing is disabled by default; span() then returns a shared no-op
+object and count() returns at once, so instrumented code pays only a
+function call and a flag check.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+METRIC_PREFIX = 'tonkintelligent_'
+
+# Upper bounds of the span latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    30.0, 60.0, 300.0
+)
+
+_enabled = False
+_log_file = None
+_log_lock = threading.Lock()
+_metrics_path = None
+_metrics_server = None
+
+_metrics_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class _NoopSpan:
+    """
+    Span returned while tracing is disabled; does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """
+    A timed stage. Created by span(); use as a context manager.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        attributes: dict
+    ) -> None:
+        """
+        Creates the span.
+
+        Args:
+            name (str): Name of the stage.
+            attributes (dict): Initial attributes.
+        """
+        self.name = name
+        self.attributes = attributes
+        self.span_id = uuid.uuid4().hex[:16]
+        self.trace_id = None
+        self.parent_id = None
+        self._token = None
+        self._start = None
+        self._start_time = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is not None:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+        else:
+            self.trace_id = uuid.uuid4().hex
+        self._token = _current_span.set(self)
+        self._start_time = time.time()
+        self._start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        _current_span.reset(self._token)
+
+        # Exceptions that are not errors (GeneratorExit, a stopped
+        # pipeline, KeyboardInterrupt) mark the span as cancelled.
+        if exc_type is None:
+            status = 'ok'
+        elif issubclass(exc_type, Exception):
+            status = 'error'
+        else:
+            status = 'cancelled'
+
+        observe('span_seconds', seconds, span=self.name)
+        if status == 'error':
+            count('span_errors_total', span=self.name)
+
+        record = {
+            'timestamp': self._start_time,
+            'name': self.name,
+            'duration_ms': round(seconds * 1000, 3),
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'thread': threading.current_thread().name,
+            'status': status,
+            'attributes': self.attributes
+        }
+        if status == 'error':
+            record['error'] = f'{exc_type.__name__}: {exc}'
+        _write_log(record)
+
+        return False
+
+    def set(self, **attributes) -> None:
+        """
+        Adds attributes, e.g. token counts known once the stage ran.
+        """
+        self.attributes.update(attributes)
+
+
+def configure(
+    log_path: str = None,
+    metrics_path: str = None,
+    metrics_port: int = None
+) -> None:
+    """
+    Enables tracing if any output is given, or disables it otherwise.
+
+    Args:
+        log_path (str): File to append JSON span logs to, or '-' for
+            standard error. Default is None (no logs).
+        metrics_path (str): File write_metrics() saves the metrics to.
+            Default is None.
+        metrics_port (int): Port to serve the metrics on at /metrics.
+            Default is None (no endpoint).
+    """
+    global _enabled, _log_file, _metrics_path, _metrics_server
+
+    with _log_lock:
+        if _log_file is not None and _log_file is not sys.stderr:
+            _log_file.close()
+        _log_file = None
+        if log_path == '-':
+            _log_file = sys.stderr
+        elif log_path:
+            os.makedirs(
+                os.path.dirname(os.path.abspath(log_path)), exist_ok=True
+            )
+            _log_file = open(log_path, 'a', encoding='utf-8')
+
+    _metrics_path = metrics_path
+    if metrics_port is not None and _metrics_server is None:
+        _metrics_server = _serve_metrics(metrics_port)
+
+    _enabled = bool(log_path or metrics_path or metrics_port is not None)
+
+
+def enabled() -> bool:
+    """
+    Checks whether tracing is enabled.
+
+    Returns:
+        bool: Whether tracing is enabled.
+    """
+    return _enabled
+
+
+def span(
+    name: str,
+    **attributes
+) -> Span | _NoopSpan:
+    """
+    Starts a span around a stage. Spans opened inside it, in the same
+    thread or context, become its children.
+
+    Args:
+        name (str): Name of the stage, e.g. 'embed_query'.
+        **attributes: Attributes logged with the span.
+
+    Returns:
+        Span | _NoopSpan: Context manager timing the stage.
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+
+    return Span(name, attributes)
+
+
+def _labels_key(
+    name: str,
+    labels: dict
+) -> tuple:
+    """
+    Returns the key of a metric series.
+
+    Args:
+        name (str): Metric name, without METRIC_PREFIX.
+        labels (dict): Label values.
+
+    Returns:
+        tuple: Name and sorted labels.
+    """
+    return (name, tuple(sorted(
+        (k, str(v).lower() if isinstance(v, bool) else str(v))
+        for k, v in labels.items()
+    )))
+
+
+def count(
+    name: str,
+    value: float = 1,
+    **labels
+) -> None:
+    """
+    Adds to a counter, e.g. count('openai_retries_total',
+    endpoint='embeddings').
+
+    Args:
+        name (str): Counter name, without METRIC_PREFIX.
+        value (float): Amount to add. Default is 1.
+        **labels: Label values of the series.
+    """
+    if not _enabled:
+        return
+
+    key = _labels_key(name, labels)
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(
+    name: str,
+    value: float,
+    **labels
+) -> None:
+    """
+    Sets a gauge, e.g. the number of indexed vectors.
+
+    Args:
+        name (str): Gauge name, without METRIC_PREFIX.
+        value (float): The current value.
+        **labels: Label values of the series.
+    """
+    if not _enabled:
+        return
+
+    with _metrics_lock:
+        _gauges[_labels_key(name, labels)] = value
+
+
+def observe(
+    name: str,
+    value: float,
+    **labels
+) -> None:
+    """
+    Adds an observation to a histogram with LATENCY_BUCKETS.
+
+    Args:
+        name (str): Histogram name, without METRIC_PREFIX.
+        value (float): The observed value, in seconds.
+        **labels: Label values of the series.
+    """
+    if not _enabled:
+        return
+
+    key = _labels_key(name, labels)
+    with _metrics_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                'buckets': [0] * len(LATENCY_BUCKETS),
+                'sum': 0.0,
+                'count': 0
+            }
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def _write_log(
+    record: dict
+) -> None:
+    """
+    Writes a log record as one JSON line.
+
+    Args:
+        record (dict): The record.
+    """
+    if _log_file is None:
+        return
+
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _log_lock:
+        if _log_file is not None:
+            _log_file.write(line + '\n')
+            _log_file.flush()
+
+
+def _format_labels(
+    labels: tuple,
+    extra: tuple = ()
+) -> str:
+    """
+    Formats label pairs for the Prometheus text format.
+
+    Args:
+        labels (tuple): (name, value) pairs.
+        extra (tuple): Further pairs, e.g. the bucket bound. Default is
+            ().
+
+    Returns:
+        str: '{name="value",...}', or '' without labels.
+    """
+    pairs = labels + extra
+    if not pairs:
+        return ''
+
+    def escape(value):
+        return (
+            value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+
+def render_metrics() -> str:
+    """
+    Renders all metrics in the Prometheus text exposition format.
+
+    Returns:
+        str: The metrics.
+    """
+    lines = []
+    with _metrics_lock:
+        for kind, series in (('counter', _counters), ('gauge', _gauges)):
+            typed = set()
+            for (name, labels), value in sorted(series.items()):
+                metric = METRIC_PREFIX + name
+                if metric not in typed:
+                    lines.append(f'# TYPE {metric} {kind}')
+                    typed.add(metric)
+                lines.append(f'{metric}{_format_labels(labels)} {value}')
+
+        typed = set()
+        for (name, labels), histogram in sorted(_histograms.items()):
+            metric = METRIC_PREFIX + name
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} histogram')
+                typed.add(metric)
+            for bound, n in zip(LATENCY_BUCKETS, histogram['buckets']):
+                lines.append(
+                    f'{metric}_bucket'
+                    f'{_format_labels(labels, (("le", str(bound)),))} {n}'
+                )
+            lines.append(
+                f'{metric}_bucket{_format_labels(labels, (("le", "+Inf"),))} '
+                f'{histogram["count"]}'
+            )
+            lines.append(
+                f'{metric}_sum{_format_labels(labels)} {histogram["sum"]}'
+            )
+            lines.append(
+                f'{metric}_count{_format_labels(labels)} '
+                f'{histogram["count"]}'
+            )
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(
+    path: str = None
+) -> None:
+    """
+    Atomically saves the metrics in the Prometheus text format, e.g.
+    for the node exporter's textfile collector.
+
+    Args:
+        path (str): Destination file. Default is None (the metrics_path
+            given to configure(); nothing is written without one).
+    """
+    path = path or _metrics_path
+    if not _enabled or not path:
+        return
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fout:
+        fout.write(render_metrics())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics at /metrics.
+    """
+
+    def do_GET(self) -> None:
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def _serve_metrics(
+    port: int
+) -> ThreadingHTTPServer:
+    """
+    Serves the metrics from a daemon thread.
+
+    Args:
+        port (int): Port to listen on.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name='metrics', daemon=True
+    ).start()
+    print(f'Serving metrics at http://localhost:{port}/metrics.')
+
+    return server